@@ -0,0 +1,411 @@
+# -*- coding: utf-8 -*-
+"""
+Бэкенды ответа клиенту: Assistants API (threads/runs) и chat completions с локальной
+историей разговора и FAQ. Обработчики bot.py получают результат хода (TurnResult)
+и не зависят от того, какой бэкенд выбран.
+"""
+
+import asyncio
+import glob
+import json
+import logging
+import math
+import os
+import re
+from collections import Counter
+
+import openai
+
+from config import CHAT_SYSTEM_PROMPT_PATH, CHAT_FAQ_MAX_CHARS, CHAT_HISTORY_MESSAGES, SUPPORTED_LANGUAGES
+from openai_client import (create_thread_for_user, get_run_status, cancel_run, get_assistant_response,
+                           maybe_rotate_thread, get_conversation_history, get_previous_conversation_summary,
+                           format_history_message, stream_chat_completion)
+from openai_factory import openai_for
+from tenants import current_tenant
+from traffic_capture import traced, summarize_request_result
+from utils import save_threads, save_conversations
+
+# Интервал опроса статуса run'а в секундах (traffic_replay уменьшает его при ускорении)
+RUN_POLL_INTERVAL = 1.0
+
+# Сколько ошибок опроса подряд допускается, прежде чем запрос считается неудавшимся
+MAX_POLL_ERRORS = 3
+
+# Сколько опросов ждать завершения run'а
+MAX_POLL_ATTEMPTS = 60
+
+# Виды результата хода
+REPLY = 'reply'
+TRANSFER = 'transfer'
+ERROR = 'error'
+
+class TurnResult:
+    """
+    Итог одного хода разговора.
+
+    REPLY - text для клиента (None - отвечать нечего), TRANSFER - transfer_args функции
+    transfer_to_manager, ERROR - error, ключ текста ошибки в TEXTS.
+    finish - необязательная синхронная работа бэкенда после ответа клиенту (свертка thread'а,
+    отмена run'а); бот выполняет ее в отдельном потоке.
+    usage - расход хода для учета (usage_ledger.py): prompt_tokens, completion_tokens, polls.
+    """
+
+    def __init__(self, kind, text=None, transfer_args=None, error=None, finish=None, usage=None):
+        self.kind = kind
+        self.text = text
+        self.transfer_args = transfer_args
+        self.error = error
+        self.finish = finish
+        self.usage = usage or {}
+
+    def __repr__(self):
+        return f"TurnResult({self.kind!r}, error={self.error!r})"
+
+# Ошибки safe_process_message -> ключи текстов ошибок
+_REQUEST_ERRORS = {
+    'rate_limit': 'rate_limit_error',
+    'api_error': 'api_error'
+}
+
+@traced('openai.safe_process_message', summarize_request_result)
+async def safe_process_message(user_message, thread_id, user_lang, assistant_id=None):
+    """
+    Безопасно обрабатывает сообщение через OpenAI Assistant с проверкой активных run'ов.
+    assistant_id - ассистент маршрута (по умолчанию - ассистент бота).
+    """
+    try:
+        # Проверяем активные run'ы в thread
+        runs = openai_for('runs.list').beta.threads.runs.list(thread_id=thread_id, limit=5)
+
+        # Отменяем все активные run'ы
+        for run in runs.data:
+            if run.status in ['queued', 'in_progress', 'requires_action']:
+                logging.info(f"Cancelling active run {run.id} before new message")
+                try:
+                    cancel_run(thread_id, run.id)
+                    # Даем время на отмену
+                    await asyncio.sleep(1)
+                except Exception as e:
+                    logging.warning(f"Could not cancel run {run.id}: {e}")
+
+        # Добавляем сообщение пользователя в thread
+        openai_for('messages.create').beta.threads.messages.create(
+            thread_id=thread_id,
+            role="user",
+            content=user_message
+        )
+
+        # Запускаем ассистента
+        run = openai_for('runs.create').beta.threads.runs.create(
+            thread_id=thread_id,
+            assistant_id=assistant_id or current_tenant().assistant_id
+        )
+
+        return run
+
+    except openai.RateLimitError:
+        return {"error": "rate_limit", "message": "Сервис временно перегружен. Попробуйте через несколько минут."}
+    except openai.APIError as e:
+        logging.error(f"OpenAI API error: {e}")
+        return {"error": "api_error", "message": "Проблема с сервисом ИИ. Попробуйте позже или обратитесь к оператору."}
+    except Exception as e:
+        logging.error(f"Unexpected error: {e}")
+        return {"error": "unknown", "message": "Произошла ошибка при обработке вашего запроса. Пожалуйста, попробуйте еще раз."}
+
+def run_usage(run, polls):
+    """Расход run'а: токены (известны только у завершенного run'а) и число опросов статуса."""
+    usage = getattr(run, 'usage', None)
+    return {
+        'prompt_tokens': getattr(usage, 'prompt_tokens', 0) or 0,
+        'completion_tokens': getattr(usage, 'completion_tokens', 0) or 0,
+        'polls': polls
+    }
+
+def cancel_run_after_transfer(thread_id, run_id):
+    """Отменяет run, вызвавший transfer_to_manager, чтобы thread был свободен для новых сообщений."""
+    logging.info(f"Cancelling run {run_id} after transfer to manager")
+    if cancel_run(thread_id, run_id):
+        logging.info(f"Run {run_id} cancelled successfully")
+    else:
+        logging.error(f"Failed to cancel run {run_id}")
+
+class AssistantsBackend:
+    """
+    Assistants API: сообщение и run в thread пользователя, опрос статуса run'а
+    и чтение ответа из thread'а - четыре и больше запросов на ответ.
+    """
+
+    name = 'assistants'
+
+    async def respond(self, user_id, text, user_lang, assistant=None):
+        user_threads = current_tenant().user_threads
+
+        # Create new thread if doesn't exist for user
+        if user_id not in user_threads:
+            thread_id = create_thread_for_user(user_id, user_threads)
+        else:
+            thread_id = user_threads[user_id]
+
+        result = await safe_process_message(text, thread_id, user_lang, assistant)
+        if isinstance(result, dict) and "error" in result:
+            return TurnResult(ERROR, error=_REQUEST_ERRORS.get(result["error"], 'processing_error'))
+
+        # Wait for completion with timeout
+        timeout_counter = 0
+        poll_errors = 0
+        polls = 0
+        run_status = None
+
+        while True:
+            try:
+                polls += 1
+                run_status = get_run_status(thread_id, result.id)
+            except openai.APIError as e:
+                # SDK не повторяет опрос сам: повтором служит следующая итерация цикла
+                poll_errors += 1
+                logging.warning(f"Polling run {result.id} failed ({poll_errors}/{MAX_POLL_ERRORS}): {e}")
+                if poll_errors >= MAX_POLL_ERRORS:
+                    return TurnResult(ERROR, error='api_error', usage=run_usage(run_status, polls))
+                await asyncio.sleep(RUN_POLL_INTERVAL)
+                continue
+            poll_errors = 0
+
+            if run_status.status == 'completed':
+                break
+            elif run_status.status == 'requires_action':
+                # Assistant called transfer_to_manager function
+                tool_calls = run_status.required_action.submit_tool_outputs.tool_calls
+                for tool_call in tool_calls:
+                    if tool_call.function.name == "transfer_to_manager":
+                        run_id = result.id
+                        return TurnResult(
+                            TRANSFER,
+                            transfer_args=json.loads(tool_call.function.arguments),
+                            finish=lambda: cancel_run_after_transfer(thread_id, run_id),
+                            usage=run_usage(run_status, polls)
+                        )
+            elif run_status.status in ['failed', 'cancelled', 'expired']:
+                if run_status.status == 'cancelled':
+                    # Run was cancelled after transfer_to_manager, this is expected
+                    logging.info(f"Run {result.id} was cancelled as expected after transfer_to_manager")
+                    return TurnResult(REPLY, usage=run_usage(run_status, polls))
+                return TurnResult(ERROR, error='processing_error', usage=run_usage(run_status, polls))
+
+            timeout_counter += 1
+            if timeout_counter > MAX_POLL_ATTEMPTS:
+                return TurnResult(ERROR, error='timeout_error', usage=run_usage(run_status, polls))
+
+            # Не блокируем event loop: планировщик отправок должен работать во время ожидания
+            await asyncio.sleep(RUN_POLL_INTERVAL)
+
+        # Сворачиваем thread, если он вышел за бюджет контекста (после ответа, чтобы не задерживать его)
+        return TurnResult(
+            REPLY,
+            text=get_assistant_response(thread_id),
+            finish=lambda: maybe_rotate_thread(user_id, thread_id, user_threads, run_status),
+            usage=run_usage(run_status, polls)
+        )
+
+    def instructions(self, assistant):
+        """Инструкции ассистента (синхронный запрос к OpenAI)."""
+        return openai_for('assistants.retrieve').beta.assistants.retrieve(assistant).instructions or ""
+
+    def conversation_id(self, user_id):
+        return current_tenant().user_threads.get(user_id)
+
+    def conversation_history(self, user_id):
+        thread_id = self.conversation_id(user_id)
+        return get_conversation_history(thread_id) if thread_id else None
+
+    def previous_summary(self, user_id):
+        thread_id = self.conversation_id(user_id)
+        return get_previous_conversation_summary(thread_id) if thread_id else None
+
+    def reset(self, user_id):
+        user_threads = current_tenant().user_threads
+        if user_id not in user_threads:
+            return False
+        del user_threads[user_id]
+        save_threads(user_threads)
+        return True
+
+_WORD_RE = re.compile(r'\w+')
+
+def _terms(text):
+    """Грубые основы слов: первые 5 букв слов от 3 букв (хватает для русских окончаний)."""
+    return {word[:5] for word in _WORD_RE.findall(text.lower()) if len(word) >= 3 and not word.isdigit()}
+
+class FaqIndex:
+    """
+    Фрагменты FAQ (абзацы файлов *.txt) и их выбор под вопрос клиента по совпадению
+    основ слов с весом IDF. Индекс строится один раз при первом обращении.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.sections = []
+        self._terms = []
+        self._idf = {}
+
+        for path in sorted(glob.glob(os.path.join(directory, '**', '*.txt'), recursive=True)):
+            with open(path, 'r', encoding='utf-8') as f:
+                blocks = re.split(r'\n\s*\n', f.read())
+            self.sections.extend(block.strip() for block in blocks if block.strip())
+
+        self._terms = [_terms(section) for section in self.sections]
+        document_frequency = Counter(term for terms in self._terms for term in terms)
+        self._idf = {term: math.log(len(self.sections) / count) + 1.0 for term, count in document_frequency.items()}
+        logging.info(f"FAQ index {directory}: {len(self.sections)} sections")
+
+    def select(self, question, max_chars=CHAT_FAQ_MAX_CHARS):
+        """Самые подходящие вопросу фрагменты общей длиной не больше max_chars."""
+        if sum(len(section) for section in self.sections) <= max_chars:
+            return list(self.sections)
+
+        question_terms = _terms(question)
+        scored = sorted(
+            ((sum(self._idf[term] for term in terms & question_terms), index)
+             for index, terms in enumerate(self._terms)),
+            reverse=True
+        )
+
+        selected = []
+        size = 0
+        for score, index in scored:
+            if score <= 0:
+                break
+            section = self.sections[index]
+            if size + len(section) > max_chars:
+                continue
+            selected.append(section)
+            size += len(section)
+        return selected
+
+DEFAULT_SYSTEM_PROMPT = (
+    "Ты - вежливый помощник полиграфической компании Web2Print в Ташкенте. Отвечай кратко и по делу "
+    "на вопросы об услугах, ценах, сроках, материалах и требованиях к макетам, опираясь на фрагменты "
+    "FAQ ниже. Не придумывай цены и условия, которых нет в FAQ. Если клиент просит менеджера, готов "
+    "оформить заказ или вопрос требует индивидуального расчета, вызови функцию transfer_to_manager."
+)
+
+class ChatBackend:
+    """
+    Chat completions: один потоковый запрос на ход. История разговора хранится локально
+    (последние CHAT_HISTORY_MESSAGES сообщений), подходящие фрагменты FAQ подставляются
+    в системный промпт, передача менеджеру - та же функция transfer_to_manager.
+    """
+
+    name = 'chat'
+
+    def __init__(self):
+        self._faq_indexes = {}
+        self._default_prompt = None
+        self._route_prompts = {}
+
+    def _faq(self, directory):
+        index = self._faq_indexes.get(directory)
+        if index is None:
+            index = self._faq_indexes[directory] = FaqIndex(directory)
+        return index
+
+    def _base_prompt(self, tenant, prompt_path=None):
+        # Промпт маршрута (assistant_routing.py) - файл, читается один раз
+        if prompt_path:
+            prompt = self._route_prompts.get(prompt_path)
+            if prompt is None:
+                with open(prompt_path, 'r', encoding='utf-8') as f:
+                    prompt = self._route_prompts[prompt_path] = f.read().strip()
+            return prompt
+        if tenant.system_prompt:
+            return tenant.system_prompt
+        if self._default_prompt is None:
+            if CHAT_SYSTEM_PROMPT_PATH:
+                with open(CHAT_SYSTEM_PROMPT_PATH, 'r', encoding='utf-8') as f:
+                    self._default_prompt = f.read().strip()
+            else:
+                self._default_prompt = DEFAULT_SYSTEM_PROMPT
+        return self._default_prompt
+
+    def system_prompt(self, question, user_lang, assistant=None):
+        tenant = current_tenant()
+        parts = [
+            self._base_prompt(tenant, assistant),
+            f"Язык ответа: {SUPPORTED_LANGUAGES.get(user_lang, user_lang)}, если клиент не пишет на другом языке.",
+            "Телефоны компании: " + ", ".join(tenant.phones)
+        ]
+        sections = self._faq(tenant.faq_dir).select(question)
+        if sections:
+            parts.append("FAQ:\n\n" + "\n\n".join(sections))
+        return "\n\n".join(parts)
+
+    async def respond(self, user_id, text, user_lang, assistant=None):
+        conversations = current_tenant().conversations
+        history = conversations.get(user_id, [])
+        messages = [{"role": "system", "content": self.system_prompt(text, user_lang, assistant)}]
+        messages.extend(history)
+        messages.append({"role": "user", "content": text})
+
+        try:
+            # Синхронный потоковый запрос - в отдельном потоке, event loop не блокируется
+            completion = await asyncio.to_thread(stream_chat_completion, messages)
+        except openai.RateLimitError:
+            return TurnResult(ERROR, error='rate_limit_error')
+        except openai.APIError as e:
+            logging.error(f"OpenAI API error: {e}")
+            return TurnResult(ERROR, error='api_error')
+        except Exception as e:
+            logging.error(f"Unexpected error: {e}")
+            return TurnResult(ERROR, error='processing_error')
+
+        usage = {
+            'prompt_tokens': completion['prompt_tokens'] or 0,
+            'completion_tokens': completion.get('completion_tokens') or 0
+        }
+        history = history + [{"role": "user", "content": text}]
+        transfer = next((call for call in completion['tool_calls'] if call['name'] == 'transfer_to_manager'), None)
+        if transfer is not None:
+            try:
+                transfer_args = json.loads(transfer['arguments'] or '{}')
+            except json.JSONDecodeError:
+                logging.warning(f"Malformed transfer_to_manager arguments: {transfer['arguments'][:200]}")
+                transfer_args = {}
+            # Модель должна помнить, что разговор уже передан менеджеру
+            history.append({"role": "assistant", "content": f"[Передано менеджеру: {transfer_args.get('summary', '')}]"})
+            result = TurnResult(TRANSFER, transfer_args=transfer_args, usage=usage)
+        else:
+            history.append({"role": "assistant", "content": completion['text'] or ""})
+            result = TurnResult(REPLY, text=completion['text'], usage=usage)
+
+        conversations[user_id] = history[-CHAT_HISTORY_MESSAGES:]
+        save_conversations(conversations)
+        return result
+
+    def instructions(self, assistant):
+        """Системный промпт маршрута без FAQ и служебных строк."""
+        return self._base_prompt(current_tenant(), assistant)
+
+    def conversation_id(self, user_id):
+        return f"local-{user_id}" if user_id in current_tenant().conversations else None
+
+    def conversation_history(self, user_id):
+        history = current_tenant().conversations.get(user_id)
+        if not history:
+            return None
+        return "\n".join(format_history_message(message['role'], message['content']) for message in history)
+
+    def previous_summary(self, user_id):
+        return None
+
+    def reset(self, user_id):
+        conversations = current_tenant().conversations
+        if user_id not in conversations:
+            return False
+        del conversations[user_id]
+        save_conversations(conversations)
+        return True
+
+_BACKENDS = {backend.name: backend for backend in (AssistantsBackend(), ChatBackend())}
+
+def get_backend():
+    """Бэкенд текущего бота (ASSISTANT_BACKEND или "backend" в настройках бота)."""
+    return _BACKENDS[current_tenant().backend]
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""
+Выбор ассистента по языку клиента и быстрому действию вместо одного ассистента на все
+языки, и размер промпта каждого ассистента по фактическим prompt_tokens его ходов.
+"""
+
+import logging
+import os
+from collections import Counter, deque
+
+from config import SUPPORTED_LANGUAGES
+from circuit_breaker import percentile
+
+# Быстрые действия, которые отправляются ассистенту (callback_data "quick_<действие>")
+INTENTS = ('services', 'manager')
+
+def route_keys(lang, intent=None):
+    """Ключи маршрутов от самого точного: "язык/действие", "действие", "язык"."""
+    keys = [f"{lang}/{intent}", intent] if intent else []
+    keys.append(lang)
+    return keys
+
+def invalid_route_keys(routes):
+    """Ключи маршрутов с неизвестным языком или действием."""
+    invalid = []
+    for key in routes:
+        if '/' in key:
+            lang, _, intent = key.partition('/')
+            valid = lang in SUPPORTED_LANGUAGES and intent in INTENTS
+        else:
+            valid = key in SUPPORTED_LANGUAGES or key in INTENTS
+        if not valid:
+            invalid.append(key)
+    return invalid
+
+def missing_route_files(routes):
+    """Маршруты бэкенда chat, файла системного промпта которых нет: ["ключ=путь"]."""
+    return [f"{key}={path}" for key, path in routes.items() if not os.path.isfile(path)]
+
+class AssistantRouter:
+    """
+    Маршруты одного бота: {"uz": "asst_...", "services": "asst_...", "ru/manager": "asst_..."}.
+    Ход идет к ассистенту самого точного подходящего маршрута, а если маршрута нет -
+    к default (ASSISTANT_ID бота). Для бэкенда chat значения маршрутов - файлы системных
+    промптов, default - общий промпт (None).
+
+    Для каждого ассистента запоминаются prompt_tokens последних window ходов: минимум
+    близок к постоянной части (инструкции и функции), медиана и p95 - к цене обычного хода.
+    """
+
+    def __init__(self, default, routes=None, window=500):
+        self.default = default
+        self.routes = dict(routes or {})
+        self.window = window
+        self.turns = Counter()
+        self._prompt_tokens = {}
+
+        invalid = invalid_route_keys(self.routes)
+        if invalid:
+            logging.warning(f"Unknown assistant routes ignored: {', '.join(invalid)} "
+                            f"(languages: {', '.join(SUPPORTED_LANGUAGES)}, intents: {', '.join(INTENTS)})")
+            for key in invalid:
+                del self.routes[key]
+
+    def route(self, lang, intent=None):
+        """Ассистент для хода на языке lang (и быстрого действия intent)."""
+        for key in route_keys(lang, intent):
+            if key in self.routes:
+                return self.routes[key]
+        return self.default
+
+    def assistants(self):
+        """Все ассистенты бота: {ассистент: ключи его маршрутов ("*" - по умолчанию)}."""
+        assistants = {self.default: ['*']}
+        for key, assistant in self.routes.items():
+            assistants.setdefault(assistant, []).append(key)
+        return assistants
+
+    def record(self, assistant, usage):
+        """Учитывает prompt_tokens хода ассистента (usage из TurnResult; ходы без расхода не учитываются)."""
+        tokens = usage.get('prompt_tokens')
+        if not tokens:
+            return
+        self.turns[assistant] += 1
+        samples = self._prompt_tokens.get(assistant)
+        if samples is None:
+            samples = self._prompt_tokens[assistant] = deque(maxlen=self.window)
+        samples.append(tokens)
+
+    def report(self):
+        """Размер промпта по ассистентам: [{assistant, routes, turns, prompt_min, prompt_p50, prompt_p95}]."""
+        rows = []
+        for assistant, keys in self.assistants().items():
+            samples = list(self._prompt_tokens.get(assistant, ()))
+            rows.append({
+                'assistant': assistant,
+                'routes': keys,
+                'turns': self.turns[assistant],
+                'prompt_min': min(samples) if samples else None,
+                'prompt_p50': percentile(samples, 0.5),
+                'prompt_p95': percentile(samples, 0.95)
+            })
+        return rows
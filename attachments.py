@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+"""
+Файлы клиентов (макеты, фото): потоковая загрузка из Telegram на диск частями,
+проверка размера и типа содержимого, загрузка на Диск Битрикс24 и ссылки на файлы
+для передачи менеджеру.
+"""
+
+import asyncio
+import hashlib
+import logging
+import os
+import re
+import time
+from datetime import datetime
+
+import httpx
+from telegram.error import TelegramError
+
+from config import (ATTACHMENTS_DIR, ATTACHMENT_MAX_MB, ATTACHMENT_CHUNK_SIZE, ATTACHMENT_CONCURRENCY,
+                    ATTACHMENT_TIMEOUT, ATTACHMENT_PENDING_TTL, ATTACHMENT_RETENTION_DAYS, ATTACHMENT_SWEEP_INTERVAL)
+from tenants import current_tenant
+from bitrix_integration import upload_to_bitrix_disk
+from traffic_capture import traced, summarize_attachment
+
+# Сигнатуры допустимых типов: (тип, смещение, первые байты). Заявленному клиентом
+# mime_type и расширению не доверяем - тип определяется по содержимому
+SIGNATURES = [
+    ('pdf', 0, b'%PDF'),
+    ('jpeg', 0, b'\xff\xd8\xff'),
+    ('png', 0, b'\x89PNG\r\n\x1a\n'),
+    ('tiff', 0, b'II*\x00'),
+    ('tiff', 0, b'MM\x00*'),
+    ('webp', 8, b'WEBP'),
+    ('heic', 4, b'ftyphei'),
+    ('heic', 4, b'ftypmif1'),
+    ('psd', 0, b'8BPS'),
+    ('eps', 0, b'%!PS'),
+    ('eps', 0, b'\xc5\xd0\xd3\xc6'),
+    ('cdr', 8, b'CDR'),
+    # Архивы, CorelDRAW X4+ и документы Office
+    ('zip', 0, b'PK\x03\x04'),
+    ('office', 0, b'\xd0\xcf\x11\xe0'),
+]
+
+_UNSAFE_NAME_RE = re.compile(r'[^\w.-]+')
+
+def detect_type(head):
+    """Тип файла по первым байтам или None, если тип не из допустимых."""
+    for kind, offset, signature in SIGNATURES:
+        if head[offset:offset + len(signature)] == signature:
+            return kind
+    return None
+
+def describe_attachment(message):
+    """(file_id, имя, размер по данным Telegram) документа или самого крупного фото; None - файла нет."""
+    if message.document is not None:
+        document = message.document
+        return document.file_id, document.file_name or f"document_{document.file_unique_id}", document.file_size
+    if message.photo:
+        # Telegram присылает фото в нескольких размерах, последний - оригинальный
+        photo = message.photo[-1]
+        return photo.file_id, f"photo_{photo.file_unique_id}.jpg", photo.file_size
+    return None
+
+class AttachmentError(Exception):
+    """Файл не принят; reason - ключ текста для клиента (file_too_large, file_type_rejected, file_error)."""
+
+    def __init__(self, reason, detail=None):
+        super().__init__(detail or reason)
+        self.reason = reason
+
+class AttachmentPipeline:
+    """
+    Загружает файлы клиентов в data_dir бота (attachments/<user_id>/), оттуда - на Диск
+    Битрикс24 (ссылку на файл видит менеджер) и держит описания файлов до передачи менеджеру.
+
+    Файл читается из Telegram частями по chunk_size и сразу пишется на диск, поэтому память
+    не зависит от размера файлов; на Диск файл тоже уходит частями, прямо с диска.
+    Одновременно загружается (из Telegram и в Битрикс24) не больше concurrency файлов
+    со всех ботов процесса. Загрузки идут фоновыми задачами (submit): обработчик обновления
+    их не ждет, а передача менеджеру ждет файлы клиента в collect().
+
+    Периодическая очистка (start): файлы клиента, так и не переданные менеджеру за pending_ttl
+    секунд, забываются, а файлы старше retention_days дней удаляются с диска.
+    """
+
+    def __init__(self, max_bytes=ATTACHMENT_MAX_MB * 1024 * 1024, chunk_size=ATTACHMENT_CHUNK_SIZE,
+                 concurrency=ATTACHMENT_CONCURRENCY, timeout=ATTACHMENT_TIMEOUT,
+                 pending_ttl=ATTACHMENT_PENDING_TTL, retention_days=ATTACHMENT_RETENTION_DAYS,
+                 sweep_interval=ATTACHMENT_SWEEP_INTERVAL):
+        self.max_bytes = max_bytes
+        self.chunk_size = chunk_size
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.pending_ttl = pending_ttl
+        self.retention_days = retention_days
+        self.sweep_interval = sweep_interval
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._client = None
+        # (бот, пользователь) -> задачи загрузки, результаты которых еще не переданы менеджеру,
+        # и время последнего файла клиента
+        self._pending = {}
+        self._submitted = {}
+        # Директории файлов ботов, которые чистит периодическая очистка
+        self._roots = set()
+        self._sweeper = None
+
+    def _http(self):
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                timeout=httpx.Timeout(self.timeout),
+                limits=httpx.Limits(max_connections=self.concurrency)
+            )
+        return self._client
+
+    @staticmethod
+    def root(tenant):
+        """Директория файлов клиентов бота."""
+        return tenant.path(os.path.basename(ATTACHMENTS_DIR))
+
+    def check_size(self, size):
+        """Отклоняет файл больше лимита до загрузки (размер известен из сообщения)."""
+        if size is not None and size > self.max_bytes:
+            raise AttachmentError('file_too_large', f"{size} bytes")
+
+    @traced('telegram.download_file', summarize_attachment)
+    async def fetch(self, bot, user_id, file_id, name):
+        """Загружает файл на диск и на Диск Битрикс24; описание файла для менеджера или AttachmentError."""
+        async with self._semaphore:
+            try:
+                telegram_file = await bot.get_file(file_id)
+                self.check_size(telegram_file.file_size)
+
+                directory = os.path.join(self.root(current_tenant()), str(user_id))
+                os.makedirs(directory, exist_ok=True)
+                safe_name = _UNSAFE_NAME_RE.sub('_', name)[-100:]
+                path = os.path.join(directory, f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{safe_name}")
+                kind, size, sha256 = await asyncio.wait_for(self._download(telegram_file.file_path, path), self.timeout)
+            except httpx.HTTPStatusError as e:
+                # Текст ошибки содержит URL файла, а в нем токен бота - в лог только статус
+                raise AttachmentError('file_error', f"HTTP {e.response.status_code}") from None
+            except (TelegramError, httpx.HTTPError, OSError, asyncio.TimeoutError) as e:
+                raise AttachmentError('file_error', type(e).__name__) from None
+
+            logging.info(f"Attachment from user {user_id} saved: {path} ({kind}, {size} bytes)")
+            # Без ссылки (Диск не настроен или недоступен) менеджер видит файл по пути на сервере бота
+            url = await upload_to_bitrix_disk(self._http(), path, os.path.basename(path))
+
+        return {'name': name, 'type': kind, 'size': size, 'sha256': sha256, 'path': path, 'url': url}
+
+    async def _download(self, url, path):
+        """Пишет файл на диск частями, проверяя тип по первой части и размер по мере загрузки."""
+        kind = None
+        size = 0
+        digest = hashlib.sha256()
+        partial_path = path + '.part'
+        try:
+            with open(partial_path, 'wb') as f:
+                async with self._http().stream('GET', url) as response:
+                    response.raise_for_status()
+                    async for chunk in response.aiter_bytes(self.chunk_size):
+                        if kind is None:
+                            kind = detect_type(chunk)
+                            if kind is None:
+                                raise AttachmentError('file_type_rejected', f"signature {chunk[:16]!r}")
+                        size += len(chunk)
+                        # Telegram не всегда сообщает размер заранее
+                        if size > self.max_bytes:
+                            raise AttachmentError('file_too_large', f"more than {self.max_bytes} bytes")
+                        digest.update(chunk)
+                        f.write(chunk)
+            if kind is None:
+                raise AttachmentError('file_type_rejected', "empty file")
+            os.replace(partial_path, path)
+        except BaseException:
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+            raise
+        return kind, size, digest.hexdigest()
+
+    def submit(self, user_id, download):
+        """Запускает загрузку (корутину, возвращающую описание файла или None) фоновой задачей."""
+        task = asyncio.create_task(download)
+        key = (current_tenant().name, user_id)
+        self._pending.setdefault(key, []).append(task)
+        self._submitted[key] = time.monotonic()
+        return task
+
+    async def collect(self, user_id):
+        """
+        Файлы клиента для передачи менеджеру: ждет незавершенные загрузки (не дольше timeout)
+        и забирает описания загруженных файлов. Не успевшие загрузки остаются до следующей передачи.
+        """
+        key = (current_tenant().name, user_id)
+        tasks = self._pending.pop(key, [])
+        if not tasks:
+            return []
+        self._submitted.pop(key, None)
+        done, pending = await asyncio.wait(tasks, timeout=self.timeout)
+        if pending:
+            self._pending.setdefault(key, []).extend(pending)
+            self._submitted[key] = time.monotonic()
+        return [task.result() for task in tasks
+                if task in done and not task.cancelled() and task.exception() is None and task.result()]
+
+    def discard(self, user_id):
+        """Забывает файлы клиента (сброс разговора); файлы на диске остаются."""
+        key = (current_tenant().name, user_id)
+        self._submitted.pop(key, None)
+        for task in self._pending.pop(key, []):
+            task.cancel()
+
+    def start(self, tenant):
+        """Включает периодическую очистку файлов бота tenant (из post_init его приложения)."""
+        self._roots.add(self.root(tenant))
+        if self._sweeper is None and self.sweep_interval:
+            self._sweeper = asyncio.create_task(self._sweep_periodically())
+
+    async def _sweep_periodically(self):
+        while True:
+            try:
+                self.prune_pending()
+                # Обход директорий - в отдельном потоке, event loop не блокируется
+                await asyncio.to_thread(self.remove_expired_files)
+            except Exception as e:
+                logging.error(f"Attachment sweep failed: {e}")
+            await asyncio.sleep(self.sweep_interval)
+
+    def prune_pending(self, now=None):
+        """Забывает файлы клиентов, которые не передавались менеджеру дольше pending_ttl."""
+        now = time.monotonic() if now is None else now
+        expired = [key for key, submitted in self._submitted.items() if now - submitted > self.pending_ttl]
+        for key in expired:
+            del self._submitted[key]
+            for task in self._pending.pop(key, []):
+                task.cancel()
+        if expired:
+            logging.info(f"Forgot pending attachments of {len(expired)} users")
+        return len(expired)
+
+    def remove_expired_files(self, now=None):
+        """Удаляет файлы старше retention_days (и опустевшие директории пользователей); число удаленных."""
+        if not self.retention_days:
+            return 0
+        cutoff = (time.time() if now is None else now) - self.retention_days * 86400
+        removed = 0
+        for root in list(self._roots):
+            if not os.path.isdir(root):
+                continue
+            for user_dir in os.scandir(root):
+                if not user_dir.is_dir():
+                    continue
+                for entry in os.scandir(user_dir.path):
+                    # Незавершенные загрузки (.part) удаляет сама загрузка
+                    if entry.is_file() and not entry.name.endswith('.part') and entry.stat().st_mtime < cutoff:
+                        os.remove(entry.path)
+                        removed += 1
+                try:
+                    os.rmdir(user_dir.path)
+                except OSError:
+                    pass
+        if removed:
+            logging.info(f"Removed {removed} attachments older than {self.retention_days} days")
+        return removed
+
+    async def close(self):
+        """Останавливает очистку, отменяет незавершенные загрузки и закрывает HTTP клиент."""
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            await asyncio.gather(self._sweeper, return_exceptions=True)
+            self._sweeper = None
+        tasks = [task for tasks in self._pending.values() for task in tasks if not task.done()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._pending.clear()
+        self._submitted.clear()
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
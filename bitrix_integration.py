@@ -1,14 +1,65 @@
 # -*- coding: utf-8 -*-
+import asyncio
+import httpx
 import requests
 import json
 import logging
-from config import COMPANY_PHONES
+from urllib.parse import urlencode
+from config import COMPANY_PHONES, BITRIX_WEBHOOK_URL, BITRIX_TIMEOUT, BITRIX_DISK_FOLDER_ID
+from traffic_capture import traced
 
-async def send_to_bitrix(user_data, formatted_message, thread_id):
-    """Отправляет расширенный запрос в Битрикс24 через webhook."""
-    # TODO: Добавить реальный URL webhook и настройки
-    # BITRIX_WEBHOOK_URL = "https://your-bitrix.bitrix24.ru/rest/webhook/..."
-    
+class BitrixError(Exception):
+    """Ошибка, которую вернул REST API Битрикс24."""
+
+def call_bitrix(method, params):
+    """Вызывает метод REST API Битрикс24 через входящий webhook (BITRIX_WEBHOOK_URL) и возвращает result."""
+    response = requests.post(f"{BITRIX_WEBHOOK_URL.rstrip('/')}/{method}.json", json=params, timeout=BITRIX_TIMEOUT)
+    try:
+        data = response.json()
+    except ValueError:
+        raise BitrixError(f"{method}: HTTP {response.status_code} - {response.text[:200]}")
+    if response.status_code != 200 or 'error' in data:
+        raise BitrixError(f"{method}: {data.get('error')} - {data.get('error_description', '')}")
+    return data['result']
+
+def bitrix_query(params, prefix=None):
+    """Параметры метода строкой запроса для batch: вложенные поля - fields[PHONE][0][VALUE]."""
+    pairs = []
+    items = params.items() if isinstance(params, dict) else enumerate(params)
+    for key, value in items:
+        name = f"{prefix}[{key}]" if prefix else str(key)
+        if isinstance(value, (dict, list)):
+            pairs.append(bitrix_query(value, name))
+        else:
+            pairs.append(urlencode({name: value}))
+    return "&".join(pair for pair in pairs if pair)
+
+def call_bitrix_batch(commands, halt=True):
+    """
+    Несколько методов одним запросом batch: commands - {имя: (метод, параметры)}.
+    При halt выполнение останавливается на первой ошибке; любая ошибка - BitrixError.
+    """
+    result = call_bitrix("batch", {
+        "halt": 1 if halt else 0,
+        "cmd": {name: f"{method}?{bitrix_query(params)}" for name, (method, params) in commands.items()}
+    })
+    errors = result.get("result_error") or {}
+    if errors:
+        raise BitrixError(f"batch: {json.dumps(errors, ensure_ascii=False)[:200]}")
+    missing = [name for name in commands if name not in (result.get("result") or {})]
+    if missing:
+        raise BitrixError(f"batch: not executed {', '.join(missing)}")
+    return result["result"]
+
+def phone_field(phone):
+    return [{"VALUE": phone, "VALUE_TYPE": "MOBILE"}]
+
+@traced('bitrix.send')
+async def send_to_bitrix(user_data, formatted_message, thread_id, attachments=None):
+    """
+    Создает лид в Битрикс24 с расширенным запросом (attachments - файлы клиента).
+    Возвращает ID лида; None без BITRIX_WEBHOOK_URL (запрос только пишется в лог) или при ошибке.
+    """
     payload = {
         "user_id": user_data.get("id"),
         "username": user_data.get("username"),
@@ -16,6 +67,12 @@ async def send_to_bitrix(user_data, formatted_message, thread_id):
         "language": user_data.get("language"),
         "formatted_message": formatted_message,
         "thread_id": thread_id,
+        # Файлы загружены на Диск Битрикс24 заранее (upload_to_bitrix_disk): в запросе только ссылки,
+        # они же - в тексте лида
+        "files": [
+            {key: attachment.get(key) for key in ("name", "type", "size", "sha256", "url")}
+            for attachment in attachments or []
+        ],
         "source": "telegram_bot"
     }
     
@@ -25,24 +82,85 @@ async def send_to_bitrix(user_data, formatted_message, thread_id):
     logging.info(f"Language: {user_data.get('language', 'ru')}")
     logging.info(f"Thread ID: {thread_id}")
     logging.info(f"Message length: {len(formatted_message)} characters")
+    logging.info(f"Files: {len(payload['files'])}")
     logging.info("─" * 50)
     logging.info(formatted_message)
     logging.info("─" * 50)
     
-    # TODO: Раскомментировать когда будет webhook URL
-    # try:
-    #     response = requests.post(BITRIX_WEBHOOK_URL, json=payload, timeout=10)
-    #     if response.status_code == 200:
-    #         logging.info(f"Successfully sent enhanced data to Bitrix24: {response.json()}")
-    #         return True
-    #     else:
-    #         logging.error(f"Bitrix24 error: {response.status_code} - {response.text}")
-    #         return False
-    # except Exception as e:
-    #     logging.error(f"Error sending to Bitrix24: {e}")
-    #     return False
+    if not BITRIX_WEBHOOK_URL:
+        return None
+    
+    fields = {
+        "TITLE": f"Telegram: {payload['first_name'] or payload['username'] or payload['user_id']}",
+        "NAME": payload["first_name"],
+        "SOURCE_DESCRIPTION": f"{payload['source']}, user {payload['user_id']}, thread {thread_id}",
+        "COMMENTS": formatted_message
+    }
+    if user_data.get("phone"):
+        fields["PHONE"] = phone_field(user_data["phone"])
+    
+    try:
+        # requests синхронный - в отдельном потоке, event loop не блокируется
+        lead_id = await asyncio.to_thread(call_bitrix, "crm.lead.add", {"fields": fields})
+        logging.info(f"Bitrix24 lead {lead_id} created for user {payload['user_id']}")
+        return lead_id
+    except (requests.RequestException, BitrixError) as e:
+        logging.error(f"Error sending to Bitrix24: {e}")
+        return None
+
+@traced('bitrix.upload')
+async def upload_to_bitrix_disk(client, path, name):
+    """
+    Загружает файл клиента в папку BITRIX_DISK_FOLDER_ID Диска Битрикс24 (client - httpx.AsyncClient):
+    файл читается с диска и отправляется частями, в память целиком не попадает.
+    Возвращает ссылку на файл в Битрикс24; None, если Диск не настроен или загрузка не удалась.
+    """
+    if not BITRIX_WEBHOOK_URL or not BITRIX_DISK_FOLDER_ID:
+        return None
+    
+    try:
+        # Первый вызов без содержимого возвращает адрес для загрузки файла multipart-запросом
+        target = await asyncio.to_thread(call_bitrix, "disk.folder.uploadfile", {"id": BITRIX_DISK_FOLDER_ID})
+        with open(path, 'rb') as f:
+            response = await client.post(target["uploadUrl"], files={target["field"]: (name, f)})
+        data = response.json()
+        if response.status_code != 200 or 'error' in data:
+            raise BitrixError(f"disk upload: HTTP {response.status_code} {data.get('error')}")
+        url = data['result']['DETAIL_URL']
+    except (requests.RequestException, httpx.HTTPError, BitrixError, OSError, ValueError, KeyError) as e:
+        # Адрес загрузки содержит ключ доступа - в лог только ответ Битрикс24 или тип ошибки
+        detail = e if isinstance(e, BitrixError) else type(e).__name__
+        logging.error(f"Error uploading {name} to Bitrix24 disk: {detail}")
+        return None
+    logging.info(f"Attachment {name} uploaded to Bitrix24 disk: {url}")
+    return url
+
+@traced('bitrix.update')
+async def update_bitrix_lead(lead_id, user_data, comment):
+    """
+    Дополняет существующий лид вместо создания нового: телефон клиента (если он есть
+    в user_data) и комментарий в ленте лида. True - лид обновлен.
+    """
+    logging.info(f"Bitrix24 lead {lead_id} update for user {user_data.get('id')}: {comment[:200]}")
+    if not BITRIX_WEBHOOK_URL:
+        return True
     
-    return True  # Пока возвращаем True для тестирования
+    # Телефон и комментарий - одним запросом batch; при ошибке обновления комментарий не добавляется
+    commands = {}
+    if user_data.get("phone"):
+        commands["update"] = ("crm.lead.update", {
+            "id": lead_id,
+            "fields": {"PHONE": phone_field(user_data["phone"])}
+        })
+    commands["comment"] = ("crm.timeline.comment.add", {
+        "fields": {"ENTITY_ID": lead_id, "ENTITY_TYPE": "lead", "COMMENT": comment}
+    })
+    try:
+        await asyncio.to_thread(call_bitrix_batch, commands)
+        return True
+    except (requests.RequestException, BitrixError) as e:
+        logging.error(f"Error updating Bitrix24 lead {lead_id}: {e}")
+        return False
 
 def format_transfer_message():
     """Форматирует сообщение о передаче запроса менеджеру."""
@@ -1,18 +1,31 @@
 # -*- coding: utf-8 -*-
+import asyncio
 import logging
+import re
+import signal
 import time
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, KeyboardButton, ReplyKeyboardMarkup, ReplyKeyboardRemove
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes, CallbackQueryHandler
+from telegram.ext import Application, CommandHandler, MessageHandler, TypeHandler, filters, ContextTypes, CallbackQueryHandler
 
 # Import our modules
-from config import TELEGRAM_TOKEN, validate_environment, OPENAI_API_KEY, ASSISTANT_ID
-from utils import log_user_action, load_threads, save_user_language, get_user_language
-from openai_client import create_thread_for_user, get_run_status, get_assistant_response, submit_tool_outputs, cancel_run, format_conversation_for_manager
-from bitrix_integration import send_to_bitrix, format_transfer_message
-
-# OpenAI client import
-from openai import OpenAI
-import openai
+from config import TELEGRAM_TOKEN, validate_environment, TRAFFIC_CAPTURE_DIR
+from config import ADMIN_IDS, PROFILE_DEFAULT_SECONDS, PROFILE_MAX_SECONDS, PROFILE_DIR, ATTACHMENT_MAX_MB
+from config import USAGE_RETENTION_DAYS
+from utils import log_user_action, save_user_language, get_user_language
+from openai_client import format_conversation_for_manager
+from assistant_backends import get_backend, TurnResult, TRANSFER, ERROR
+from bitrix_integration import format_transfer_message
+from crm_identity import HandoffDispatcher
+from send_scheduler import SendScheduler
+from circuit_breaker import CircuitBreaker
+from traffic_capture import TrafficRecorder
+from profiler import SamplingProfiler
+from loop_watchdog import LoopWatchdog
+from idempotency import UpdateDeduplicator
+from usage_ledger import RATE_LIMITED
+from attachments import AttachmentPipeline, AttachmentError, describe_attachment
+from similarity_index import load_index
+from tenants import default_tenant, current_tenant, use_tenant
 
 # Logging setup
 logging.basicConfig(
@@ -20,11 +33,37 @@ logging.basicConfig(
     level=logging.INFO
 )
 
-# OpenAI client initialization
-client = OpenAI(api_key=OPENAI_API_KEY)
+# Все исходящие сообщения и индикаторы набора идут через общий планировщик
+outbound = SendScheduler()
+
+# Профилировщик по запросу администратора (/profile) или сигналу SIGUSR1
+profiler = SamplingProfiler()
+
+# Сторож event loop: блокировки loop'а синхронным кодом - в лог со стеком и в метрики
+watchdog = LoopWatchdog()
+
+# Файлы клиентов загружаются фоном частями, с общим на процесс лимитом одновременных загрузок
+attachments = AttachmentPipeline()
+
+# Передачи менеджеру в CRM: сразу создают лид или дополняют открытый лид клиента
+handoffs = HandoffDispatcher()
 
-# Load saved thread_id on startup
-user_threads = load_threads()
+# Размыкается при деградации OpenAI: новые запросы сразу получают ответ без ассистента
+assistant_breaker = CircuitBreaker()
+
+# Служебные обработчики выполняются до основных (группа 0) в порядке своих групп,
+# DONE_GROUP - после основных
+TENANT_GROUP = -3
+CAPTURE_GROUP = -2
+DEDUP_GROUP = -1
+DONE_GROUP = 1
+
+# Кнопка "Пропустить" под просьбой поделиться контактом
+SKIP_TEXTS = {
+    'ru': "⏭️ Пропустить",
+    'uz': "⏭️ O'tkazib yuborish",
+    'en': "⏭️ Skip"
+}
 
 # Multilingual texts
 TEXTS = {
@@ -44,6 +83,13 @@ TEXTS = {
         'timeout_error': '⏰ Извините, запрос выполняется слишком долго. Попробуйте позже.',
         'rate_limit_error': '🚫 Сервис временно перегружен. Попробуйте через несколько минут.',
         'api_error': '🔧 Проблема с сервисом ИИ. Попробуйте позже или обратитесь к оператору.',
+        'degraded_mode': "⚠️ ИИ-помощник сейчас недоступен, поэтому отвечаем сразу.\n\n📞 Позвоните нам:\n{phones}\n\n👨‍💼 Или нажмите кнопку ниже - передадим ваш вопрос менеджеру.",
+        'file_received': '📎 Файл «{name}» получен. Менеджер увидит его вместе с вашим запросом.',
+        'file_too_large': '📦 Файл слишком большой: можно отправить файл до {max_mb} МБ. Большие макеты лучше передать менеджеру ссылкой.',
+        'file_type_rejected': '🚫 Этот тип файла не принимается. Отправьте макет в PDF, JPG, PNG, TIFF, PSD, EPS, CDR или архивом ZIP.',
+        'file_error': '❌ Не удалось получить файл. Попробуйте отправить его еще раз.',
+        'usage_rate_limited': "⏳ Вы отправляете сообщения слишком часто, ИИ-помощник ответит чуть позже.\n\n👨‍💼 Или нажмите кнопку ниже - передадим ваш вопрос менеджеру.",
+        'usage_quota_exceeded': "📊 На сегодня лимит вопросов ИИ-помощнику исчерпан.\n\n📞 Позвоните нам:\n{phones}\n\n👨‍💼 Или нажмите кнопку ниже - передадим ваш вопрос менеджеру.",
         
         # Кнопки быстрых действий
         'quick_services': '📋 Наши услуги',
@@ -68,6 +114,13 @@ TEXTS = {
         'timeout_error': '⏰ Kechirasiz, so\'rov juda uzoq davom etmoqda. Keyinroq urinib ko\'ring.',
         'rate_limit_error': '🚫 Xizmat vaqtincha yuklangan. Bir necha daqiqadan so\'ng urinib ko\'ring.',
         'api_error': '🔧 AI xizmatida muammo. Keyinroq urinib ko\'ring yoki operator bilan bog\'laning.',
+        'degraded_mode': "⚠️ AI yordamchi hozir mavjud emas, shuning uchun darhol javob beramiz.\n\n📞 Bizga qo'ng'iroq qiling:\n{phones}\n\n👨‍💼 Yoki quyidagi tugmani bosing - savolingizni menejerga uzatamiz.",
+        'file_received': "📎 «{name}» fayli qabul qilindi. Menejer uni so'rovingiz bilan birga ko'radi.",
+        'file_too_large': "📦 Fayl juda katta: {max_mb} MB gacha fayl yuborish mumkin. Katta maketlarni menejerga havola orqali yuborgan ma'qul.",
+        'file_type_rejected': "🚫 Bu turdagi fayl qabul qilinmaydi. Maketni PDF, JPG, PNG, TIFF, PSD, EPS, CDR yoki ZIP arxivida yuboring.",
+        'file_error': "❌ Faylni olib bo'lmadi. Iltimos, uni qaytadan yuboring.",
+        'usage_rate_limited': "⏳ Siz xabarlarni juda tez-tez yuboryapsiz, AI yordamchi biroz keyinroq javob beradi.\n\n👨‍💼 Yoki quyidagi tugmani bosing - savolingizni menejerga uzatamiz.",
+        'usage_quota_exceeded': "📊 Bugun uchun AI yordamchiga savollar limiti tugadi.\n\n📞 Bizga qo'ng'iroq qiling:\n{phones}\n\n👨‍💼 Yoki quyidagi tugmani bosing - savolingizni menejerga uzatamiz.",
         
         # Кнопки быстрых действий
         'quick_services': '📋 Bizning xizmatlar',
@@ -92,6 +145,13 @@ TEXTS = {
         'timeout_error': '⏰ Sorry, the request is taking too long. Please try later.',
         'rate_limit_error': '🚫 Service is temporarily overloaded. Please try in a few minutes.',
         'api_error': '🔧 AI service problem. Please try later or contact an operator.',
+        'degraded_mode': "⚠️ The AI assistant is unavailable right now, so we are answering right away.\n\n📞 Call us:\n{phones}\n\n👨‍💼 Or press the button below and we will pass your question to a manager.",
+        'file_received': '📎 File "{name}" received. The manager will see it together with your request.',
+        'file_too_large': '📦 The file is too large: files up to {max_mb} MB are accepted. Please send large layouts to the manager as a link.',
+        'file_type_rejected': '🚫 This file type is not accepted. Please send the layout as PDF, JPG, PNG, TIFF, PSD, EPS, CDR or a ZIP archive.',
+        'file_error': '❌ Could not get the file. Please try sending it again.',
+        'usage_rate_limited': "⏳ You are sending messages too often, the AI assistant will answer a bit later.\n\n👨‍💼 Or press the button below and we will pass your question to a manager.",
+        'usage_quota_exceeded': "📊 Today's limit of questions to the AI assistant has been reached.\n\n📞 Call us:\n{phones}\n\n👨‍💼 Or press the button below and we will pass your question to a manager.",
         
         # Кнопки быстрых действий
         'quick_services': '📋 Our services',
@@ -101,6 +161,10 @@ TEXTS = {
     }
 }
 
+def get_texts(user_lang):
+    """Texts in user's language with overrides of the current bot (tenant)."""
+    return current_tenant().texts(TEXTS, user_lang)
+
 def get_language_keyboard():
     """Creates language selection keyboard."""
     keyboard = [
@@ -116,57 +180,16 @@ def get_quick_actions_keyboard(user_lang):
     """Creates quick actions keyboard."""
     keyboard = [
         [
-            InlineKeyboardButton(TEXTS[user_lang]['quick_services'], callback_data="quick_services"),
-            InlineKeyboardButton(TEXTS[user_lang]['quick_language'], callback_data="quick_language")
+            InlineKeyboardButton(get_texts(user_lang)['quick_services'], callback_data="quick_services"),
+            InlineKeyboardButton(get_texts(user_lang)['quick_language'], callback_data="quick_language")
         ],
         [
-            InlineKeyboardButton(TEXTS[user_lang]['quick_manager'], callback_data="quick_manager"),
-            InlineKeyboardButton(TEXTS[user_lang]['quick_info'], callback_data="quick_info")
+            InlineKeyboardButton(get_texts(user_lang)['quick_manager'], callback_data="quick_manager"),
+            InlineKeyboardButton(get_texts(user_lang)['quick_info'], callback_data="quick_info")
         ]
     ]
     return InlineKeyboardMarkup(keyboard)
 
-async def safe_process_message(user_message, thread_id, user_lang):
-    """Безопасно обрабатывает сообщение через OpenAI Assistant с проверкой активных run'ов."""
-    try:
-        # Проверяем активные run'ы в thread
-        runs = client.beta.threads.runs.list(thread_id=thread_id, limit=5)
-        
-        # Отменяем все активные run'ы
-        for run in runs.data:
-            if run.status in ['queued', 'in_progress', 'requires_action']:
-                logging.info(f"Cancelling active run {run.id} before new message")
-                try:
-                    cancel_run(thread_id, run.id)
-                    # Даем время на отмену
-                    time.sleep(1)
-                except Exception as e:
-                    logging.warning(f"Could not cancel run {run.id}: {e}")
-        
-        # Добавляем сообщение пользователя в thread
-        client.beta.threads.messages.create(
-            thread_id=thread_id,
-            role="user",
-            content=user_message
-        )
-        
-        # Запускаем ассистента
-        run = client.beta.threads.runs.create(
-            thread_id=thread_id,
-            assistant_id=ASSISTANT_ID
-        )
-        
-        return run
-        
-    except openai.RateLimitError:
-        return {"error": "rate_limit", "message": "Сервис временно перегружен. Попробуйте через несколько минут."}
-    except openai.APIError as e:
-        logging.error(f"OpenAI API error: {e}")
-        return {"error": "api_error", "message": "Проблема с сервисом ИИ. Попробуйте позже или обратитесь к оператору."}
-    except Exception as e:
-        logging.error(f"Unexpected error: {e}")
-        return {"error": "unknown", "message": "Произошла ошибка при обработке вашего запроса. Пожалуйста, попробуйте еще раз."}
-
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Sends welcome message on /start command."""
     user = update.effective_user
@@ -177,16 +200,17 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     
     # If language not set, show language selection
     if not user_lang:
-        await update.message.reply_text(
-            TEXTS['ru']['choose_language'],
+        await outbound.reply_text(
+            update.message,
+            get_texts('ru')['choose_language'],
             reply_markup=get_language_keyboard()
         )
         return
     
-    welcome_text = TEXTS[user_lang]['welcome'].format(user.first_name)
+    welcome_text = get_texts(user_lang)['welcome'].format(user.first_name)
     quick_actions_keyboard = get_quick_actions_keyboard(user_lang)
     
-    await update.message.reply_text(welcome_text, reply_markup=quick_actions_keyboard)
+    await outbound.reply_text(update.message, welcome_text, reply_markup=quick_actions_keyboard)
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Sends help message on /help command."""
@@ -194,9 +218,9 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     log_user_action(user.id, user.username, "HELP")
     
     user_lang = get_user_language(user.id) or 'ru'
-    help_text = TEXTS[user_lang]['help']
+    help_text = get_texts(user_lang)['help']
     
-    await update.message.reply_text(help_text)
+    await outbound.reply_text(update.message, help_text)
 
 async def info_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Sends company information."""
@@ -204,17 +228,18 @@ async def info_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     log_user_action(user.id, user.username, "INFO")
     
     user_lang = get_user_language(user.id) or 'ru'
-    info_text = TEXTS[user_lang]['company_info']
+    info_text = get_texts(user_lang)['company_info']
     
-    await update.message.reply_text(info_text, parse_mode='Markdown')
+    await outbound.reply_text(update.message, info_text, parse_mode='Markdown')
 
 async def lang_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Shows language selection."""
     user = update.effective_user
     log_user_action(user.id, user.username, "LANG")
     
-    await update.message.reply_text(
-        TEXTS['ru']['choose_language'],
+    await outbound.reply_text(
+        update.message,
+        get_texts('ru')['choose_language'],
         reply_markup=get_language_keyboard()
     )
 
@@ -224,15 +249,13 @@ async def reset_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
     log_user_action(user.id, user.username, "RESET")
     
     user_lang = get_user_language(user.id) or 'ru'
-    user_id = update.effective_user.id
     
-    if user_id in user_threads:
-        del user_threads[user_id]
-        from utils import save_threads
-        save_threads(user_threads)
-        await update.message.reply_text(TEXTS[user_lang]['reset_success'])
+    # Файлы из сброшенного разговора менеджеру уже не передаются
+    attachments.discard(user.id)
+    if get_backend().reset(user.id):
+        await outbound.reply_text(update.message, get_texts(user_lang)['reset_success'])
     else:
-        await update.message.reply_text(TEXTS[user_lang]['reset_empty'])
+        await outbound.reply_text(update.message, get_texts(user_lang)['reset_empty'])
 
 async def language_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handles language selection through inline buttons."""
@@ -249,89 +272,20 @@ async def language_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
     log_user_action(user.id, user.username, f"LANG_SET", lang_code)
     
     # Send confirmation in selected language
-    confirmation_text = TEXTS[lang_code]['language_set']
-    await query.edit_message_text(confirmation_text)
+    confirmation_text = get_texts(lang_code)['language_set']
+    await outbound.edit_message_text(query, confirmation_text)
     
     # Show welcome in selected language with quick actions
-    welcome_text = TEXTS[lang_code]['welcome'].format(user.first_name)
+    welcome_text = get_texts(lang_code)['welcome'].format(user.first_name)
     quick_actions_keyboard = get_quick_actions_keyboard(lang_code)
-    await query.message.reply_text(welcome_text, reply_markup=quick_actions_keyboard)
+    await outbound.reply_text(query.message, welcome_text, reply_markup=quick_actions_keyboard)
 
-async def process_assistant_request(query, message_text, user_lang):
-    """Обрабатывает запрос к Assistant'у из inline кнопки с безопасной обработкой."""
-    user_id = query.from_user.id
+async def process_assistant_request(query, message_text, user_lang, intent=None):
+    """Обрабатывает запрос к Assistant'у из inline кнопки (intent - быстрое действие для маршрута ассистента)."""
     user = query.from_user
     
     log_user_action(user.id, user.username, "QUICK_ACTION", message_text)
-    
-    # Create new thread if doesn't exist for user
-    if user_id not in user_threads:
-        thread_id = create_thread_for_user(user_id, user_threads)
-    else:
-        thread_id = user_threads[user_id]
-    
-    # Send typing indicator
-    await query.message.chat.send_action(action="typing")
-    
-    # Process message through OpenAI using safe method
-    result = await safe_process_message(message_text, thread_id, user_lang)
-    
-    # Check for errors
-    if isinstance(result, dict) and "error" in result:
-        error_type = result["error"]
-        if error_type == "rate_limit":
-            error_message = TEXTS[user_lang]['rate_limit_error']
-        elif error_type == "api_error":
-            error_message = TEXTS[user_lang]['api_error']
-        else:
-            error_message = TEXTS[user_lang]['processing_error']
-        
-        await query.message.reply_text(error_message)
-        return
-    
-    # Wait for completion with timeout
-    timeout_counter = 0
-    max_timeout = 60
-    
-    while True:
-        run_status = get_run_status(thread_id, result.id)
-        
-        if run_status.status == 'completed':
-            break
-        elif run_status.status == 'requires_action':
-            # Assistant called transfer_to_manager function
-            tool_calls = run_status.required_action.submit_tool_outputs.tool_calls
-            for tool_call in tool_calls:
-                if tool_call.function.name == "transfer_to_manager":
-                    # Создаем mock update для handle_transfer_to_manager
-                    mock_update = type('MockUpdate', (), {
-                        'effective_user': user,
-                        'message': query.message
-                    })()
-                    await handle_transfer_to_manager(mock_update, tool_call, thread_id, result.id, user_lang)
-                    return
-        elif run_status.status in ['failed', 'cancelled', 'expired']:
-            if run_status.status == 'cancelled':
-                logging.info(f"Run {result.id} was cancelled as expected after transfer_to_manager")
-            else:
-                await query.message.reply_text(TEXTS[user_lang]['processing_error'])
-            return
-        
-        timeout_counter += 1
-        if timeout_counter > max_timeout:
-            await query.message.reply_text(TEXTS[user_lang]['timeout_error'])
-            return
-        
-        # Отправляем typing action каждые 4 секунды
-        if timeout_counter % 4 == 0:
-            await query.message.chat.send_action(action="typing")
-            
-        time.sleep(1)
-    
-    # Get assistant response
-    assistant_response = get_assistant_response(thread_id)
-    if assistant_response:
-        await query.message.reply_text(assistant_response)
+    await converse(query.message, user, message_text, user_lang, intent)
 
 async def quick_actions_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handles quick action buttons."""
@@ -352,12 +306,13 @@ async def quick_actions_callback(update: Update, context: ContextTypes.DEFAULT_T
         }
         
         # Обрабатываем как обычное сообщение пользователя
-        await process_assistant_request(query, services_questions[user_lang], user_lang)
+        await process_assistant_request(query, services_questions[user_lang], user_lang, 'services')
         
     elif action == "quick_language":
         # Показываем меню выбора языка
-        await query.message.reply_text(
-            TEXTS['ru']['choose_language'],
+        await outbound.reply_text(
+            query.message,
+            get_texts('ru')['choose_language'],
             reply_markup=get_language_keyboard()
         )
         
@@ -368,12 +323,12 @@ async def quick_actions_callback(update: Update, context: ContextTypes.DEFAULT_T
             'en': "I want to contact a manager"
         }
         
-        await process_assistant_request(query, manager_requests[user_lang], user_lang)
+        await process_assistant_request(query, manager_requests[user_lang], user_lang, 'manager')
         
     elif action == "quick_info":
         # Отправляем информацию о компании напрямую
-        info_text = TEXTS[user_lang]['company_info']
-        await query.message.reply_text(info_text, parse_mode='Markdown')
+        info_text = get_texts(user_lang)['company_info']
+        await outbound.reply_text(query.message, info_text, parse_mode='Markdown')
 
 async def handle_contact(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обрабатывает полученный контакт пользователя."""
@@ -395,11 +350,8 @@ async def handle_contact(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             "phone": phone_number
         }
         
-        # Отправляем обновление с номером телефона
-        thread_id = user_threads.get(user.id)
-        if thread_id:
-            update_message = f"📞 ОБНОВЛЕНИЕ: Клиент поделился номером телефона: {phone_number}"
-            await send_to_bitrix(user_data, update_message, thread_id)
+        # Номер дополняет лид, созданный передачей менеджеру, или открытый лид клиента
+        await handoffs.contact(user_data, get_backend().conversation_id(user.id))
         
         # Благодарим пользователя
         thanks_texts = {
@@ -421,7 +373,7 @@ async def handle_contact(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         message = error_texts.get(user_lang, error_texts['ru'])
     
     # Убираем клавиатуру
-    await update.message.reply_text(message, reply_markup=ReplyKeyboardRemove())
+    await outbound.reply_text(update.message, message, reply_markup=ReplyKeyboardRemove())
 
 async def handle_skip_contact(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обрабатывает нажатие кнопки 'Пропустить'."""
@@ -439,21 +391,107 @@ async def handle_skip_contact(update: Update, context: ContextTypes.DEFAULT_TYPE
     log_user_action(user.id, user.username, "CONTACT_SKIPPED")
     
     # Убираем клавиатуру
-    await update.message.reply_text(message, reply_markup=ReplyKeyboardRemove())
+    await outbound.reply_text(update.message, message, reply_markup=ReplyKeyboardRemove())
+
+async def ask_for_contact(message, user_lang):
+    """Сообщает о передаче менеджеру и просит поделиться номером телефона."""
+    # Создаем кнопку для запроса контакта
+    contact_texts = {
+        'ru': "📞 Поделиться номером телефона",
+        'uz': "📞 Telefon raqamini ulashish", 
+        'en': "📞 Share phone number"
+    }
+    
+    contact_button_text = contact_texts.get(user_lang, contact_texts['ru'])
+    skip_button_text = SKIP_TEXTS.get(user_lang, SKIP_TEXTS['ru'])
+    
+    keyboard = [
+        [KeyboardButton(contact_button_text, request_contact=True)],
+        [KeyboardButton(skip_button_text)]
+    ]
+    reply_markup = ReplyKeyboardMarkup(keyboard, one_time_keyboard=True, resize_keyboard=True)
+    
+    # Сообщения о передаче с просьбой поделиться контактом
+    contact_request_texts = {
+        'ru': f"{get_texts(user_lang)['contact_manager']}\n\n💡 Для более быстрой связи поделитесь номером телефона:",
+        'uz': f"{get_texts(user_lang)['contact_manager']}\n\n💡 Tezroq bog'lanish uchun telefon raqamingizni ulashing:",
+        'en': f"{get_texts(user_lang)['contact_manager']}\n\n💡 For faster contact, please share your phone number:"
+    }
+    
+    text = contact_request_texts.get(user_lang, contact_request_texts['ru'])
+    await outbound.reply_text(message, text, reply_markup=reply_markup)
+
+async def send_degraded_reply(message, user_lang):
+    """Ответ без ассистента, пока circuit breaker разомкнут: информация о компании, телефоны и передача менеджеру."""
+    logging.info(f"Assistant breaker {assistant_breaker.state}: degraded reply to chat {message.chat_id}")
+    
+    phones = "\n".join(f"• {phone}" for phone in current_tenant().phones)
+    keyboard = InlineKeyboardMarkup([
+        [InlineKeyboardButton(get_texts(user_lang)['quick_manager'], callback_data="degraded_manager")]
+    ])
+    
+    await outbound.reply_text(message, get_texts(user_lang)['company_info'], parse_mode='Markdown')
+    await outbound.reply_text(message, get_texts(user_lang)['degraded_mode'].format(phones=phones), reply_markup=keyboard)
+
+async def send_limited_reply(message, user, reason, user_lang):
+    """Ответ без ассистента пользователю сверх лимита частоты или дневной квоты: предложение менеджера."""
+    log_user_action(user.id, user.username, "USAGE_LIMITED", reason)
+    # Скрипт, шлющий сообщения подряд, получает одно предупреждение за окно лимита, а не ответ на каждое
+    if not current_tenant().usage.should_notify(user.id):
+        return
+    
+    phones = "\n".join(f"• {phone}" for phone in current_tenant().phones)
+    keyboard = InlineKeyboardMarkup([
+        [InlineKeyboardButton(get_texts(user_lang)['quick_manager'], callback_data="degraded_manager")]
+    ])
+    text_key = 'usage_rate_limited' if reason == RATE_LIMITED else 'usage_quota_exceeded'
+    await outbound.reply_text(message, get_texts(user_lang)[text_key].format(phones=phones), reply_markup=keyboard)
+
+async def degraded_manager_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Передает запрос менеджеру напрямую, без ассистента (кнопка из ответа в деградированном режиме)."""
+    query = update.callback_query
+    user = query.from_user
+    user_lang = get_user_language(user.id) or 'ru'
+    
+    await query.answer()
+    log_user_action(user.id, user.username, "DEGRADED_TRANSFER")
+    
+    user_data = {
+        "id": user.id,
+        "username": user.username,
+        "first_name": user.first_name,
+        "language": user_lang,
+        "phone": None
+    }
+    
+    # История thread'а недоступна, пока OpenAI деградировал - передаем последний вопрос клиента
+    question = context.user_data.get('degraded_question')
+    if current_tenant().usage.refusal(user.id) is not None:
+        summary = "Клиент превысил лимит обращений к ИИ-помощнику и запросил менеджера"
+    else:
+        summary = "ИИ-помощник недоступен, клиент запросил менеджера"
+    if question:
+        summary = f"{summary}. Вопрос: {question}"
+    backend = get_backend()
+    files = await attachments.collect(user.id)
+    formatted_message = format_conversation_for_manager(
+        user_data=user_data,
+        summary=summary,
+        previous_summary=backend.previous_summary(user.id),
+        attachments=files
+    )
+    
+    await handoffs.handoff(user_data, formatted_message, backend.conversation_id(user.id), attachments=files)
+    await ask_for_contact(query.message, user_lang)
 
-async def handle_transfer_to_manager(update, tool_call, thread_id, run_id, user_lang):
+async def handle_transfer_to_manager(message, user, transfer_args, user_lang):
     """Handles transfer request to manager with enhanced information."""
-    user = update.effective_user
     log_user_action(user.id, user.username, "TRANSFER_TO_MANAGER")
     
-    # Extract data from function call
-    import json
-    function_args = json.loads(tool_call.function.arguments)
-    
     # Извлекаем все возможные параметры от Assistant'а
-    summary = function_args.get("summary", "Client requested manager contact")
-    technical_specs = function_args.get("technical_specs", None)
-    recommendations = function_args.get("recommendations", None)
+    summary = transfer_args.get("summary", "Client requested manager contact")
+    technical_specs = transfer_args.get("technical_specs", None)
+    recommendations = transfer_args.get("recommendations", None)
     
     # Prepare enhanced user data
     user_data = {
@@ -464,132 +502,206 @@ async def handle_transfer_to_manager(update, tool_call, thread_id, run_id, user_
         "phone": None  # Пока нет телефона
     }
     
-    # Форматируем полную информацию для менеджера
+    # Форматируем полную информацию для менеджера (файлы клиента - после завершения их загрузки)
+    backend = get_backend()
+    files = await attachments.collect(user.id)
     formatted_message = format_conversation_for_manager(
-        thread_id=thread_id,
         user_data=user_data,
         summary=summary,
         technical_specs=technical_specs,
-        recommendations=recommendations
+        recommendations=recommendations,
+        conversation_history=backend.conversation_history(user.id),
+        previous_summary=backend.previous_summary(user.id),
+        attachments=files
     )
     
-    # Send enhanced data to Bitrix24
-    success = await send_to_bitrix(user_data, formatted_message, thread_id)
+    # Send enhanced data to Bitrix24: новым лидом или в открытый лид клиента
+    await handoffs.handoff(user_data, formatted_message, backend.conversation_id(user.id), attachments=files)
     
-    # Cancel the current run to free the thread for future messages
-    logging.info(f"Cancelling run {run_id} after transfer to manager")
-    cancel_result = cancel_run(thread_id, run_id)
+    await ask_for_contact(message, user_lang)
+
+async def keep_typing(chat):
+    """Показывает индикатор набора, пока задачу не отменят."""
+    while True:
+        outbound.send_typing(chat)
+        await asyncio.sleep(outbound.typing_interval)
+
+async def converse(message, user, text, user_lang, intent=None):
+    """
+    Passes user's text to the assistant routed by language and quick action intent
+    and delivers the result.
+    
+    Returns False if the backend is degraded or the user is over usage limits
+    and got a reply without the assistant instead.
+    """
+    # Слишком частые запросы (скрипты, спам) и исчерпанная квота не доходят до OpenAI
+    # и не занимают пробные запросы circuit breaker'а
+    tenant = current_tenant()
+    usage = tenant.usage
+    limit = usage.check(user.id)
+    if limit is not None:
+        await send_limited_reply(message, user, limit, user_lang)
+        return False
+    
+    # Backend ассистента деградировал - отвечаем сразу, не создавая новых запросов
+    if not assistant_breaker.allow_request():
+        await send_degraded_reply(message, user_lang)
+        return False
+    
+    assistant = tenant.router.route(user_lang, intent)
+    started = time.monotonic()
+    typing = asyncio.create_task(keep_typing(message.chat))
+    try:
+        result = await get_backend().respond(user.id, text, user_lang, assistant)
+    except Exception as e:
+        # Сбой бэкенда вне обработанных им ошибок (создание thread'а, опрос, чтение ответа) -
+        # тоже отказ: circuit breaker должен его учесть, а клиент - получить ответ
+        logging.exception(f"Assistant backend failed for user {user.id}: {type(e).__name__}")
+        result = TurnResult(ERROR, error='processing_error')
+    finally:
+        typing.cancel()
+    latency = time.monotonic() - started
+    usage.record(user.id, latency, result.usage)
+    tenant.router.record(assistant, result.usage)
+    
+    if result.kind == ERROR:
+        assistant_breaker.record_failure(latency)
+        await outbound.reply_text(message, get_texts(user_lang)[result.error])
+        return True
+    
+    assistant_breaker.record_success(latency)
+    if result.kind == TRANSFER:
+        await handle_transfer_to_manager(message, user, result.transfer_args, user_lang)
+    elif result.text:
+        await outbound.reply_text(message, result.text)
+    
+    # Служебная работа бэкенда - после ответа, чтобы не задерживать его
+    if result.finish is not None:
+        await asyncio.to_thread(result.finish)
+    return True
+
+async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Handles messages from user and passes them to the assistant backend."""
+    user_message = update.message.text
+    user = update.effective_user
+    user_lang = get_user_language(user.id) or 'ru'
     
-    if cancel_result:
-        logging.info(f"Run {run_id} cancelled successfully")
-    else:
-        logging.error(f"Failed to cancel run {run_id}")
+    log_user_action(user.id, user.username, "MESSAGE", user_message)
     
-    # Создаем кнопку для запроса контакта
-    contact_texts = {
-        'ru': "📞 Поделиться номером телефона",
-        'uz': "📞 Telefon raqamini ulashish", 
-        'en': "📞 Share phone number"
-    }
+    if not await converse(update.message, user, user_message, user_lang):
+        # Вопрос пригодится, если клиент попросит менеджера из деградированного ответа
+        context.user_data['degraded_question'] = user_message
+
+async def receive_attachment(message, user, file_id, name, user_lang):
+    """Downloads customer's file in background and tells the customer whether it was accepted."""
+    try:
+        attachment = await attachments.fetch(message.get_bot(), user.id, file_id, name)
+    except AttachmentError as e:
+        logging.warning(f"Attachment {name} from user {user.id} rejected: {e.reason} ({e})")
+        await outbound.reply_text(message, get_texts(user_lang)[e.reason].format(max_mb=ATTACHMENT_MAX_MB))
+        return None
+    
+    await outbound.reply_text(message, get_texts(user_lang)['file_received'].format(name=name))
+    return attachment
+
+async def handle_attachment(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Handles documents and photos: files are streamed to disk in background and attached to the manager handoff."""
+    message = update.message
+    user = update.effective_user
+    user_lang = get_user_language(user.id) or 'ru'
+    file_id, name, size = describe_attachment(message)
     
-    skip_texts = {
-        'ru': "⏭️ Пропустить",
-        'uz': "⏭️ O'tkazib yuborish",
-        'en': "⏭️ Skip"
-    }
+    log_user_action(user.id, user.username, "ATTACHMENT", f"{name} ({size} bytes)")
     
-    contact_button_text = contact_texts.get(user_lang, contact_texts['ru'])
-    skip_button_text = skip_texts.get(user_lang, skip_texts['ru'])
+    # Заведомо большой файл отклоняется сразу, без запроса к Telegram
+    try:
+        attachments.check_size(size)
+    except AttachmentError as e:
+        await outbound.reply_text(message, get_texts(user_lang)[e.reason].format(max_mb=ATTACHMENT_MAX_MB))
+        return
     
-    keyboard = [
-        [KeyboardButton(contact_button_text, request_contact=True)],
-        [KeyboardButton(skip_button_text)]
-    ]
-    reply_markup = ReplyKeyboardMarkup(keyboard, one_time_keyboard=True, resize_keyboard=True)
+    # Обработчик не ждет загрузку: обновления других клиентов не задерживаются
+    attachments.submit(user.id, receive_attachment(message, user, file_id, name, user_lang))
     
-    # Сообщения о передаче с просьбой поделиться контактом
-    contact_request_texts = {
-        'ru': f"{TEXTS[user_lang]['contact_manager']}\n\n💡 Для более быстрой связи поделитесь номером телефона:",
-        'uz': f"{TEXTS[user_lang]['contact_manager']}\n\n💡 Tezroq bog'lanish uchun telefon raqamingizni ulashing:",
-        'en': f"{TEXTS[user_lang]['contact_manager']}\n\n💡 For faster contact, please share your phone number:"
-    }
+    # Подпись к файлу - вопрос клиента: ассистент получает ее с пометкой о файле
+    if message.caption:
+        await converse(message, user, f"{message.caption}\n\n[Клиент приложил файл: {name}]", user_lang)
+
+async def run_profile(seconds, message=None):
+    """Профилирует бота seconds секунд; сводку отправляет в чат message, если он задан."""
+    try:
+        collapsed_path, summary_path, summary = await profiler.profile(seconds, PROFILE_DIR)
+    except RuntimeError as e:
+        logging.warning(f"Profiling not started: {e}")
+        if message is not None:
+            await outbound.reply_text(message, "⚠️ Профилирование уже идет")
+        return
     
-    message = contact_request_texts.get(user_lang, contact_request_texts['ru'])
-    await update.message.reply_text(message, reply_markup=reply_markup)
+    logging.info(f"Profile saved: {collapsed_path}, {summary_path}")
+    if message is not None:
+        # Лимит Telegram - 4096 символов; полная сводка остается в файле
+        await outbound.reply_text(message, f"{summary[:3500]}\n\n💾 {collapsed_path}")
 
-async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Handles messages from user and passes them to OpenAI Assistant."""
-    user_id = update.effective_user.id
-    user_message = update.message.text
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Запускает профилирование на N секунд: /profile [N] (только для администраторов)."""
     user = update.effective_user
-    user_lang = get_user_language(user_id) or 'ru'
     
-    log_user_action(user.id, user.username, "MESSAGE", user_message)
+    seconds = int(context.args[0]) if context.args and context.args[0].isdigit() else PROFILE_DEFAULT_SECONDS
+    seconds = max(1, min(seconds, PROFILE_MAX_SECONDS))
+    log_user_action(user.id, user.username, "PROFILE", str(seconds))
     
-    # Create new thread if doesn't exist for user
-    if user_id not in user_threads:
-        thread_id = create_thread_for_user(user_id, user_threads)
-    else:
-        thread_id = user_threads[user_id]
-    
-    # Send typing indicator
-    await update.message.chat.send_action(action="typing")
-    
-    # Process message through OpenAI using safe method
-    result = await safe_process_message(user_message, thread_id, user_lang)
-    
-    # Check for errors
-    if isinstance(result, dict) and "error" in result:
-        error_type = result["error"]
-        if error_type == "rate_limit":
-            error_message = TEXTS[user_lang]['rate_limit_error']
-        elif error_type == "api_error":
-            error_message = TEXTS[user_lang]['api_error']
-        else:
-            error_message = TEXTS[user_lang]['processing_error']
-        
-        await update.message.reply_text(error_message)
+    if profiler.running:
+        await outbound.reply_text(update.message, "⚠️ Профилирование уже идет")
         return
     
-    # Wait for completion with timeout
-    timeout_counter = 0
-    max_timeout = 60
+    await outbound.reply_text(update.message, f"🔬 Профилирование запущено на {seconds} с")
+    # Окно профилирования не должно задерживать обработку следующих обновлений
+    context.application.create_task(run_profile(seconds, update.message))
+
+async def usage_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Показывает самых затратных пользователей: /usage [дней] (только для администраторов)."""
+    user = update.effective_user
     
-    while True:
-        run_status = get_run_status(thread_id, result.id)
-        
-        if run_status.status == 'completed':
-            break
-        elif run_status.status == 'requires_action':
-            # Assistant called transfer_to_manager function
-            tool_calls = run_status.required_action.submit_tool_outputs.tool_calls
-            for tool_call in tool_calls:
-                if tool_call.function.name == "transfer_to_manager":
-                    await handle_transfer_to_manager(update, tool_call, thread_id, result.id, user_lang)
-                    return  # Exit after transfer, run is cancelled
-        elif run_status.status in ['failed', 'cancelled', 'expired']:
-            if run_status.status == 'cancelled':
-                # Run was cancelled after transfer_to_manager, this is expected
-                logging.info(f"Run {result.id} was cancelled as expected after transfer_to_manager")
-            else:
-                await update.message.reply_text(TEXTS[user_lang]['processing_error'])
-            return
-        
-        timeout_counter += 1
-        if timeout_counter > max_timeout:
-            await update.message.reply_text(TEXTS[user_lang]['timeout_error'])
-            return
-        
-        # Отправляем typing action каждые 4 секунды
-        if timeout_counter % 4 == 0:
-            await update.message.chat.send_action(action="typing")
-            
-        time.sleep(1)
+    days = int(context.args[0]) if context.args and context.args[0].isdigit() else 1
+    days = max(1, min(days, USAGE_RETENTION_DAYS))
+    log_user_action(user.id, user.username, "USAGE", str(days))
+    
+    top = current_tenant().usage.top(days)
+    if not top:
+        await outbound.reply_text(update.message, f"📊 За {days} дн. расхода нет")
+        return
     
-    # Get assistant response
-    assistant_response = get_assistant_response(thread_id)
-    if assistant_response:
-        await update.message.reply_text(assistant_response)
+    lines = [f"📊 Топ пользователей по токенам за {days} дн.:"]
+    for number, (user_id, counters) in enumerate(top, 1):
+        tokens = counters['prompt_tokens'] + counters['completion_tokens']
+        lines.append(
+            f"{number}. {user_id}: {tokens} ток. (промпт {counters['prompt_tokens']}), ходов {counters['turns']}, "
+            f"{counters['seconds']:.0f} с, опросов {counters['polls']}, отказов {counters['limited']}"
+        )
+    await outbound.reply_text(update.message, "\n".join(lines))
+
+async def assistants_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Показывает маршруты ассистентов и размер их промптов (только для администраторов)."""
+    user = update.effective_user
+    log_user_action(user.id, user.username, "ASSISTANTS")
+    
+    backend = get_backend()
+    lines = ["🧭 Ассистенты: промпт хода в токенах (min / p50 / p95)"]
+    for row in current_tenant().router.report():
+        # Инструкции ассистента - запрос к OpenAI, в отдельном потоке
+        try:
+            instructions = await asyncio.to_thread(backend.instructions, row['assistant'])
+            size = f"инструкции {len(instructions)} симв."
+        except Exception as e:
+            logging.warning(f"Could not read instructions of {row['assistant']}: {e}")
+            size = "инструкции недоступны"
+        tokens = " / ".join('-' if value is None else str(value)
+                            for value in (row['prompt_min'], row['prompt_p50'], row['prompt_p95']))
+        lines.append(
+            f"{row['assistant'] or 'общий промпт'} [{', '.join(row['routes'])}]: "
+            f"{tokens}, ходов {row['turns']}, {size}"
+        )
+    await outbound.reply_text(update.message, "\n".join(lines))
 
 async def set_bot_commands(application):
     """Sets bot command list."""
@@ -602,32 +714,117 @@ async def set_bot_commands(application):
     ]
     await application.bot.set_my_commands(commands)
 
-def main() -> None:
-    """Starts the bot."""
-    validate_environment()
+async def post_init(application):
+    """
+    Настраивает команды, открывает индекс похожих диалогов, запускает планировщик отправок,
+    очистку файлов клиентов и сторож loop'а.
+    """
+    await set_bot_commands(application)
+    # Индекс отображается в память при старте: первая передача менеджеру не ждет открытия
+    load_index(application.bot_data['tenant'].similarity_index_dir)
+    outbound.start()
+    attachments.start(application.bot_data['tenant'])
+    watchdog.start()
+    
+    # SIGUSR1 запускает профилирование без команды в Telegram (результат - в PROFILE_DIR и в лог)
+    if hasattr(signal, 'SIGUSR1'):
+        asyncio.get_running_loop().add_signal_handler(
+            signal.SIGUSR1,
+            lambda: application.create_task(run_profile(PROFILE_DEFAULT_SECONDS))
+        )
+
+async def post_shutdown(application):
+    """
+    Дожидается создаваемых лидов CRM, останавливает планировщик отправок, загрузки файлов
+    и запись трафика, сохраняет учет расхода и пишет в лог число отброшенных дубликатов,
+    блокировки event loop и размер промптов ассистентов.
+    """
+    await handoffs.close()
+    await outbound.stop()
+    await attachments.close()
+    await watchdog.stop()
+    application.bot_data['tenant'].usage.flush()
+    logging.info(f"Duplicate updates: {application.bot_data['deduplicator'].stats()}")
+    logging.info(f"Event loop stalls: {watchdog.snapshot()}")
+    logging.info(f"Assistant prompt sizes: {application.bot_data['tenant'].router.report()}")
+    recorder = application.bot_data.get('traffic_recorder')
+    if recorder:
+        recorder.close()
+
+async def bind_tenant(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Makes the application's bot current, so handlers use its state, texts and assistant."""
+    use_tenant(context.bot_data['tenant'])
+
+def build_application(token, request=None, capture_dir=TRAFFIC_CAPTURE_DIR, tenant=None, polling=True):
+    """
+    Creates application with all handlers.
+    
+    request - custom Telegram transport (pool shared by several bots or replay transport),
+    tenant - bot whose state and texts handlers use (default - bot from environment),
+    polling=False - no updater, updates are put into update_queue directly (replay).
+    """
+    builder = Application.builder().token(token)
+    if request is not None:
+        builder = builder.request(request)
+    if not polling:
+        builder = builder.updater(None)
+    application = builder.build()
+    
+    # Бот выбирается первым: запись трафика и все обработчики работают с его состоянием
+    application.bot_data['tenant'] = tenant or default_tenant
+    application.add_handler(TypeHandler(Update, bind_tenant), group=TENANT_GROUP)
+    
+    # Запись трафика включается только явно (TRAFFIC_CAPTURE_DIR) и идет до всех обработчиков
+    if capture_dir:
+        # Тексты кнопок записываются как есть - по ним воспроизведение выбирает обработчик
+        recorder = TrafficRecorder(capture_dir, keep_texts=SKIP_TEXTS.values())
+        application.bot_data['traffic_recorder'] = recorder
+        application.add_handler(TypeHandler(Update, recorder.on_update), group=CAPTURE_GROUP)
+    
+    # Повторные доставки и двойные нажатия отбрасываются до обработчиков (после записи -
+    # запись сохраняет трафик как есть)
+    deduplicator = UpdateDeduplicator()
+    application.bot_data['deduplicator'] = deduplicator
+    application.add_handler(TypeHandler(Update, deduplicator.on_update), group=DEDUP_GROUP)
+    application.add_handler(TypeHandler(Update, deduplicator.on_done), group=DONE_GROUP)
     
-    # Create application and add handlers
-    application = Application.builder().token(TELEGRAM_TOKEN).build()
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("help", help_command))
     application.add_handler(CommandHandler("info", info_command))
     application.add_handler(CommandHandler("lang", lang_command))
     application.add_handler(CommandHandler("reset", reset_command))
+    application.add_handler(CommandHandler("profile", profile_command, filters=filters.User(user_id=ADMIN_IDS)))
+    application.add_handler(CommandHandler("usage", usage_command, filters=filters.User(user_id=ADMIN_IDS)))
+    application.add_handler(CommandHandler("assistants", assistants_command, filters=filters.User(user_id=ADMIN_IDS)))
     application.add_handler(CallbackQueryHandler(language_callback, pattern="^lang_"))
     application.add_handler(CallbackQueryHandler(quick_actions_callback, pattern="^quick_"))
+    application.add_handler(CallbackQueryHandler(degraded_manager_callback, pattern="^degraded_manager$"))
     
     # Обработчик контактов
     application.add_handler(MessageHandler(filters.CONTACT, handle_contact))
     
+    # Файлы клиентов: документы (макеты) и фото
+    application.add_handler(MessageHandler(filters.Document.ALL | filters.PHOTO, handle_attachment))
+    
     # Обработчик кнопки "Пропустить"
-    skip_pattern = filters.Regex(r"^(⏭️ Пропустить|⏭️ O'tkazib yuborish|⏭️ Skip)$")
+    skip_pattern = filters.Regex(f"^({'|'.join(map(re.escape, SKIP_TEXTS.values()))})$")
     application.add_handler(MessageHandler(skip_pattern, handle_skip_contact))
     
     # Обработчик обычных сообщений (должен быть последним)
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
     
-    # Set commands
-    application.post_init = set_bot_commands
+    # Set commands and start send scheduler
+    application.post_init = post_init
+    application.post_shutdown = post_shutdown
+    
+    return application
+
+def main() -> None:
+    """Starts the bot."""
+    validate_environment()
+    
+    # Create application and add handlers
+    application = build_application(TELEGRAM_TOKEN)
     
     # Start bot
     application.run_polling()
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""
+Circuit breaker для вызовов OpenAI Assistant: доля ошибок и перцентили задержки run'ов
+"""
+
+import logging
+import math
+import time
+from collections import deque
+
+from config import (BREAKER_WINDOW, BREAKER_MIN_REQUESTS, BREAKER_ERROR_RATE,
+                    BREAKER_LATENCY_P95, BREAKER_COOLDOWN, BREAKER_PROBE_SUCCESSES)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+def percentile(values, share):
+    """Перцентиль по методу ближайшего ранга; None для пустого списка."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(share * len(ordered)) - 1)]
+
+class CircuitBreaker:
+    """
+    Следит за результатами запросов к ассистенту в скользящем окне window секунд.
+
+    Размыкается, когда в окне набралось не меньше min_requests запросов и доля ошибок
+    достигла error_rate или p95 задержки run'а превысил latency_p95 секунд.
+    В разомкнутом состоянии allow_request() сразу возвращает False. Через cooldown
+    секунд breaker пропускает один пробный запрос; после probe_successes успешных проб
+    подряд он замыкается, а ошибка пробы размыкает его на следующий cooldown.
+    """
+
+    def __init__(self, name='assistant', window=BREAKER_WINDOW, min_requests=BREAKER_MIN_REQUESTS,
+                 error_rate=BREAKER_ERROR_RATE, latency_p95=BREAKER_LATENCY_P95,
+                 cooldown=BREAKER_COOLDOWN, probe_successes=BREAKER_PROBE_SUCCESSES, probe_timeout=90.0):
+        self.name = name
+        self.window = window
+        self.min_requests = min_requests
+        self.error_rate = error_rate
+        self.latency_p95 = latency_p95
+        self.cooldown = cooldown
+        self.probe_successes = probe_successes
+        # Проба, по которой так и не пришел результат, перестает блокировать новые пробы
+        self.probe_timeout = probe_timeout
+
+        self.state = CLOSED
+        self._outcomes = deque()
+        self._opened_at = 0.0
+        self._probe_started = None
+        self._probe_streak = 0
+
+        self.rejected = 0
+        self.trips = 0
+
+    def _trim(self, now):
+        while self._outcomes and now - self._outcomes[0][0] > self.window:
+            self._outcomes.popleft()
+
+    def allow_request(self):
+        """Можно ли отправить запрос ассистенту прямо сейчас."""
+        now = time.monotonic()
+
+        if self.state == OPEN:
+            if now - self._opened_at < self.cooldown:
+                self.rejected += 1
+                return False
+            self.state = HALF_OPEN
+            self._probe_streak = 0
+            self._probe_started = None
+            logging.info(f"Circuit breaker '{self.name}' half-open: probing backend")
+
+        if self.state == HALF_OPEN:
+            if self._probe_started is not None and now - self._probe_started < self.probe_timeout:
+                self.rejected += 1
+                return False
+            self._probe_started = now
+
+        return True
+
+    def record_success(self, latency=None):
+        """Запрос к ассистенту завершился ответом; latency - длительность run'а в секундах."""
+        now = time.monotonic()
+
+        if self.state == HALF_OPEN:
+            self._probe_started = None
+            self._probe_streak += 1
+            if self._probe_streak >= self.probe_successes:
+                self.state = CLOSED
+                self._outcomes.clear()
+                logging.info(f"Circuit breaker '{self.name}' closed after {self._probe_streak} successful probes")
+            return
+
+        self._outcomes.append((now, True, latency))
+        self._check(now)
+
+    def record_failure(self, latency=None):
+        """Запрос к ассистенту завершился ошибкой, failed/expired run'ом или таймаутом."""
+        now = time.monotonic()
+
+        if self.state == HALF_OPEN:
+            self._open(now, "probe failed")
+            return
+
+        self._outcomes.append((now, False, latency))
+        self._check(now)
+
+    def _check(self, now):
+        self._trim(now)
+        if self.state != CLOSED or len(self._outcomes) < self.min_requests:
+            return
+
+        failures = sum(1 for _, ok, _ in self._outcomes if not ok)
+        error_rate = failures / len(self._outcomes)
+        p95 = percentile([latency for _, _, latency in self._outcomes if latency is not None], 0.95)
+
+        if error_rate >= self.error_rate:
+            self._open(now, f"error rate {error_rate:.0%} over {len(self._outcomes)} requests")
+        elif p95 is not None and p95 >= self.latency_p95:
+            self._open(now, f"run latency p95 {p95:.1f}s")
+
+    def _open(self, now, reason):
+        self.state = OPEN
+        self._opened_at = now
+        self._probe_started = None
+        self.trips += 1
+        logging.warning(f"Circuit breaker '{self.name}' opened: {reason}; next probe in {self.cooldown:.0f}s")
+
+    def snapshot(self):
+        """Текущее состояние и метрики окна для логов и админ-команд."""
+        now = time.monotonic()
+        self._trim(now)
+        latencies = [latency for _, _, latency in self._outcomes if latency is not None]
+        failures = sum(1 for _, ok, _ in self._outcomes if not ok)
+        return {
+            'state': self.state,
+            'requests': len(self._outcomes),
+            'error_rate': round(failures / len(self._outcomes), 3) if self._outcomes else 0.0,
+            'latency_p50': percentile(latencies, 0.5),
+            'latency_p95': percentile(latencies, 0.95),
+            'trips': self.trips,
+            'rejected': self.rejected
+        }
@@ -6,10 +6,144 @@ import logging
 TELEGRAM_TOKEN = os.environ.get("TELEGRAM_TOKEN")
 OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")
 ASSISTANT_ID = os.environ.get("ASSISTANT_ID")
+VECTOR_STORE_ID = os.environ.get("VECTOR_STORE_ID")
+
+# Бэкенд ответов: "assistants" (threads/runs Assistants API) или "chat" (один потоковый
+# chat completions запрос на ход, история разговора и FAQ - локально)
+ASSISTANT_BACKENDS = ("assistants", "chat")
+ASSISTANT_BACKEND = os.environ.get("ASSISTANT_BACKEND", "assistants")
+# Ассистенты по языку и быстрому действию (assistant_routing.py): "uz=asst_...,en=asst_...,ru/services=asst_..."
+# Ключи - язык, действие (services, manager) или "язык/действие"; без маршрута - ASSISTANT_ID.
+# Для бэкенда chat значения - файлы системных промптов
+ASSISTANT_ROUTES = {
+    key.strip(): value.strip()
+    for key, value in (route.split("=", 1) for route in os.environ.get("ASSISTANT_ROUTES", "").split(",") if "=" in route)
+}
+CHAT_MODEL = os.environ.get("CHAT_MODEL", "gpt-4o-mini")
+# Файл системного промпта chat бэкенда (пусто - встроенный промпт)
+CHAT_SYSTEM_PROMPT_PATH = os.environ.get("CHAT_SYSTEM_PROMPT_PATH")
+# Директория FAQ, фрагменты которой подставляются в промпт, и их общий лимит (символы)
+CHAT_FAQ_DIR = os.environ.get("CHAT_FAQ_DIR", "FAQ")
+CHAT_FAQ_MAX_CHARS = int(os.environ.get("CHAT_FAQ_MAX_CHARS", "6000"))
+# Сколько последних сообщений разговора хранится и отправляется модели
+CHAT_HISTORY_MESSAGES = int(os.environ.get("CHAT_HISTORY_MESSAGES", "20"))
+
+# Общий HTTP клиент OpenAI: размер пула, keep-alive соединения и их время жизни (с),
+# HTTP/2 (нужен пакет h2), таймауты по операциям (с) и повторы идемпотентных запросов
+OPENAI_MAX_CONNECTIONS = int(os.environ.get("OPENAI_MAX_CONNECTIONS", "20"))
+OPENAI_MAX_KEEPALIVE = int(os.environ.get("OPENAI_MAX_KEEPALIVE", "10"))
+OPENAI_KEEPALIVE_EXPIRY = float(os.environ.get("OPENAI_KEEPALIVE_EXPIRY", "60"))
+OPENAI_HTTP2 = os.environ.get("OPENAI_HTTP2", "0").lower() in ("1", "true", "yes")
+OPENAI_CONNECT_TIMEOUT = float(os.environ.get("OPENAI_CONNECT_TIMEOUT", "5"))
+OPENAI_POLL_TIMEOUT = float(os.environ.get("OPENAI_POLL_TIMEOUT", "10"))
+OPENAI_CREATE_TIMEOUT = float(os.environ.get("OPENAI_CREATE_TIMEOUT", "30"))
+OPENAI_READ_TIMEOUT = float(os.environ.get("OPENAI_READ_TIMEOUT", "20"))
+OPENAI_COMPLETION_TIMEOUT = float(os.environ.get("OPENAI_COMPLETION_TIMEOUT", "60"))
+OPENAI_READ_RETRIES = int(os.environ.get("OPENAI_READ_RETRIES", "2"))
 
 # Пути к файлам
 THREADS_DB_PATH = "data/threads.json"
 LANGUAGES_DB_PATH = "data/languages.json"
+VECTOR_STORE_SYNC_DB_PATH = "data/vector_store_sync.json"
+THREAD_ARCHIVE_DB_PATH = "data/thread_archive.json"
+CONVERSATIONS_DB_PATH = "data/conversations.json"
+ATTACHMENTS_DIR = "data/attachments"
+USAGE_DB_PATH = "data/usage.json"
+CRM_IDENTITIES_DB_PATH = "data/crm_identities.json"
+
+# Бюджет контекста thread: когда сам разговор (оценка токенов сообщений thread'а, без
+# инструкций ассистента и фрагментов file_search) превышает порог, thread сворачивается
+# в краткое резюме и заменяется новым
+THREAD_TOKEN_BUDGET = int(os.environ.get("THREAD_TOKEN_BUDGET", "16000"))
+SUMMARY_MODEL = os.environ.get("SUMMARY_MODEL", "gpt-4o-mini")
+
+# Индекс похожих вопросов из dialogue_processor.py --similarity-index (пусто - выключен):
+# сколько похожих прошлых диалогов прикладывать при передаче менеджеру и минимальное сходство
+SIMILARITY_INDEX_DIR = os.environ.get("SIMILARITY_INDEX_DIR")
+SIMILAR_DIALOGUES_TOP_K = int(os.environ.get("SIMILAR_DIALOGUES_TOP_K", "3"))
+SIMILAR_DIALOGUES_MIN_SCORE = float(os.environ.get("SIMILAR_DIALOGUES_MIN_SCORE", "0.2"))
+
+# Файлы клиентов (макеты, фото): предельный размер (МБ; Bot API отдает ботам файлы до 20 МБ),
+# размер части при потоковой загрузке (байты), число одновременных загрузок на процесс
+# и таймаут загрузки одного файла (с)
+ATTACHMENT_MAX_MB = int(os.environ.get("ATTACHMENT_MAX_MB", "20"))
+ATTACHMENT_CHUNK_SIZE = int(os.environ.get("ATTACHMENT_CHUNK_SIZE", "65536"))
+ATTACHMENT_CONCURRENCY = int(os.environ.get("ATTACHMENT_CONCURRENCY", "4"))
+ATTACHMENT_TIMEOUT = float(os.environ.get("ATTACHMENT_TIMEOUT", "60"))
+# Сколько файлы клиента ждут передачи менеджеру (с), сколько дней файлы хранятся на диске
+# (0 - без удаления) и период очистки (с)
+ATTACHMENT_PENDING_TTL = float(os.environ.get("ATTACHMENT_PENDING_TTL", "86400"))
+ATTACHMENT_RETENTION_DAYS = int(os.environ.get("ATTACHMENT_RETENTION_DAYS", "30"))
+ATTACHMENT_SWEEP_INTERVAL = float(os.environ.get("ATTACHMENT_SWEEP_INTERVAL", "3600"))
+
+# Битрикс24: входящий webhook REST API (https://<портал>.bitrix24.ru/rest/<user>/<код>/;
+# пусто - передачи менеджеру только пишутся в лог) и таймаут запроса (с)
+BITRIX_WEBHOOK_URL = os.environ.get("BITRIX_WEBHOOK_URL")
+BITRIX_TIMEOUT = float(os.environ.get("BITRIX_TIMEOUT", "10"))
+# ID папки Диска Битрикс24, в которую загружаются файлы клиентов: ссылки на них попадают
+# в лид и сообщение менеджеру (пусто - файлы остаются только на сервере бота)
+BITRIX_DISK_FOLDER_ID = os.environ.get("BITRIX_DISK_FOLDER_ID")
+# Сколько дней обращения клиента (передачи менеджеру и контакт) дополняют его лид, а не создают новый
+CRM_LEAD_REUSE_DAYS = int(os.environ.get("CRM_LEAD_REUSE_DAYS", "30"))
+
+# Учет расхода OpenAI по пользователям (usage_ledger.py): дневные квоты на токены и ходы,
+# не больше USAGE_RATE_LIMIT ходов за USAGE_RATE_WINDOW секунд (0 - без ограничения),
+# сколько дней хранить статистику и как часто сохранять ее на диск (с)
+USAGE_DAILY_TOKENS = int(os.environ.get("USAGE_DAILY_TOKENS", "200000"))
+USAGE_DAILY_TURNS = int(os.environ.get("USAGE_DAILY_TURNS", "100"))
+USAGE_RATE_LIMIT = int(os.environ.get("USAGE_RATE_LIMIT", "8"))
+USAGE_RATE_WINDOW = float(os.environ.get("USAGE_RATE_WINDOW", "60"))
+USAGE_RETENTION_DAYS = int(os.environ.get("USAGE_RETENTION_DAYS", "30"))
+USAGE_SAVE_INTERVAL = float(os.environ.get("USAGE_SAVE_INTERVAL", "30"))
+
+# Лимиты исходящих отправок в Telegram: общий поток сообщений в секунду,
+# минимальный интервал между сообщениями в одном чате и период индикатора набора
+SEND_GLOBAL_RATE = float(os.environ.get("SEND_GLOBAL_RATE", "25"))
+SEND_CHAT_INTERVAL = float(os.environ.get("SEND_CHAT_INTERVAL", "1.0"))
+TYPING_INTERVAL = float(os.environ.get("TYPING_INTERVAL", "4.0"))
+
+# Circuit breaker ассистента: окно наблюдения (с), минимум запросов для решения,
+# доля ошибок и p95 длительности run'а (с) для размыкания, пауза до пробы (с)
+# и число успешных проб подряд для замыкания
+BREAKER_WINDOW = float(os.environ.get("BREAKER_WINDOW", "120"))
+BREAKER_MIN_REQUESTS = int(os.environ.get("BREAKER_MIN_REQUESTS", "5"))
+BREAKER_ERROR_RATE = float(os.environ.get("BREAKER_ERROR_RATE", "0.5"))
+BREAKER_LATENCY_P95 = float(os.environ.get("BREAKER_LATENCY_P95", "30"))
+BREAKER_COOLDOWN = float(os.environ.get("BREAKER_COOLDOWN", "30"))
+BREAKER_PROBE_SUCCESSES = int(os.environ.get("BREAKER_PROBE_SUCCESSES", "2"))
+
+# Идемпотентность обновлений: сколько секунд помнить обработанные update_id/сообщения/callback'и,
+# окно двойного нажатия одной кнопки (с) и предельное число запоминаемых ключей
+DEDUP_TTL = float(os.environ.get("DEDUP_TTL", "600"))
+DEDUP_TAP_WINDOW = float(os.environ.get("DEDUP_TAP_WINDOW", "5"))
+DEDUP_MAX_ENTRIES = int(os.environ.get("DEDUP_MAX_ENTRIES", "10000"))
+
+# Директория для записи трафика (traffic_capture.py); пусто - запись выключена.
+# Тексты сообщений пишутся только длиной и хэшем; TRAFFIC_CAPTURE_RAW_TEXT=1 - исходный текст,
+# из которого убираются лишь e-mail, упоминания и номера (имена и адреса клиентов остаются)
+TRAFFIC_CAPTURE_DIR = os.environ.get("TRAFFIC_CAPTURE_DIR")
+TRAFFIC_CAPTURE_RAW_TEXT = os.environ.get("TRAFFIC_CAPTURE_RAW_TEXT", "0").lower() in ("1", "true", "yes")
+
+# Telegram ID администраторов через запятую: им доступны служебные команды (/profile)
+ADMIN_IDS = {int(user_id) for user_id in os.environ.get("ADMIN_IDS", "").split(",") if user_id.strip()}
+
+# Профилирование по команде /profile или сигналу SIGUSR1: период сэмплов (с),
+# длительность окна по умолчанию и максимальная (с), директория результатов
+PROFILE_INTERVAL = float(os.environ.get("PROFILE_INTERVAL", "0.01"))
+PROFILE_DEFAULT_SECONDS = int(os.environ.get("PROFILE_DEFAULT_SECONDS", "30"))
+PROFILE_MAX_SECONDS = int(os.environ.get("PROFILE_MAX_SECONDS", "300"))
+PROFILE_DIR = "data/profiles"
+
+# Сторож event loop (loop_watchdog.py): период замера задержки loop'а (с), порог блокировки,
+# при котором снимается стек (с, 0 - сторож выключен), и как часто блокировки пишутся в лог (с)
+LOOP_WATCHDOG_INTERVAL = float(os.environ.get("LOOP_WATCHDOG_INTERVAL", "0.1"))
+LOOP_STALL_THRESHOLD = float(os.environ.get("LOOP_STALL_THRESHOLD", "0.25"))
+LOOP_STALL_LOG_INTERVAL = float(os.environ.get("LOOP_STALL_LOG_INTERVAL", "30"))
+
+# Несколько ботов в одном процессе (multi_tenant.py): JSON файл с настройками ботов
+# и размер общего пула соединений к Telegram Bot API
+TENANTS_CONFIG = os.environ.get("TENANTS_CONFIG", "tenants.json")
+TELEGRAM_POOL_SIZE = int(os.environ.get("TELEGRAM_POOL_SIZE", "32"))
 
 # Контактная информация
 COMPANY_PHONES = [
@@ -27,11 +161,17 @@ SUPPORTED_LANGUAGES = {
 
 def validate_environment():
     """Проверяет наличие всех необходимых переменных окружения."""
+    if ASSISTANT_BACKEND not in ASSISTANT_BACKENDS:
+        logging.error(f"Unknown ASSISTANT_BACKEND: {ASSISTANT_BACKEND}")
+        raise SystemExit(f"Error: ASSISTANT_BACKEND must be one of: {', '.join(ASSISTANT_BACKENDS)}")
+    
     required_vars = {
         'TELEGRAM_TOKEN': TELEGRAM_TOKEN,
-        'OPENAI_API_KEY': OPENAI_API_KEY, 
-        'ASSISTANT_ID': ASSISTANT_ID
+        'OPENAI_API_KEY': OPENAI_API_KEY
     }
+    # Ассистент нужен только бэкенду Assistants API
+    if ASSISTANT_BACKEND == "assistants":
+        required_vars['ASSISTANT_ID'] = ASSISTANT_ID
     
     missing_vars = []
     for var_name, var_value in required_vars.items():
@@ -42,4 +182,12 @@ def validate_environment():
         logging.error(f"Missing required environment variables: {', '.join(missing_vars)}")
         raise SystemExit(f"Error: Missing environment variables: {', '.join(missing_vars)}")
     
+    # Для бэкенда chat маршруты ASSISTANT_ROUTES - файлы промптов: без файла падал бы каждый ход маршрута
+    if ASSISTANT_BACKEND == "chat":
+        from assistant_routing import missing_route_files
+        missing_files = missing_route_files(ASSISTANT_ROUTES)
+        if missing_files:
+            logging.error(f"Assistant route prompt files not found: {', '.join(missing_files)}")
+            raise SystemExit(f"Error: ASSISTANT_ROUTES prompt files not found: {', '.join(missing_files)}")
+    
     logging.info("All required environment variables are set")
\ No newline at end of file
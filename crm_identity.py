@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+"""
+Связь клиентов Telegram с лидами Битрикс24: локальный индекс Telegram ID и телефон -> лид
+и передачи менеджеру, которые дополняют лид клиента, а не создают новые.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import re
+import time
+from collections import Counter
+
+from config import CRM_LEAD_REUSE_DAYS
+from bitrix_integration import send_to_bitrix, update_bitrix_lead
+from tenants import current_tenant
+from utils import write_json_atomic
+
+def normalize_phone(phone):
+    """Только цифры номера: "+998 71 207-39-00" и "998712073900" - один номер."""
+    return re.sub(r'\D', '', phone or '')
+
+class IdentityIndex:
+    """
+    Лиды клиентов одного бота в path:
+    {"users": {telegram_id: {"lead_id", "phone", "updated"}}, "phones": {цифры номера: {"lead_id", "updated"}}}.
+
+    Лид считается открытым reuse_days дней после последнего обращения клиента:
+    обращение позже создает новый лид, а не дополняет старый.
+    """
+
+    def __init__(self, path, reuse_days=CRM_LEAD_REUSE_DAYS):
+        self.path = path
+        self.reuse_days = reuse_days
+        self.users = {}
+        self.phones = {}
+        # Сохранения по очереди: последнее записывает самое новое состояние
+        self._save_lock = asyncio.Lock()
+
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            try:
+                with open(path, "r") as f:
+                    data = json.load(f)
+                self.users = {int(k): v for k, v in data.get("users", {}).items()}
+                self.phones = data.get("phones", {})
+            except (json.JSONDecodeError, IOError) as e:
+                logging.error(f"Error loading CRM identities: {e}")
+
+    def _write(self, data):
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            write_json_atomic(self.path, data)
+        except IOError as e:
+            logging.error(f"Error saving CRM identities: {e}")
+
+    async def save(self):
+        """Записывает индекс в потоке, не блокируя event loop; снимок данных - в event loop."""
+        async with self._save_lock:
+            data = {
+                "users": {str(k): dict(v) for k, v in self.users.items()},
+                "phones": {k: dict(v) for k, v in self.phones.items()},
+            }
+            await asyncio.to_thread(self._write, data)
+
+    def _open_lead(self, entry, now):
+        if entry and entry.get("lead_id") is not None and now - entry["updated"] <= self.reuse_days * 86400:
+            return entry["lead_id"]
+        return None
+
+    def lead_for(self, user_id, phone=None, now=None):
+        """Открытый лид клиента по Telegram ID, а если его нет - по телефону; None - лида нет."""
+        now = time.time() if now is None else now
+        lead_id = self._open_lead(self.users.get(user_id), now)
+        if lead_id is None and phone:
+            lead_id = self._open_lead(self.phones.get(normalize_phone(phone)), now)
+        return lead_id
+
+    def knows_phone(self, user_id, phone):
+        """Этот номер уже записан в лид клиента."""
+        entry = self.users.get(user_id)
+        return bool(entry and entry["phone"] and normalize_phone(entry["phone"]) == normalize_phone(phone))
+
+    async def remember(self, user_id, lead_id, phone=None):
+        """Связывает клиента (и его телефон) с лидом и отмечает время обращения."""
+        now = time.time()
+        entry = self.users.setdefault(user_id, {"lead_id": None, "phone": None, "updated": now})
+        entry["lead_id"] = lead_id
+        entry["updated"] = now
+        phone = phone or entry["phone"]
+        if phone:
+            entry["phone"] = phone
+            self.phones[normalize_phone(phone)] = {"lead_id": lead_id, "updated": now}
+        await self.save()
+
+class HandoffDispatcher:
+    """
+    Передачи менеджеру в Битрикс24 с учетом известных лидов клиентов:
+
+    - передача клиента с открытым лидом - комментарий в этом лиде, а не новый лид;
+    - новая передача сразу создает лид и запоминает его в индексе клиентов: в памяти
+      ничего не ждет, и остановка или падение бота передачу не теряют;
+    - контакт, которым клиент поделился после передачи (бот просит номер сразу после нее), -
+      обновление этого лида: телефон в карточке и комментарий в ленте.
+
+    Контакт, пришедший, пока лид передачи еще создается, ждет его создания.
+    """
+
+    def __init__(self):
+        # (бот, пользователь) -> отправляемая передача
+        self._sending = {}
+        self.stats = Counter()
+
+    async def handoff(self, user_data, message, thread_id, attachments=None):
+        """Передает запрос клиента менеджеру: в открытый лид клиента или новым лидом."""
+        tenant = current_tenant()
+        user_id = user_data["id"]
+        lead_id = tenant.crm_identities.lead_for(user_id)
+        if lead_id is not None:
+            await self._update(tenant, lead_id, user_data, message)
+            return
+
+        key = (tenant.name, user_id)
+        task = asyncio.ensure_future(self._send(tenant, user_data, message, thread_id, attachments))
+        self._sending[key] = task
+        try:
+            await task
+        finally:
+            if self._sending.get(key) is task:
+                del self._sending[key]
+
+    async def contact(self, user_data, thread_id):
+        """Контакт клиента: в открытый лид (в том числе только что созданный передачей) или отдельным запросом."""
+        tenant = current_tenant()
+        user_id = user_data["id"]
+        phone = user_data["phone"]
+
+        sending = self._sending.get((tenant.name, user_id))
+        if sending is not None:
+            await asyncio.shield(sending)
+
+        update_message = f"📞 ОБНОВЛЕНИЕ: Клиент поделился номером телефона: {phone}"
+        lead_id = tenant.crm_identities.lead_for(user_id, phone)
+        if lead_id is not None and tenant.crm_identities.knows_phone(user_id, phone):
+            # Повторно отправленный тот же контакт лид не меняет
+            self.stats['contacts_known'] += 1
+        elif lead_id is not None:
+            self.stats['contacts_merged'] += 1
+            await self._update(tenant, lead_id, user_data, update_message)
+        elif thread_id:
+            await self._send(tenant, user_data, update_message, thread_id)
+        else:
+            self.stats['contacts_dropped'] += 1
+            logging.warning(f"Contact of user {user_id} not sent to CRM: no open lead and no conversation")
+
+    async def close(self):
+        """Дожидается создаваемых лидов (остановка бота)."""
+        await asyncio.gather(*self._sending.values(), return_exceptions=True)
+        self._sending.clear()
+        logging.info(f"CRM handoffs: {dict(self.stats)}")
+
+    async def _send(self, tenant, user_data, message, thread_id, attachments=None):
+        self.stats['leads_created'] += 1
+        lead_id = await send_to_bitrix(user_data, message, thread_id, attachments=attachments)
+        if lead_id is not None:
+            await tenant.crm_identities.remember(user_data["id"], lead_id, user_data.get("phone"))
+
+    async def _update(self, tenant, lead_id, user_data, comment):
+        self.stats['leads_updated'] += 1
+        if await update_bitrix_lead(lead_id, user_data, comment):
+            await tenant.crm_identities.remember(user_data["id"], lead_id, user_data.get("phone"))
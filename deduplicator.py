@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""
+Удаление точных и почти точных дубликатов диалогов (MinHash + LSH)
+"""
+
+import hashlib
+import re
+import zlib
+from typing import Dict, Set
+
+import numpy as np
+
+# Простое число Мерсенна 2^61 - 1 для универсального хэширования
+_MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+_MAX_HASH = np.uint64((1 << 32) - 1)
+
+class DialogueDeduplicator:
+    """
+    Потоковый фильтр дубликатов: первый встреченный диалог остается представителем,
+    последующие копии отбрасываются.
+
+    Точные дубликаты ищутся по хэшу нормализованного текста сообщений. Почти точные -
+    по MinHash сигнатурам словесных шинглов: LSH по полосам сигнатуры дает кандидатов,
+    которые затем проверяются оценкой сходства Жаккара против threshold.
+    threshold >= 1.0 оставляет только поиск точных дубликатов.
+    """
+
+    def __init__(self, threshold: float = 0.9, num_perm: int = 128, shingle_size: int = 3, seed: int = 1):
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+
+        rng = np.random.RandomState(seed)
+        self._a = rng.randint(1, 1 << 32, size=num_perm, dtype=np.uint64)
+        self._b = rng.randint(0, 1 << 32, size=num_perm, dtype=np.uint64)
+        self.bands, self.rows = self._choose_bands(threshold, num_perm)
+
+        self._exact = {}
+        self._buckets = [{} for _ in range(self.bands)]
+        # Сигнатуры представителей храним в uint32 - вдвое меньше памяти
+        self._signatures = []
+        self._representatives = []
+
+        self.duplicates = []
+        self.exact_duplicates = 0
+        self.near_duplicates = 0
+        self.dropped_messages = 0
+        self.kept = 0
+
+    @staticmethod
+    def _choose_bands(threshold: float, num_perm: int):
+        """Подбирает число полос и строк LSH, чей порог (1/b)^(1/r) ближе всего к threshold"""
+        best = None
+        for rows in range(1, num_perm + 1):
+            if num_perm % rows:
+                continue
+            bands = num_perm // rows
+            distance = abs((1 / bands) ** (1 / rows) - threshold)
+            if best is None or distance < best[0]:
+                best = (distance, bands, rows)
+        return best[1], best[2]
+
+    def _normalized_text(self, dialogue: Dict) -> str:
+        parts = []
+        for msg in dialogue['messages']:
+            role = 'c' if msg['is_client'] else 'o'
+            parts.append(f"{role}:{msg['text'].lower()}")
+        return '\n'.join(parts)
+
+    def _shingles(self, text: str) -> Set[bytes]:
+        words = re.findall(r'\w+', text)
+        if len(words) <= self.shingle_size:
+            return {' '.join(words).encode('utf-8')}
+        return {
+            ' '.join(words[i:i + self.shingle_size]).encode('utf-8')
+            for i in range(len(words) - self.shingle_size + 1)
+        }
+
+    def signature(self, text: str) -> np.ndarray:
+        """MinHash сигнатура текста длины num_perm"""
+        hashes = np.fromiter((zlib.crc32(s) for s in self._shingles(text)), dtype=np.uint64)
+        permuted = (np.outer(self._a, hashes) + self._b[:, None]) % _MERSENNE_PRIME
+        return (permuted.min(axis=1) & _MAX_HASH).astype(np.uint32)
+
+    def _record(self, dialogue: Dict, representative_id, kind: str, similarity: float):
+        self.duplicates.append({
+            'dialogue_id': dialogue['dialogue_id'],
+            'representative_id': representative_id,
+            'kind': kind,
+            'similarity': round(similarity, 3)
+        })
+        self.dropped_messages += dialogue['message_count']
+
+    def is_duplicate(self, dialogue: Dict) -> bool:
+        """Проверяет диалог; если он новый - запоминает его как представителя"""
+        text = self._normalized_text(dialogue)
+
+        digest = hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest()
+        if digest in self._exact:
+            self.exact_duplicates += 1
+            self._record(dialogue, self._exact[digest], 'exact', 1.0)
+            return True
+
+        if self.threshold < 1.0:
+            signature = self.signature(text)
+            band_keys = [
+                signature[band * self.rows:(band + 1) * self.rows].tobytes()
+                for band in range(self.bands)
+            ]
+
+            candidates = set()
+            for band, key in enumerate(band_keys):
+                candidates.update(self._buckets[band].get(key, ()))
+
+            for candidate in sorted(candidates):
+                similarity = float(np.mean(self._signatures[candidate] == signature))
+                if similarity >= self.threshold:
+                    self.near_duplicates += 1
+                    self._record(dialogue, self._representatives[candidate], 'near', similarity)
+                    # Точные копии отброшенного диалога относятся к оставленному представителю
+                    self._exact[digest] = self._representatives[candidate]
+                    return True
+
+            index = len(self._signatures)
+            self._signatures.append(signature)
+            self._representatives.append(dialogue['dialogue_id'])
+            for band, key in enumerate(band_keys):
+                self._buckets[band].setdefault(key, []).append(index)
+
+        self._exact[digest] = dialogue['dialogue_id']
+        self.kept += 1
+        return False
+
+    def stats(self) -> Dict:
+        """Сводка для processing_info.json"""
+        dropped = self.exact_duplicates + self.near_duplicates
+        total = self.kept + dropped
+        return {
+            'threshold': self.threshold,
+            'num_perm': self.num_perm,
+            'lsh_bands': self.bands,
+            'lsh_rows': self.rows,
+            'dialogues_seen': total,
+            'dialogues_kept': self.kept,
+            'exact_duplicates': self.exact_duplicates,
+            'near_duplicates': self.near_duplicates,
+            'dialogues_dropped': dropped,
+            'messages_dropped': self.dropped_messages,
+            'dropped_percent': round(100 * dropped / total, 2) if total else 0.0
+        }
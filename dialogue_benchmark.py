@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Генератор синтетических выгрузок Битрикс24 и бенчмарк этапов DialogueProcessor
+"""
+
+import argparse
+import html
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+from datetime import datetime
+from typing import Dict, Iterator, List
+
+import openpyxl
+
+from dialogue_processor import DialogueProcessor, DialogueJsonWriter, KnowledgeBaseTxtWriter
+
+# Готовые размеры выгрузок
+SIZE_PRESETS = {
+    '10k': 10_000,
+    '100k': 100_000,
+    '1m': 1_000_000
+}
+
+OPERATORS = ['Sitora', 'Yulia', 'Yuliya', 'Sofiya', 'Anton', 'Liliya']
+
+# Словарь для сообщений: обычные слова и ключевые слова тем
+VOCABULARY = (
+    'здравствуйте добрый день подскажите пожалуйста нужно хотим можно сделать '
+    'визитки баннер листовки буклеты наклейки футболки кружки календари '
+    'цена стоимость сколько стоит сум срок когда готов день час размер формат мм см '
+    'дизайн макет файл картинка доставка самовывоз курьер оплата счет перечисление '
+    'материал бумага ткань качество заказ оформить тираж штук экземпляров спасибо'
+).split()
+
+COLUMNS = ['№', 'Клиент', 'Диалог (Demo)']
+
+def generate_rows(count: int, min_messages: int, max_messages: int, message_words: int,
+                  client_ratio: float, operators: List[str], seed: int) -> Iterator[List]:
+    """Генерирует строки выгрузки: номер, клиент, текст диалога в формате 'Имя: текст'"""
+    rng = random.Random(seed)
+
+    for number in range(1, count + 1):
+        client = f"Клиент{number}"
+        operator = rng.choice(operators)
+        parts = []
+
+        for i in range(rng.randint(min_messages, max_messages)):
+            # Первое сообщение всегда от клиента, дальше - по заданной доле
+            speaker = client if i == 0 or rng.random() < client_ratio else operator
+            words = rng.choices(VOCABULARY, k=max(1, int(rng.gauss(message_words, message_words / 3))))
+            text = ' '.join(words).capitalize()
+            if speaker == client and rng.random() < 0.5:
+                text += '?'
+            parts.append(f"{speaker}: {text}")
+
+        yield [number, client, ' '.join(parts)]
+
+def write_xlsx(path: str, rows: Iterator[List]):
+    """Пишет настоящий .xlsx в потоковом режиме openpyxl"""
+    workbook = openpyxl.Workbook(write_only=True)
+    sheet = workbook.create_sheet()
+    sheet.append(COLUMNS)
+    for row in rows:
+        sheet.append(row)
+    workbook.save(path)
+
+def write_html_xls(path: str, rows: Iterator[List]):
+    """Пишет HTML таблицу с расширением .xls, как это делает Битрикс24"""
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('\ufeff<html><head><meta charset="utf-8"></head><body><table>\n')
+        f.write('<tr>' + ''.join(f'<th>{html.escape(c)}</th>' for c in COLUMNS) + '</tr>\n')
+        for row in rows:
+            f.write('<tr>' + ''.join(f'<td>{html.escape(str(value))}</td>' for value in row) + '</tr>\n')
+        f.write('</table></body></html>\n')
+
+def peak_rss_mb() -> float:
+    """Пиковое потребление памяти процессом в МБ (ru_maxrss в КБ на Linux, в байтах на macOS)"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak /= 1024
+    return round(peak / 1024, 1)
+
+def timed(stages: Dict, name: str, func):
+    """Обертка функции, накапливающая время ее вызовов в stages[name]"""
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            stages[name] += time.perf_counter() - started
+    return wrapper
+
+def run_benchmark(file_path: str) -> Dict:
+    """
+    Прогоняет файл через потоковый конвейер, замеряя каждый этап отдельно:
+    чтение строк, очистку текста, разбор на сообщения, тегирование и запись.
+
+    Диалоги собирает сам DialogueProcessor.build_dialogue: этапы замеряются обертками
+    его методов, поэтому бенчмарк меряет ровно тот код, что работает в обработке.
+    """
+    processor = DialogueProcessor()
+    stages = {'read': 0.0, 'clean': 0.0, 'parse': 0.0, 'tag': 0.0, 'write': 0.0}
+    processor.clean_message = timed(stages, 'clean', processor.clean_message)
+    processor.parse_dialogue = timed(stages, 'parse', processor.parse_dialogue)
+    processor.topic_tagger.tag_dialogue = timed(stages, 'tag', processor.topic_tagger.tag_dialogue)
+    rows_count = 0
+    dialogues_count = 0
+    messages_count = 0
+    clock = time.perf_counter
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        json_writer = DialogueJsonWriter(os.path.join(output_dir, 'benchmark.json'))
+        txt_writer = KnowledgeBaseTxtWriter(os.path.join(output_dir, 'benchmark.txt'))
+
+        started = clock()
+        with json_writer, txt_writer:
+            rows = processor.iter_rows(file_path)
+            while True:
+                t0 = clock()
+                row = next(rows, None)
+                stages['read'] += clock() - t0
+                if row is None:
+                    break
+                rows_count += 1
+
+                dialogue = processor.build_dialogue(*row)
+                if dialogue is None:
+                    continue
+
+                t1 = clock()
+                json_writer.write(dialogue)
+                txt_writer.write(dialogue)
+                stages['write'] += clock() - t1
+
+                dialogues_count += 1
+                messages_count += dialogue['message_count']
+        total = clock() - started
+        output_bytes = sum(os.path.getsize(os.path.join(output_dir, name)) for name in os.listdir(output_dir))
+
+    # parse_dialogue сам очищает текст: время очистки учтено в clean, а не дважды
+    stages['parse'] -= stages['clean']
+
+    return {
+        'file': os.path.basename(file_path),
+        'file_bytes': os.path.getsize(file_path),
+        'timestamp': datetime.now().isoformat(),
+        'rows': rows_count,
+        'dialogues': dialogues_count,
+        'messages': messages_count,
+        'output_bytes': output_bytes,
+        'total_seconds': round(total, 3),
+        'stages': {name: round(seconds, 3) for name, seconds in stages.items()},
+        'dialogues_per_second': round(dialogues_count / total, 1) if total else 0.0,
+        'peak_rss_mb': peak_rss_mb()
+    }
+
+def compare_with_baseline(result: Dict, baseline: Dict, tolerance: float) -> List[str]:
+    """Возвращает список регрессий: этапы, ставшие медленнее базового замера больше чем на tolerance"""
+    regressions = []
+    checks = [(f"stage {name}", result['stages'][name], baseline.get('stages', {}).get(name)) for name in result['stages']]
+    checks.append(('total', result['total_seconds'], baseline.get('total_seconds')))
+    checks.append(('peak_rss_mb', result['peak_rss_mb'], baseline.get('peak_rss_mb')))
+
+    print(f"\n📏 Сравнение с базовым замером (допуск {tolerance:.0%}):")
+    for name, current, previous in checks:
+        if not previous:
+            continue
+        ratio = current / previous
+        mark = '❌' if ratio > 1 + tolerance else '✅'
+        print(f"   {mark} {name}: {previous} → {current} ({ratio:.2f}x)")
+        if ratio > 1 + tolerance:
+            regressions.append(name)
+    return regressions
+
+def print_result(result: Dict):
+    print(f"\n📊 {result['file']}: {result['dialogues']} диалогов, {result['messages']} сообщений")
+    for name, seconds in result['stages'].items():
+        share = seconds / result['total_seconds'] if result['total_seconds'] else 0
+        print(f"   ⏱️ {name:<6} {seconds:>9.3f} с ({share:.0%})")
+    print(f"   ⏱️ total  {result['total_seconds']:>9.3f} с")
+    print(f"   🚀 {result['dialogues_per_second']} диалогов/с, пик памяти {result['peak_rss_mb']} МБ")
+
+def main():
+    parser = argparse.ArgumentParser(description='Синтетические выгрузки и бенчмарк DialogueProcessor')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    generate = subparsers.add_parser('generate', help='Сгенерировать синтетическую выгрузку')
+    generate.add_argument('output', help='Путь к файлу (.xlsx или .xls для HTML выгрузки)')
+    generate.add_argument('--size', choices=sorted(SIZE_PRESETS), help='Готовый размер: 10k, 100k или 1m диалогов')
+    generate.add_argument('--count', type=int, default=1000, help='Количество диалогов (по умолчанию 1000)')
+    generate.add_argument('--format', choices=['xlsx', 'html'], help='Формат файла (по умолчанию по расширению: .xls - HTML)')
+    generate.add_argument('--min-messages', type=int, default=2, help='Минимум сообщений в диалоге')
+    generate.add_argument('--max-messages', type=int, default=12, help='Максимум сообщений в диалоге')
+    generate.add_argument('--message-words', type=int, default=12, help='Средняя длина сообщения в словах')
+    generate.add_argument('--client-ratio', type=float, default=0.5, help='Доля сообщений клиента (0..1)')
+    generate.add_argument('--operators', default=','.join(OPERATORS), help='Операторы через запятую')
+    generate.add_argument('--seed', type=int, default=42, help='Seed генератора для воспроизводимости')
+
+    run = subparsers.add_parser('run', help='Замерить этапы обработки файла')
+    run.add_argument('file', help='Файл выгрузки')
+    run.add_argument('--output', help='Сохранить результат замера в JSON')
+    run.add_argument('--baseline', help='JSON базового замера для сравнения')
+    run.add_argument('--tolerance', type=float, default=0.2, help='Допустимое замедление относительно базового замера (по умолчанию 0.2 = 20%%)')
+
+    args = parser.parse_args()
+
+    if args.command == 'generate':
+        count = SIZE_PRESETS[args.size] if args.size else args.count
+        file_format = args.format or ('html' if args.output.lower().endswith('.xls') else 'xlsx')
+        operators = [name.strip() for name in args.operators.split(',') if name.strip()]
+        rows = generate_rows(count, args.min_messages, args.max_messages, args.message_words,
+                             args.client_ratio, operators, args.seed)
+
+        started = time.perf_counter()
+        if file_format == 'html':
+            write_html_xls(args.output, rows)
+        else:
+            write_xlsx(args.output, rows)
+        print(f"✅ {args.output}: {count} диалогов ({file_format}), "
+              f"{os.path.getsize(args.output) / 1024 / 1024:.1f} МБ за {time.perf_counter() - started:.1f} с")
+        return
+
+    result = run_benchmark(args.file)
+    print_result(result)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"💾 Результат сохранен в {args.output}")
+
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare_with_baseline(result, baseline, args.tolerance)
+        if regressions:
+            print(f"❌ Замедление относительно базового замера: {', '.join(regressions)}")
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -9,41 +9,150 @@ import json
 import re
 import glob
 import os
+import hashlib
+import shutil
+import tempfile
+import gzip
+import io
+from collections import Counter
 from datetime import datetime
 from typing import List, Dict, Tuple
 import sys
 import argparse
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from contextlib import ExitStack
+from typing import Iterator, Iterable, Any
+import openpyxl
+from lxml import etree
+
+from topic_tagger import TopicTagger, DEFAULT_TOPIC
+from deduplicator import DialogueDeduplicator
+from similarity_index import SimilarityIndexBuilder
 
 class DialogueProcessor:
+    # Эвристики качества Q&A пар
+    QUESTION_INDICATORS = ['?', 'как', 'что', 'где', 'когда', 'сколько', 'можно', 'есть']
+    BAD_ANSWERS = ['да', 'нет', 'хорошо', 'ок', 'понятно', 'спасибо']
+    
+    # Признаки узбекского текста: буквы кириллицы и типичные слова/апострофы латиницы
+    UZBEK_CYRILLIC = re.compile(r'[ўқғҳ]')
+    UZBEK_LATIN = re.compile(r"\b(salom|assalomu|rahmat|qancha|narxi?|kerak|bormi|iltimos|qanday|buyurtma|bo'l|yo'q)|[og][ʻ'‘]", re.IGNORECASE)
+    
     def __init__(self):
         self.qa_pairs = []
+        self.topic_tagger = TopicTagger()
     
-    def read_excel_file(self, file_path: str) -> pd.DataFrame:
-        """Читает Excel файл с диалогами или HTML файл"""
+    def load_dataframe(self, file_path: str, verbose: bool = False) -> pd.DataFrame:
+        """Загружает таблицу с диалогами из Excel или HTML файла, ошибки пробрасывает наверх"""
+        # Проверяем по первым байтам, это HTML файл
+        if self.is_html_file(file_path):
+            # Это HTML файл - читаем как HTML таблицу
+            if verbose:
+                print("🔍 Обнаружен HTML файл, читаем как таблицу...")
+            tables = pd.read_html(file_path, encoding='utf-8')
+            
+            if not tables:
+                raise ValueError("HTML таблицы не найдены")
+            
+            # Берем первую таблицу (обычно самую большую)
+            return tables[0]
+        
+        # Настоящий Excel файл
+        if verbose:
+            print("🔍 Обнаружен Excel файл...")
+        if file_path.lower().endswith('.xls'):
+            return pd.read_excel(file_path, engine='xlrd')
+        return pd.read_excel(file_path, engine='openpyxl')
+    
+    def is_html_file(self, file_path: str) -> bool:
+        """Проверяет, является ли файл HTML выгрузкой с расширением .xls"""
+        with open(file_path, 'rb') as f:
+            first_bytes = f.read(10)
+        return first_bytes.startswith(b'\xef\xbb\xbf<html') or first_bytes.startswith(b'<html') or first_bytes.startswith(b'<!DOCTYPE')
+    
+    def iter_rows(self, file_path: str) -> Iterator[Tuple[int, Dict[str, Any]]]:
+        """
+        Построчно читает таблицу с диалогами, не загружая ее целиком.
+        
+        Возвращает пары (индекс строки, {колонка: значение}) - индекс совпадает
+        с индексом DataFrame, который вернул бы load_dataframe.
+        """
+        if self.is_html_file(file_path):
+            yield from self.iter_html_rows(file_path)
+        elif file_path.lower().endswith('.xls'):
+            # xlrd не умеет читать построчно - старый .xls читаем через pandas
+            yield from self.load_dataframe(file_path).iterrows()
+        else:
+            yield from self.iter_xlsx_rows(file_path)
+    
+    def iter_xlsx_rows(self, file_path: str) -> Iterator[Tuple[int, Dict[str, Any]]]:
+        """Читает .xlsx построчно в режиме read-only openpyxl"""
+        workbook = openpyxl.load_workbook(file_path, read_only=True, data_only=True)
         try:
-            # Читаем первые байты файла для определения типа
-            with open(file_path, 'rb') as f:
-                first_bytes = f.read(10)
+            sheet = workbook.worksheets[0]
+            rows = sheet.iter_rows(values_only=True)
+            header = next(rows, None)
+            if header is None:
+                return
+            columns = [str(name) if name is not None else '' for name in header]
             
-            # Проверяем, это HTML файл
-            if first_bytes.startswith(b'\xef\xbb\xbf<html') or first_bytes.startswith(b'<html') or first_bytes.startswith(b'<!DOCTYPE'):
-                # Это HTML файл - читаем как HTML таблицу
-                print("🔍 Обнаружен HTML файл, читаем как таблицу...")
-                tables = pd.read_html(file_path, encoding='utf-8')
-                
-                if not tables:
-                    raise ValueError("HTML таблицы не найдены")
-                
-                # Берем первую таблицу (обычно самую большую)
-                df = tables[0]
+            for idx, values in enumerate(rows):
+                yield idx, dict(zip(columns, values))
+        finally:
+            workbook.close()
+    
+    def iter_html_rows(self, file_path: str) -> Iterator[Tuple[int, Dict[str, Any]]]:
+        """Инкрементально разбирает только первую HTML таблицу, освобождая обработанные строки"""
+        columns = None
+        cells = []
+        table_depth = 0
+        idx = 0
+        
+        for event, element in etree.iterparse(file_path, events=('start', 'end'), html=True, encoding='utf-8'):
+            tag = element.tag if isinstance(element.tag, str) else ''
+            
+            if event == 'start':
+                if tag == 'table':
+                    table_depth += 1
+                continue
+            
+            if tag == 'table':
+                table_depth -= 1
+                if table_depth == 0:
+                    break  # Остальные таблицы не нужны
+            elif table_depth != 1:
+                continue  # Вложенные таблицы и все вне первой таблицы пропускаем
+            elif tag in ('td', 'th'):
+                cells.append(self._html_cell_value(' '.join(element.itertext())))
+            elif tag == 'tr':
+                if columns is None:
+                    columns = [str(value) for value in cells]
+                elif cells:
+                    yield idx, dict(zip(columns, cells))
+                    idx += 1
+                cells = []
                 
-            else:
-                # Настоящий Excel файл
-                print("🔍 Обнаружен Excel файл...")
-                if file_path.lower().endswith('.xls'):
-                    df = pd.read_excel(file_path, engine='xlrd')
-                else:
-                    df = pd.read_excel(file_path, engine='openpyxl')
+                # Освобождаем уже разобранные строки
+                element.clear()
+                while element.getprevious() is not None:
+                    del element.getparent()[0]
+        
+        if columns is None:
+            raise ValueError("HTML таблицы не найдены")
+    
+    def _html_cell_value(self, text: str):
+        """Приводит текст ячейки к тому же виду, что и pd.read_html (пустые - None, числа - int)"""
+        text = text.strip()
+        if not text:
+            return None
+        if text.isdigit():
+            return int(text)
+        return text
+    
+    def read_excel_file(self, file_path: str) -> pd.DataFrame:
+        """Читает Excel файл с диалогами или HTML файл"""
+        try:
+            df = self.load_dataframe(file_path, verbose=True)
             
             print(f"✅ Файл загружен: {len(df)} строк")
             print(f"📋 Колонки: {list(df.columns)}")
@@ -137,120 +246,165 @@ class DialogueProcessor:
             return False
         
         # Проверяем, что это действительно вопрос
-        question_indicators = ['?', 'как', 'что', 'где', 'когда', 'сколько', 'можно', 'есть']
-        has_question_indicator = any(indicator in question.lower() for indicator in question_indicators)
+        has_question_indicator = any(indicator in question.lower() for indicator in self.QUESTION_INDICATORS)
         
         # Проверяем, что ответ информативный
-        bad_answers = ['да', 'нет', 'хорошо', 'ок', 'понятно', 'спасибо']
-        is_bad_answer = answer.lower().strip() in bad_answers
+        is_bad_answer = answer.lower().strip() in self.BAD_ANSWERS
         
         return has_question_indicator and not is_bad_answer
     
-    def extract_full_dialogues(self, df: pd.DataFrame) -> List[Dict]:
-        """Извлекает ПОЛНЫЕ диалоги, а не отдельные Q&A пары"""
-        full_dialogues = []
+    def build_dialogue(self, idx, row) -> Dict:
+        """Собирает диалог из строки таблицы, возвращает None для пустых строк"""
+        client_name = str(row.get('Клиент', ''))
+        dialogue_text = row.get('Диалог (Demo)', '')
         
-        print(f"\n🔍 Анализируем {len(df)} диалогов...")
+        if not dialogue_text:
+            return None
         
-        for idx, row in df.iterrows():
-            client_name = str(row.get('Клиент', ''))
-            dialogue_text = row.get('Диалог (Demo)', '')
-            
-            if not dialogue_text:
-                continue
-            
-            messages = self.parse_dialogue(dialogue_text, client_name)
-            
-            if len(messages) == 0:
-                continue  # Пропускаем только пустые диалоги
-                
-            # Сохраняем ВЕСЬ диалог целиком
-            full_dialogues.append({
-                'dialogue_id': row.get('№', idx),
-                'client': client_name,
-                'operator': messages[0]['speaker'] if not messages[0]['is_client'] else (messages[1]['speaker'] if len(messages) > 1 else 'Unknown'),
-                'messages': messages,
-                'message_count': len(messages)
-            })
+        messages = self.parse_dialogue(dialogue_text, client_name)
         
-        return full_dialogues
-    
-    def save_to_json(self, full_dialogues: List[Dict], output_file: str):
-        """Сохраняет полные диалоги в JSON"""
-        output_data = {
-            'meta': {
-                'total_dialogues': len(full_dialogues),
-                'total_messages': sum(d['message_count'] for d in full_dialogues),
-                'generated_by': 'DialogueProcessor v2.0'
-            },
-            'dialogues': full_dialogues
+        if len(messages) == 0:
+            return None  # Пропускаем только пустые диалоги
+        
+        dialogue_id = row.get('№', idx)
+        
+        # Сохраняем ВЕСЬ диалог целиком
+        return {
+            'dialogue_id': idx if dialogue_id is None else dialogue_id,
+            'client': client_name,
+            'operator': messages[0]['speaker'] if not messages[0]['is_client'] else (messages[1]['speaker'] if len(messages) > 1 else 'Unknown'),
+            'messages': messages,
+            'message_count': len(messages),
+            'topics': self.topic_tagger.tag_dialogue(messages)
         }
+    
+    def iter_dialogues(self, rows: Iterable[Tuple[int, Any]]) -> Iterator[Dict]:
+        """Потоково превращает строки таблицы в диалоги"""
+        for idx, row in rows:
+            dialogue = self.build_dialogue(idx, row)
+            if dialogue is not None:
+                yield dialogue
+    
+    def extract_full_dialogues(self, df: pd.DataFrame, verbose: bool = True) -> List[Dict]:
+        """Извлекает ПОЛНЫЕ диалоги, а не отдельные Q&A пары"""
+        if verbose:
+            print(f"\n🔍 Анализируем {len(df)} диалогов...")
         
-        with open(output_file, 'w', encoding='utf-8') as f:
-            json.dump(output_data, f, ensure_ascii=False, indent=2)
+        return list(self.iter_dialogues(df.iterrows()))
+    
+    def save_to_json(self, full_dialogues: Iterable[Dict], output_file: str):
+        """Сохраняет полные диалоги в JSON"""
+        with DialogueJsonWriter(output_file) as writer:
+            for dialogue in full_dialogues:
+                writer.write(dialogue)
         
         print(f"✅ JSON файл сохранен в {output_file}")
     
-    def save_to_txt(self, full_dialogues: List[Dict], output_file: str):
+    def save_to_txt(self, full_dialogues: Iterable[Dict], output_file: str):
         """Сохраняет ПОЛНЫЕ диалоги в TXT для загрузки в Vector Store"""
-        
-        with open(output_file, 'w', encoding='utf-8') as f:
-            f.write("База знаний из реальных диалогов клиентов Web2Print\n\n")
-            f.write("КЛЮЧЕВЫЕ СЛОВА: полиграфия, печать, сроки, цены, материалы, дизайн, клиенты, заказы\n\n")
-            
-            for i, dialogue in enumerate(full_dialogues, 1):
-                f.write(f"ДИАЛОГ {i} - ID {dialogue['dialogue_id']}\n")
-                f.write(f"Клиент: {dialogue['client']}\n")
-                f.write(f"Оператор: {dialogue['operator']}\n")
-                f.write(f"Количество сообщений: {dialogue['message_count']}\n\n")
-                
-                f.write("ПОЛНЫЙ ДИАЛОГ:\n")
-                
-                # Записываем ВСЕ сообщения по порядку
-                for msg in dialogue['messages']:
-                    role = "Клиент" if msg['is_client'] else "Оператор"
-                    f.write(f"{role}: {msg['text']}\n")
-                
-                f.write("\n")
-                
-                # Анализируем ТОЛЬКО общие бизнес-темы диалога (БЕЗ продукции)
-                topics = set()
-                dialogue_text = " ".join([msg['text'].lower() for msg in dialogue['messages']])
-                
-                if any(word in dialogue_text for word in ['цена', 'стоимость', 'сколько', 'стоит', 'рубл', 'сум']):
-                    topics.add('Ценообразование')
-                if any(word in dialogue_text for word in ['срок', 'время', 'когда', 'готов', 'день', 'час']):
-                    topics.add('Сроки изготовления')
-                if any(word in dialogue_text for word in ['размер', 'формат', 'сантиметр', 'мм', 'см']):
-                    topics.add('Технические характеристики')
-                if any(word in dialogue_text for word in ['дизайн', 'макет', 'файл', 'картинк', 'изображен']):
-                    topics.add('Дизайн и макеты')
-                if any(word in dialogue_text for word in ['доставк', 'самовывоз', 'привез', 'курьер']):
-                    topics.add('Доставка')
-                if any(word in dialogue_text for word in ['оплат', 'плат', 'счет', 'деньг']):
-                    topics.add('Оплата')
-                if any(word in dialogue_text for word in ['материал', 'бумаг', 'ткан', 'качеств']):
-                    topics.add('Материалы')
-                if any(word in dialogue_text for word in ['заказ', 'оформ', 'как получ']):
-                    topics.add('Процесс заказа')
-                
-                f.write("КЛЮЧЕВЫЕ ТЕМЫ: ")
-                if topics:
-                    f.write(f"{', '.join(sorted(topics))}\n\n")
-                else:
-                    f.write("Общие вопросы\n\n")
-                
-                f.write("---\n\n")
-            
-            f.write("ИНФОРМАЦИЯ О БАЗЕ ЗНАНИЙ\n")
-            f.write(f"Всего диалогов: {len(full_dialogues)}\n")
-            f.write(f"Всего сообщений: {sum(d['message_count'] for d in full_dialogues)}\n")
-            f.write(f"Источник: Реальные диалоги клиентов из Битрикс24\n")
-            f.write(f"Компания: Web2Print - полиграфические услуги\n")
-            f.write(f"Обработано автоматически из выгрузки диалогов\n")
+        with KnowledgeBaseTxtWriter(output_file) as writer:
+            for dialogue in full_dialogues:
+                writer.write(dialogue)
         
         print(f"✅ TXT файл сохранен в {output_file}")
     
+    def detect_language(self, dialogue: Dict) -> str:
+        """Определяет язык диалога (ru, uz, en) по сообщениям клиента"""
+        text = " ".join(msg['text'] for msg in dialogue['messages'] if msg['is_client']).lower()
+        if not text:
+            text = " ".join(msg['text'] for msg in dialogue['messages']).lower()
+        
+        cyrillic = len(re.findall(r'[а-яё]', text))
+        latin = len(re.findall(r'[a-z]', text))
+        
+        if cyrillic >= latin:
+            return 'uz' if self.UZBEK_CYRILLIC.search(text) else 'ru'
+        return 'uz' if self.UZBEK_LATIN.search(text) else 'en'
+    
+    def extract_qa_candidates(self, dialogue: Dict) -> List[Dict]:
+        """
+        Составляет пары вопрос-ответ из диалога: подряд идущие сообщения клиента
+        объединяются в вопрос, следующие за ними сообщения оператора - в ответ.
+        """
+        # Склеиваем подряд идущие реплики одной стороны
+        turns = []
+        for msg in dialogue['messages']:
+            if turns and turns[-1][0] == msg['is_client']:
+                turns[-1][1].append(msg['text'])
+            else:
+                turns.append((msg['is_client'], [msg['text']]))
+        
+        candidates = []
+        for (is_client, question_parts), (next_is_client, answer_parts) in zip(turns, turns[1:]):
+            if is_client and not next_is_client:
+                candidates.append({
+                    'dialogue_id': dialogue['dialogue_id'],
+                    'client': dialogue['client'],
+                    'operator': dialogue['operator'],
+                    'question': ' '.join(question_parts),
+                    'answer': ' '.join(answer_parts),
+                    'topics': dialogue['topics']
+                })
+        
+        return candidates
+    
+    def score_qa_pairs(self, pairs: pd.DataFrame) -> pd.Series:
+        """
+        Пакетно оценивает Q&A пары от 0 до 1. Пары, не прошедшие is_good_qa_pair,
+        получают 0; остальные оцениваются по длине и информативности ответа.
+        """
+        questions = pairs['question'].str.lower()
+        answers = pairs['answer'].str.lower().str.strip()
+        question_len = pairs['question'].str.len()
+        answer_len = pairs['answer'].str.len()
+        
+        # Существующие эвристики is_good_qa_pair в векторной форме
+        indicators = '|'.join(re.escape(indicator) for indicator in self.QUESTION_INDICATORS)
+        is_good = (
+            (question_len >= 10) & (answer_len >= 5)
+            & questions.str.contains(indicators, regex=True)
+            & ~answers.isin(self.BAD_ANSWERS)
+        )
+        
+        # Длина: короткие ответы малоинформативны, очень длинные плохо подходят для поиска
+        answer_len_score = (answer_len / 200).clip(upper=1) - ((answer_len - 1500) / 1500).clip(lower=0, upper=1)
+        question_len_score = (question_len / 80).clip(upper=1)
+        
+        # Информативность: доля уникальных слов, числа (цены, размеры, сроки), явный вопрос, темы
+        answer_words = answers.str.findall(r'\w+')
+        unique_ratio = answer_words.map(lambda words: len(set(words)) / len(words) if words else 0.0)
+        has_numbers = answers.str.contains(r'\d', regex=True).astype(float)
+        has_question_mark = questions.str.contains('?', regex=False).astype(float)
+        topics_score = pairs['topics'].map(len).clip(upper=3) / 3
+        
+        score = (
+            0.3 * answer_len_score.clip(lower=0)
+            + 0.15 * question_len_score
+            + 0.2 * unique_ratio
+            + 0.15 * has_numbers
+            + 0.1 * has_question_mark
+            + 0.1 * topics_score
+        )
+        return score.where(is_good, 0.0).round(3)
+    
+    def rank_qa_pairs(self, candidates: List[Dict], min_score: float = 0.3, limit: int = None) -> List[Dict]:
+        """Оценивает все пары разом, убирает повторы и возвращает лучшие по убыванию оценки"""
+        if not candidates:
+            return []
+        
+        pairs = pd.DataFrame(candidates)
+        pairs['score'] = self.score_qa_pairs(pairs)
+        pairs = pairs[pairs['score'] >= min_score]
+        
+        # Одинаковые пары из разных диалогов оставляем один раз
+        pairs = pairs.sort_values('score', ascending=False, kind='mergesort')
+        pairs = pairs.loc[~pairs[['question', 'answer']].apply(lambda col: col.str.lower()).duplicated()]
+        
+        if limit:
+            pairs = pairs.head(limit)
+        
+        return pairs.to_dict('records')
+    
     def print_statistics(self, qa_pairs: List[Dict]):
         """Выводит статистику по извлеченным парам"""
         print(f"\n📊 СТАТИСТИКА:")
@@ -272,6 +426,566 @@ class DialogueProcessor:
         full_dialogues = self.extract_full_dialogues(df)
         
         return full_dialogues
+    
+    def stream_file(self, input_file: str) -> Iterator[Dict]:
+        """Потоковая обработка файла: строки читаются и разбираются по одной"""
+        return self.iter_dialogues(self.iter_rows(input_file))
+
+class DialogueJsonWriter:
+    """
+    Пишет JSON с диалогами инкрементально, не держа их все в памяти.
+    
+    Итоговые счетчики известны только в конце, поэтому блок meta
+    записывается после списка dialogues.
+    """
+    
+    def __init__(self, output_file: str):
+        self.output_file = output_file
+        self.total_dialogues = 0
+        self.total_messages = 0
+        self._file = None
+    
+    def __enter__(self):
+        self._file = open(self.output_file, 'w', encoding='utf-8')
+        self._file.write('{\n  "dialogues": [')
+        return self
+    
+    def write(self, dialogue: Dict):
+        separator = ',\n' if self.total_dialogues else '\n'
+        body = json.dumps(dialogue, ensure_ascii=False, indent=2).replace('\n', '\n    ')
+        self._file.write(f"{separator}    {body}")
+        
+        self.total_dialogues += 1
+        self.total_messages += dialogue['message_count']
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        meta = {
+            'total_dialogues': self.total_dialogues,
+            'total_messages': self.total_messages,
+            'generated_by': 'DialogueProcessor v2.0'
+        }
+        meta_body = json.dumps(meta, ensure_ascii=False, indent=2).replace('\n', '\n  ')
+        closing = '\n  ]' if self.total_dialogues else ']'
+        self._file.write(f'{closing},\n  "meta": {meta_body}\n}}\n')
+        self._file.close()
+        return False
+
+# Заголовок TXT базы знаний (общий для целого файла и для частей)
+KNOWLEDGE_BASE_HEADER = (
+    "База знаний из реальных диалогов клиентов Web2Print\n\n"
+    "КЛЮЧЕВЫЕ СЛОВА: полиграфия, печать, сроки, цены, материалы, дизайн, клиенты, заказы\n\n"
+)
+
+def format_dialogue_block(number: int, dialogue: Dict) -> str:
+    """Форматирует диалог для TXT базы знаний"""
+    lines = [
+        f"ДИАЛОГ {number} - ID {dialogue['dialogue_id']}",
+        f"Клиент: {dialogue['client']}",
+        f"Оператор: {dialogue['operator']}",
+        f"Количество сообщений: {dialogue['message_count']}",
+        "",
+        "ПОЛНЫЙ ДИАЛОГ:"
+    ]
+    
+    # Записываем ВСЕ сообщения по порядку
+    for msg in dialogue['messages']:
+        role = "Клиент" if msg['is_client'] else "Оператор"
+        lines.append(f"{role}: {msg['text']}")
+    
+    # Общие бизнес-темы диалога (БЕЗ продукции), размечены TopicTagger при разборе
+    topics = dialogue['topics']
+    lines.append("")
+    lines.append(f"КЛЮЧЕВЫЕ ТЕМЫ: {', '.join(topics) if topics else DEFAULT_TOPIC}")
+    lines.append("")
+    lines.append("---")
+    
+    return "\n".join(lines) + "\n\n"
+
+class KnowledgeBaseTxtWriter:
+    """Пишет TXT базу знаний для Vector Store по одному диалогу"""
+    
+    def __init__(self, output_file: str):
+        self.output_file = output_file
+        self.total_dialogues = 0
+        self.total_messages = 0
+        self._file = None
+    
+    def __enter__(self):
+        self._file = open(self.output_file, 'w', encoding='utf-8')
+        self._file.write(KNOWLEDGE_BASE_HEADER)
+        return self
+    
+    def write(self, dialogue: Dict):
+        self.total_dialogues += 1
+        self.total_messages += dialogue['message_count']
+        self._file.write(format_dialogue_block(self.total_dialogues, dialogue))
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        f = self._file
+        f.write("ИНФОРМАЦИЯ О БАЗЕ ЗНАНИЙ\n")
+        f.write(f"Всего диалогов: {self.total_dialogues}\n")
+        f.write(f"Всего сообщений: {self.total_messages}\n")
+        f.write(f"Источник: Реальные диалоги клиентов из Битрикс24\n")
+        f.write(f"Компания: Web2Print - полиграфические услуги\n")
+        f.write(f"Обработано автоматически из выгрузки диалогов\n")
+        f.close()
+        return False
+
+class ChunkedKnowledgeBaseWriter:
+    """
+    Пишет базу знаний частями не больше max_bytes, разбивая только по границам диалогов.
+    
+    Рядом с каждой частью лежит <часть>.meta.json (ID диалогов, темы, операторы, языки),
+    а manifest.json перечисляет все части с размером и SHA-256 - по нему видно,
+    какие части изменились и требуют повторной загрузки. Диалог больше max_bytes
+    попадает в отдельную часть целиком.
+    
+    Диалоги нумеруются внутри части: новый диалог не меняет текст (и хэш) других частей.
+    Части пишутся во временную директорию рядом и заменяют части прошлого запуска только
+    после успешного запуска (лишние прошлые части удаляются). Прерванный запуск оставляет
+    прежние части и manifest.json как были.
+    """
+    
+    def __init__(self, processor: DialogueProcessor, chunks_dir: str, base_name: str, max_bytes: int):
+        self.processor = processor
+        self.chunks_dir = chunks_dir
+        self.base_name = base_name
+        self.max_bytes = max_bytes
+        self.manifest_path = os.path.join(chunks_dir, 'manifest.json')
+        self.chunks = []
+        self.total_dialogues = 0
+        self._file = None
+    
+    def __enter__(self):
+        os.makedirs(self.chunks_dir, exist_ok=True)
+        # Скрытая директория: ее не подхватит синхронизация Vector Store (glob пропускает .имена)
+        self._staging_dir = tempfile.mkdtemp(prefix=f".{os.path.basename(self.chunks_dir)}.",
+                                             dir=os.path.dirname(os.path.abspath(self.chunks_dir)))
+        return self
+    
+    def _open_chunk(self):
+        number = len(self.chunks) + 1
+        self._chunk_name = f"{self.base_name}_kb_{number:04d}.txt"
+        self._file = open(os.path.join(self._staging_dir, self._chunk_name), 'wb')
+        self._digest = hashlib.sha256()
+        self._size = 0
+        self._meta = {
+            'chunk': number,
+            'file': self._chunk_name,
+            'dialogue_ids': [],
+            'message_count': 0,
+            'topics': Counter(),
+            'operators': Counter(),
+            'languages': Counter()
+        }
+        self._write_bytes(KNOWLEDGE_BASE_HEADER.encode('utf-8'))
+    
+    def _write_bytes(self, data: bytes):
+        self._file.write(data)
+        self._digest.update(data)
+        self._size += len(data)
+    
+    def _close_chunk(self):
+        self._file.close()
+        self._file = None
+        
+        meta = dict(self._meta)
+        meta['bytes'] = self._size
+        meta['sha256'] = self._digest.hexdigest()
+        meta['dialogue_count'] = len(meta['dialogue_ids'])
+        for key in ('topics', 'operators', 'languages'):
+            meta[key] = dict(meta[key].most_common())
+        
+        meta_name = self._chunk_name[:-len('.txt')] + '.meta.json'
+        with open(os.path.join(self._staging_dir, meta_name), 'w', encoding='utf-8') as f:
+            json.dump(meta, f, ensure_ascii=False, indent=2)
+        
+        self.chunks.append({
+            'chunk': meta['chunk'],
+            'file': meta['file'],
+            'meta_file': meta_name,
+            'bytes': meta['bytes'],
+            'sha256': meta['sha256'],
+            'dialogue_count': meta['dialogue_count'],
+            'first_dialogue_id': meta['dialogue_ids'][0],
+            'last_dialogue_id': meta['dialogue_ids'][-1]
+        })
+    
+    def write(self, dialogue: Dict):
+        self.total_dialogues += 1
+        number = len(self._meta['dialogue_ids']) + 1 if self._file is not None else 1
+        block = format_dialogue_block(number, dialogue).encode('utf-8')
+        
+        if self._file is not None and self._meta['dialogue_ids'] and self._size + len(block) > self.max_bytes:
+            self._close_chunk()
+            block = format_dialogue_block(1, dialogue).encode('utf-8')
+        if self._file is None:
+            self._open_chunk()
+        
+        self._write_bytes(block)
+        self._meta['dialogue_ids'].append(dialogue['dialogue_id'])
+        self._meta['message_count'] += dialogue['message_count']
+        self._meta['topics'].update(dialogue['topics'] or [DEFAULT_TOPIC])
+        self._meta['operators'][dialogue['operator']] += 1
+        self._meta['languages'][self.processor.detect_language(dialogue)] += 1
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        # Прерванный запуск не заменяет части прошлого запуска неполным набором
+        if exc_type is not None:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            shutil.rmtree(self._staging_dir, ignore_errors=True)
+            return False
+        
+        if self._file is not None:
+            self._close_chunk()
+        
+        stale = glob.glob(os.path.join(glob.escape(self.chunks_dir), f"{glob.escape(self.base_name)}_kb_*"))
+        for path in stale + [self.manifest_path]:
+            if os.path.isfile(path):
+                os.remove(path)
+        for name in os.listdir(self._staging_dir):
+            os.replace(os.path.join(self._staging_dir, name), os.path.join(self.chunks_dir, name))
+        os.rmdir(self._staging_dir)
+        
+        # manifest.json - последним: по нему видно, что набор частей полный
+        with open(self.manifest_path, 'w', encoding='utf-8') as f:
+            json.dump({
+                'base_name': self.base_name,
+                'max_bytes': self.max_bytes,
+                'total_chunks': len(self.chunks),
+                'total_dialogues': self.total_dialogues,
+                'generated_at': datetime.now().isoformat(),
+                'chunks': self.chunks
+            }, f, ensure_ascii=False, indent=2)
+        return False
+
+class ParquetMessagesWriter:
+    """
+    Пишет сообщения в Parquet (одна строка на сообщение) группами строк,
+    не держа всю выгрузку в памяти. Требует pyarrow.
+    """
+    
+    def __init__(self, output_file: str, row_group_size: int = 100000):
+        self.output_file = output_file
+        self.row_group_size = row_group_size
+        self.total_rows = 0
+        self._writer = None
+        self._columns = None
+    
+    def __enter__(self):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        
+        self._pa = pa
+        self._schema = pa.schema([
+            ('dialogue_id', pa.string()),
+            ('message_index', pa.int32()),
+            ('speaker', pa.string()),
+            ('is_client', pa.bool_()),
+            ('text', pa.string()),
+            ('topics', pa.list_(pa.string()))
+        ])
+        self._writer = pq.ParquetWriter(self.output_file, self._schema, compression='zstd')
+        self._reset_columns()
+        return self
+    
+    def _reset_columns(self):
+        self._columns = {name: [] for name in self._schema.names}
+    
+    def _flush(self):
+        if self._columns['text']:
+            self._writer.write_table(self._pa.Table.from_pydict(self._columns, schema=self._schema))
+            self._reset_columns()
+    
+    def write(self, dialogue: Dict):
+        # ID бывают и числами, и строками - в Parquet храним строкой
+        dialogue_id = str(dialogue['dialogue_id'])
+        for i, msg in enumerate(dialogue['messages']):
+            self._columns['dialogue_id'].append(dialogue_id)
+            self._columns['message_index'].append(i)
+            self._columns['speaker'].append(msg['speaker'])
+            self._columns['is_client'].append(msg['is_client'])
+            self._columns['text'].append(msg['text'])
+            self._columns['topics'].append(dialogue['topics'])
+        
+        self.total_rows += len(dialogue['messages'])
+        if len(self._columns['text']) >= self.row_group_size:
+            self._flush()
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._flush()
+        self._writer.close()
+        return False
+
+class JsonLinesWriter:
+    """Пишет диалоги в сжатый JSON Lines (один диалог на строку) для потоковых потребителей"""
+    
+    EXTENSIONS = {'gzip': '.jsonl.gz', 'zstd': '.jsonl.zst'}
+    
+    def __init__(self, output_file: str, compression: str = 'gzip'):
+        self.output_file = output_file
+        self.compression = compression
+        self.total_dialogues = 0
+        self._file = None
+        self._raw = None
+    
+    def __enter__(self):
+        if self.compression == 'zstd':
+            import zstandard
+            
+            self._raw = open(self.output_file, 'wb')
+            binary = zstandard.ZstdCompressor(level=3).stream_writer(self._raw)
+        else:
+            binary = gzip.open(self.output_file, 'wb', compresslevel=6)
+        self._file = io.TextIOWrapper(binary, encoding='utf-8')
+        return self
+    
+    def write(self, dialogue: Dict):
+        self._file.write(json.dumps(dialogue, ensure_ascii=False))
+        self._file.write('\n')
+        self.total_dialogues += 1
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._file.close()
+        if self._raw is not None:
+            self._raw.close()
+        return False
+
+class TopicIndexWriter:
+    """Собирает обратный индекс тема -> ID диалогов и сохраняет его рядом с базой знаний"""
+    
+    def __init__(self, output_file: str):
+        self.output_file = output_file
+        self.index = {}
+    
+    def __enter__(self):
+        return self
+    
+    def write(self, dialogue: Dict):
+        for topic in dialogue['topics'] or [DEFAULT_TOPIC]:
+            self.index.setdefault(topic, []).append(dialogue['dialogue_id'])
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        output_data = {
+            topic: {'count': len(dialogue_ids), 'dialogue_ids': dialogue_ids}
+            for topic, dialogue_ids in sorted(self.index.items())
+        }
+        # Без отступов: списки ID могут быть очень длинными
+        with open(self.output_file, 'w', encoding='utf-8') as f:
+            json.dump(output_data, f, ensure_ascii=False)
+        return False
+
+class QaPairsWriter:
+    """
+    Собирает кандидатов в Q&A пары по мере записи диалогов, а при закрытии
+    ранжирует их одним пакетом и сохраняет компактную базу знаний (TXT) и JSON с оценками.
+    """
+    
+    def __init__(self, processor: DialogueProcessor, txt_file: str, json_file: str, min_score: float = 0.3, limit: int = None):
+        self.processor = processor
+        self.txt_file = txt_file
+        self.json_file = json_file
+        self.min_score = min_score
+        self.limit = limit
+        self.candidates = []
+        self.qa_pairs = []
+    
+    def __enter__(self):
+        return self
+    
+    def write(self, dialogue: Dict):
+        self.candidates.extend(self.processor.extract_qa_candidates(dialogue))
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            return False
+        
+        self.qa_pairs = self.processor.rank_qa_pairs(self.candidates, self.min_score, self.limit)
+        self.processor.qa_pairs = self.qa_pairs
+        
+        with open(self.json_file, 'w', encoding='utf-8') as f:
+            json.dump({
+                'meta': {
+                    'candidates': len(self.candidates),
+                    'total_pairs': len(self.qa_pairs),
+                    'min_score': self.min_score,
+                    'generated_by': 'DialogueProcessor v2.0'
+                },
+                'qa_pairs': self.qa_pairs
+            }, f, ensure_ascii=False, indent=2)
+        
+        with open(self.txt_file, 'w', encoding='utf-8') as f:
+            f.write("Вопросы и ответы из реальных диалогов клиентов Web2Print\n\n")
+            
+            for qa in self.qa_pairs:
+                f.write(f"ВОПРОС: {qa['question']}\n")
+                f.write(f"ОТВЕТ: {qa['answer']}\n")
+                f.write(f"ТЕМЫ: {', '.join(qa['topics']) or DEFAULT_TOPIC}\n")
+                f.write("---\n\n")
+            
+            f.write(f"Всего пар: {len(self.qa_pairs)}\n")
+            f.write("Источник: Реальные диалоги клиентов из Битрикс24\n")
+        
+        return False
+
+class SimilarityIndexWriter:
+    """
+    Строит индекс похожих вопросов клиентов (similarity_index.py) для бота: каждая
+    пара вопрос клиента - ответ оператора становится записью индекса. Индекс публикуется
+    только после успешного запуска.
+    """
+    
+    # Короче - приветствия и реплики без содержания
+    MIN_QUESTION_LENGTH = 10
+    MAX_TEXT_LENGTH = 500
+    
+    def __init__(self, processor: DialogueProcessor, index_dir: str):
+        self.processor = processor
+        self.index_dir = index_dir
+        self.builder = None
+    
+    def __enter__(self):
+        self.builder = SimilarityIndexBuilder(self.index_dir)
+        return self
+    
+    def write(self, dialogue: Dict):
+        for pair in self.processor.extract_qa_candidates(dialogue):
+            if len(pair['question']) < self.MIN_QUESTION_LENGTH or pair['answer'].lower().strip() in self.processor.BAD_ANSWERS:
+                continue
+            self.builder.add(pair['question'], {
+                'dialogue_id': pair['dialogue_id'],
+                'operator': pair['operator'],
+                'topics': pair['topics'],
+                'question': pair['question'][:self.MAX_TEXT_LENGTH],
+                'answer': pair['answer'][:self.MAX_TEXT_LENGTH]
+            })
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        # Прерванный запуск не заменяет рабочий индекс частичным
+        if exc_type is None:
+            self.builder.close()
+            self.builder.publish()
+        else:
+            self.builder.discard()
+        return False
+
+class DialogueCache:
+    """
+    Кэш разобранных диалогов для инкрементальной пересборки базы знаний.
+    
+    Результат разбора каждого файла хранится в <sha256>.jsonl (один диалог на строку),
+    manifest.json связывает хэш содержимого с файлом кэша. Файл кэша и манифест
+    обновляются атомарно после каждого файла, поэтому прерванный запуск
+    продолжается с последнего сохраненного файла. После успешного запуска prune()
+    удаляет файлы кэша удаленных и измененных выгрузок.
+    """
+    
+    MANIFEST_NAME = 'manifest.json'
+    # Увеличивается при изменении формата разобранных диалогов (v2 - добавлены topics)
+    VERSION = 2
+    
+    def __init__(self, cache_dir: str):
+        self.cache_dir = cache_dir
+        self.manifest_path = os.path.join(cache_dir, self.MANIFEST_NAME)
+        os.makedirs(cache_dir, exist_ok=True)
+        self.manifest = self._load_manifest()
+        self.files_reused = 0
+        self.files_parsed = 0
+        # Хэши файлов текущего запуска
+        self.run_hashes = set()
+    
+    def _load_manifest(self) -> Dict:
+        if os.path.exists(self.manifest_path):
+            try:
+                with open(self.manifest_path, 'r', encoding='utf-8') as f:
+                    manifest = json.load(f)
+                if manifest.get('version') == self.VERSION:
+                    return manifest
+                print("⚠️ Кэш создан старой версией, файлы будут разобраны заново")
+            except (json.JSONDecodeError, IOError) as e:
+                print(f"⚠️ Манифест кэша поврежден, начинаем заново: {e}")
+        return {'version': self.VERSION, 'files': {}}
+    
+    def _save_manifest(self):
+        tmp_path = self.manifest_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.manifest, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.manifest_path)
+    
+    @staticmethod
+    def file_hash(file_path: str) -> str:
+        """Считает SHA-256 содержимого файла блоками по 1 МБ"""
+        digest = hashlib.sha256()
+        with open(file_path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(block)
+        return digest.hexdigest()
+    
+    def _cache_path(self, file_hash: str) -> str:
+        return os.path.join(self.cache_dir, f"{file_hash}.jsonl")
+    
+    def lookup(self, file_hash: str) -> Dict:
+        """Возвращает запись манифеста для хэша, если файл кэша на месте"""
+        entry = self.manifest['files'].get(file_hash)
+        if entry and os.path.exists(self._cache_path(file_hash)):
+            return entry
+        return None
+    
+    def store(self, file_path: str, file_hash: str, dialogues: Iterable[Dict]) -> Dict:
+        """Сохраняет разобранные диалоги файла в кэш и фиксирует их в манифесте"""
+        cache_path = self._cache_path(file_hash)
+        tmp_path = cache_path + '.tmp'
+        dialogues_count = 0
+        messages_count = 0
+        
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for dialogue in dialogues:
+                f.write(json.dumps(dialogue, ensure_ascii=False))
+                f.write('\n')
+                dialogues_count += 1
+                messages_count += dialogue['message_count']
+        os.replace(tmp_path, cache_path)
+        
+        entry = {
+            'filename': os.path.basename(file_path),
+            'full_path': file_path,
+            'dialogues': dialogues_count,
+            'messages': messages_count,
+            'processed_at': datetime.now().isoformat()
+        }
+        self.manifest['files'][file_hash] = entry
+        self._save_manifest()
+        return entry
+    
+    def prune(self, keep_hashes: Iterable[str] = None) -> int:
+        """
+        Убирает из манифеста хэши не из keep_hashes (если он задан) и удаляет файлы кэша,
+        которых нет в манифесте. Возвращает число удаленных файлов.
+        """
+        if keep_hashes is not None:
+            keep_hashes = set(keep_hashes)
+            stale = [file_hash for file_hash in self.manifest['files'] if file_hash not in keep_hashes]
+            for file_hash in stale:
+                del self.manifest['files'][file_hash]
+            if stale:
+                self._save_manifest()
+        
+        removed = 0
+        for name in os.listdir(self.cache_dir):
+            file_hash, ext = name.split('.', 1) if '.' in name else (name, '')
+            if ext in ('jsonl', 'jsonl.tmp') and file_hash not in self.manifest['files']:
+                os.remove(os.path.join(self.cache_dir, name))
+                removed += 1
+        return removed
+    
+    def iter_dialogues(self, file_hash: str) -> Iterator[Dict]:
+        """Построчно читает закэшированные диалоги файла"""
+        with open(self._cache_path(file_hash), 'r', encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
 
 def find_excel_files(directory='.'):
     """Находит все Excel файлы в директории"""
@@ -290,13 +1004,209 @@ def create_output_directory():
     os.makedirs(output_dir, exist_ok=True)
     return output_dir
 
+def make_file_info(file_path: str, dialogues_count: int = 0, messages_count: int = 0, error: str = None,
+                   duplicates_dropped: int = None) -> Dict:
+    """Формирует запись о файле для processing_info.json"""
+    file_info = {
+        'filename': os.path.basename(file_path),
+        'full_path': file_path,
+        'dialogues_extracted': dialogues_count,
+        'messages_extracted': messages_count,
+        'status': 'error' if error is not None else 'success'
+    }
+    if duplicates_dropped is not None:
+        file_info['duplicates_dropped'] = duplicates_dropped
+    if error is not None:
+        file_info['error'] = error
+    return file_info
+
+def _load_file_worker(file_path: str) -> pd.DataFrame:
+    """Читает файл в дочернем процессе (режим --workers)"""
+    return DialogueProcessor().load_dataframe(file_path)
+
+def _extract_chunk_worker(df_chunk: pd.DataFrame) -> List[Dict]:
+    """Извлекает диалоги из части строк таблицы в дочернем процессе (режим --workers)"""
+    return DialogueProcessor().extract_full_dialogues(df_chunk, verbose=False)
+
+def split_into_chunks(df: pd.DataFrame, chunk_size: int) -> List[pd.DataFrame]:
+    """Делит таблицу на части по chunk_size строк, сохраняя исходный индекс"""
+    return [df.iloc[start:start + chunk_size] for start in range(0, len(df), chunk_size)]
+
+def process_files_parallel(files_to_process: List[str], workers: int, chunk_size: int) -> List[Tuple[str, List[Dict], str]]:
+    """
+    Обрабатывает файлы пулом процессов: чтение файлов идет параллельно,
+    а строки каждого файла разбиваются на части по chunk_size и парсятся независимо.
+    
+    Возвращает список (file_path, dialogues, error) в порядке files_to_process,
+    диалоги внутри файла идут в том же порядке, что и при последовательной обработке.
+    """
+    return list(iter_files_parallel(files_to_process, workers, chunk_size))
+
+def iter_files_parallel(files_to_process: List[str], workers: int, chunk_size: int,
+                        ordered: bool = True) -> Iterator[Tuple[str, List[Dict], str]]:
+    """
+    Как process_files_parallel, но отдает (file_path, dialogues, error) по мере готовности файлов:
+    в порядке files_to_process или, если ordered=False, в порядке завершения разбора.
+    """
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # Сначала читаем все файлы параллельно
+        load_futures = [executor.submit(_load_file_worker, file_path) for file_path in files_to_process]
+        
+        # По мере загрузки раздаем части строк на парсинг
+        chunk_futures = []
+        for file_path, load_future in zip(files_to_process, load_futures):
+            try:
+                df = load_future.result()
+            except Exception as e:
+                chunk_futures.append((file_path, None, f"Ошибка загрузки файла: {e}"))
+                continue
+            
+            chunks = split_into_chunks(df, chunk_size)
+            print(f"🔄 {os.path.basename(file_path)}: {len(df)} строк, частей: {len(chunks)}")
+            chunk_futures.append((file_path, [executor.submit(_extract_chunk_worker, chunk) for chunk in chunks], None))
+        
+        if not ordered:
+            # Файл готов, когда разобраны все его части (или одна из них упала)
+            owners = {}
+            for index, (file_path, futures, error) in enumerate(chunk_futures):
+                if error is not None or not futures:
+                    yield _collect_file_result(file_path, futures, error)
+                    continue
+                for future in futures:
+                    owners[future] = index
+            waiting = set(owners)
+            while waiting:
+                finished, waiting = wait(waiting, return_when=FIRST_COMPLETED)
+                for index in sorted({owners[future] for future in finished}):
+                    file_path, futures, error = chunk_futures[index]
+                    if futures is None:
+                        continue
+                    if all(future.done() for future in futures) or any(future.done() and future.exception() for future in futures):
+                        waiting.difference_update(futures)
+                        chunk_futures[index] = (file_path, None, None)
+                        yield _collect_file_result(file_path, futures, error)
+            return
+        
+        # Результаты строго в исходном порядке файлов и частей
+        for file_path, futures, error in chunk_futures:
+            yield _collect_file_result(file_path, futures, error)
+
+def _collect_file_result(file_path: str, futures, error: str) -> Tuple[str, List[Dict], str]:
+    """Результат файла из его частей: (file_path, dialogues, error)."""
+    if error is not None:
+        return file_path, [], error
+    
+    dialogues = []
+    try:
+        for future in futures:
+            dialogues.extend(future.result())
+    except Exception as e:
+        for future in futures:
+            future.cancel()
+        return file_path, [], str(e)
+    
+    return file_path, dialogues, None
+
+def iter_file_results(processor: DialogueProcessor, files_to_process: List[str], stream: bool = False) -> Iterator[Tuple[str, Iterable[Dict], str]]:
+    """
+    Последовательно обрабатывает файлы, отдавая (file_path, dialogues, error).
+    
+    В потоковом режиме dialogues - генератор, и ошибки чтения возникают
+    при его обходе (см. spool_dialogues); иначе файл разбирается целиком заранее.
+    """
+    for file_path in files_to_process:
+        print(f"🔄 Обрабатываем: {os.path.basename(file_path)}")
+        
+        if stream:
+            yield file_path, processor.stream_file(file_path), None
+            continue
+        
+        try:
+            dialogues = processor.process_file(file_path)
+        except Exception as e:
+            yield file_path, [], str(e)
+            continue
+        
+        yield file_path, dialogues, None
+
+def spool_dialogues(dialogues: Iterable[Dict], spool_dir: str) -> Iterator[Dict]:
+    """
+    Отдает диалоги по одному, но только после того, как весь поток прочитан во временный
+    JSON Lines файл в spool_dir: ошибка чтения посреди файла возникает до первого диалога,
+    а память, как и в потоковом режиме, не зависит от размера файла.
+    """
+    with tempfile.TemporaryFile('w+', encoding='utf-8', dir=spool_dir, prefix='.spool_') as spool:
+        for dialogue in dialogues:
+            spool.write(json.dumps(dialogue, ensure_ascii=False))
+            spool.write('\n')
+        spool.seek(0)
+        for line in spool:
+            yield json.loads(line)
+
+def iter_incremental_results(processor: DialogueProcessor, files_to_process: List[str], cache: DialogueCache,
+                             workers: int = 1, chunk_size: int = 5000, stream: bool = False) -> Iterator[Tuple[str, Iterable[Dict], str]]:
+    """
+    Инкрементальная обработка: разбираются только новые и измененные файлы,
+    остальные берутся из кэша. Итоговые диалоги читаются из кэша в порядке files_to_process.
+    """
+    hashes = {}
+    pending = []
+    for file_path in files_to_process:
+        hashes[file_path] = cache.file_hash(file_path)
+        if cache.lookup(hashes[file_path]) is None:
+            pending.append(file_path)
+    cache.run_hashes = set(hashes.values())
+    
+    cache.files_reused = len(files_to_process) - len(pending)
+    cache.files_parsed = len(pending)
+    print(f"♻️ Из кэша: {cache.files_reused} файлов, к разбору: {cache.files_parsed}")
+    
+    if workers > 1 and pending:
+        # Файлы фиксируются в кэше по мере завершения разбора, а не после всего пула
+        parsed = iter_files_parallel(pending, workers, chunk_size, ordered=False)
+    else:
+        parsed = iter_file_results(processor, pending, stream)
+    
+    # Каждый разобранный файл сразу фиксируется в кэше (контрольная точка)
+    errors = {}
+    for file_path, dialogues, error in parsed:
+        if error is None:
+            try:
+                cache.store(file_path, hashes[file_path], dialogues)
+            except Exception as e:
+                error = str(e)
+        if error is not None:
+            errors[file_path] = error
+    
+    for file_path in files_to_process:
+        if file_path in errors:
+            yield file_path, [], errors[file_path]
+        else:
+            yield file_path, cache.iter_dialogues(hashes[file_path]), None
+
 def main():
     parser = argparse.ArgumentParser(description='Обработка диалогов в Q&A пары')
     parser.add_argument('--file', help='Конкретный файл для обработки')
     parser.add_argument('--dir', default='.', help='Директория для поиска Excel файлов (по умолчанию текущая)')
     parser.add_argument('--output-dir', help='Директория для сохранения результатов (создается автоматически если не указана)')
+    parser.add_argument('--workers', type=int, default=1, help='Количество процессов для параллельной обработки (по умолчанию 1 - последовательно)')
+    parser.add_argument('--chunk-size', type=int, default=5000, help='Количество строк в одной части файла при параллельной обработке (по умолчанию 5000)')
+    parser.add_argument('--stream', action='store_true', help='Потоковая обработка: строки читаются и записываются по одной, память не растет с размером выгрузки')
+    parser.add_argument('--incremental', action='store_true', help='Инкрементальная пересборка: разбираются только новые и измененные файлы, остальные берутся из кэша')
+    parser.add_argument('--dedup', action='store_true', help='Удалять точные и почти точные дубликаты диалогов (MinHash/LSH)')
+    parser.add_argument('--dedup-threshold', type=float, default=0.9, help='Порог сходства Жаккара для почти точных дубликатов (1.0 - только точные, по умолчанию 0.9)')
+    parser.add_argument('--qa', action='store_true', help='Дополнительно извлечь ранжированные Q&A пары в компактную базу знаний')
+    parser.add_argument('--qa-min-score', type=float, default=0.3, help='Минимальная оценка Q&A пары (0..1, по умолчанию 0.3)')
+    parser.add_argument('--qa-limit', type=int, help='Максимальное количество Q&A пар (по умолчанию все прошедшие порог)')
+    parser.add_argument('--kb-chunk-size', type=int, help='Дополнительно разбить базу знаний на части не больше указанного размера в КБ (по границам диалогов)')
+    parser.add_argument('--parquet', action='store_true', help='Дополнительно сохранить сообщения в Parquet (требуется pyarrow)')
+    parser.add_argument('--jsonl', choices=sorted(JsonLinesWriter.EXTENSIONS), help='Дополнительно сохранить диалоги в сжатый JSON Lines (zstd требует zstandard)')
+    parser.add_argument('--similarity-index', action='store_true', help='Дополнительно построить индекс похожих вопросов клиентов для бота в <output-dir>/<имя>_similarity_index; бот читает его из SIMILARITY_INDEX_DIR (или similarity_index_dir бота в TENANTS_CONFIG)')
+    parser.add_argument('--cache-dir', help='Директория кэша для --incremental (по умолчанию .dialogue_cache в директории с файлами)')
     
     args = parser.parse_args()
+    if args.chunk_size < 1:
+        parser.error('--chunk-size должен быть не меньше 1')
     
     processor = DialogueProcessor()
     
@@ -304,6 +1214,10 @@ def main():
     if args.output_dir:
         output_dir = args.output_dir
         os.makedirs(output_dir, exist_ok=True)
+    elif args.incremental:
+        # Инкрементальный режим пересобирает одну и ту же папку
+        output_dir = os.path.join(args.dir, 'dialogue_processing_incremental')
+        os.makedirs(output_dir, exist_ok=True)
     else:
         output_dir = create_output_directory()
     
@@ -330,7 +1244,6 @@ def main():
             print(f"   📄 {f}")
         print()
     
-    all_dialogues = []
     processing_info = {
         'timestamp': datetime.now().isoformat(),
         'files_processed': [],
@@ -339,47 +1252,6 @@ def main():
         'output_directory': output_dir
     }
     
-    # Обрабатываем каждый файл
-    for file_path in files_to_process:
-        print(f"🔄 Обрабатываем: {os.path.basename(file_path)}")
-        
-        try:
-            dialogues = processor.process_file(file_path)
-            all_dialogues.extend(dialogues)
-            
-            total_messages = sum(d['message_count'] for d in dialogues)
-            
-            file_info = {
-                'filename': os.path.basename(file_path),
-                'full_path': file_path,
-                'dialogues_extracted': len(dialogues),
-                'messages_extracted': total_messages,
-                'status': 'success'
-            }
-            processing_info['files_processed'].append(file_info)
-            
-            print(f"✅ Извлечено {len(dialogues)} диалогов ({total_messages} сообщений) из {os.path.basename(file_path)}")
-        except Exception as e:
-            print(f"❌ Ошибка обработки {file_path}: {e}")
-            
-            file_info = {
-                'filename': os.path.basename(file_path),
-                'full_path': file_path,
-                'dialogues_extracted': 0,
-                'messages_extracted': 0,
-                'status': 'error',
-                'error': str(e)
-            }
-            processing_info['files_processed'].append(file_info)
-            continue
-    
-    if not all_dialogues:
-        print("❌ Не удалось извлечь диалоги ни из одного файла")
-        sys.exit(1)
-    
-    processing_info['total_dialogues'] = len(all_dialogues)
-    processing_info['total_messages'] = sum(d['message_count'] for d in all_dialogues)
-    
     # Определяем базовые имена файлов
     if len(files_to_process) == 1:
         # Один файл - используем его имя
@@ -391,14 +1263,165 @@ def main():
     # Пути для выходных файлов в созданной директории
     json_output = os.path.join(output_dir, f"{base_name}_full_dialogues.json")
     txt_output = os.path.join(output_dir, f"{base_name}_knowledge_base.txt")
+    topic_index_output = os.path.join(output_dir, f"{base_name}_topic_index.json")
+    duplicates_output = os.path.join(output_dir, f"{base_name}_duplicates.json")
+    qa_txt_output = os.path.join(output_dir, f"{base_name}_qa_pairs.txt")
+    qa_json_output = os.path.join(output_dir, f"{base_name}_qa_pairs.json")
+    kb_chunks_dir = os.path.join(output_dir, f"{base_name}_kb_chunks")
+    similarity_index_dir = os.path.join(output_dir, f"{base_name}_similarity_index")
+    parquet_output = os.path.join(output_dir, f"{base_name}_messages.parquet")
+    jsonl_output = os.path.join(output_dir, f"{base_name}_dialogues{JsonLinesWriter.EXTENSIONS[args.jsonl]}") if args.jsonl else None
     info_output = os.path.join(output_dir, "processing_info.json")
     
-    # Сохраняем результаты
-    print(f"\n📊 ИТОГО извлечено диалогов: {len(all_dialogues)}")
-    print(f"📊 ИТОГО сообщений: {sum(d['message_count'] for d in all_dialogues)}")
+    # Обрабатываем файлы: инкрементально через кэш, параллельно пулом процессов, потоково или по одному
+    cache = None
+    if args.incremental:
+        cache_dir = args.cache_dir or os.path.join(args.dir, '.dialogue_cache')
+        print(f"🗄️ Кэш разобранных файлов: {cache_dir}")
+        cache = DialogueCache(cache_dir)
+        file_results = iter_incremental_results(processor, files_to_process, cache, args.workers, args.chunk_size, args.stream)
+    elif args.workers > 1:
+        print(f"⚙️ Параллельная обработка: процессов {args.workers}, строк в части {args.chunk_size}")
+        file_results = process_files_parallel(files_to_process, args.workers, args.chunk_size)
+    else:
+        file_results = iter_file_results(processor, files_to_process, args.stream)
+    
+    deduplicator = DialogueDeduplicator(threshold=args.dedup_threshold) if args.dedup else None
     
-    processor.save_to_json(all_dialogues, json_output)
-    processor.save_to_txt(all_dialogues, txt_output)
+    output_files = [json_output, txt_output, topic_index_output]
+    if args.qa:
+        output_files += [qa_txt_output, qa_json_output]
+    if args.kb_chunk_size:
+        output_files.append(kb_chunks_dir)
+    if args.similarity_index:
+        output_files.append(similarity_index_dir)
+    if args.parquet:
+        output_files.append(parquet_output)
+    if jsonl_output:
+        output_files.append(jsonl_output)
+    
+    # Диалоги записываются во все выходные файлы сразу по мере извлечения
+    with ExitStack() as stack:
+        json_writer = stack.enter_context(DialogueJsonWriter(json_output))
+        writers = [
+            json_writer,
+            stack.enter_context(KnowledgeBaseTxtWriter(txt_output)),
+            stack.enter_context(TopicIndexWriter(topic_index_output))
+        ]
+        qa_writer = None
+        if args.qa:
+            qa_writer = stack.enter_context(QaPairsWriter(processor, qa_txt_output, qa_json_output, args.qa_min_score, args.qa_limit))
+            writers.append(qa_writer)
+        chunk_writer = None
+        if args.kb_chunk_size:
+            chunk_writer = stack.enter_context(ChunkedKnowledgeBaseWriter(processor, kb_chunks_dir, base_name, args.kb_chunk_size * 1024))
+            writers.append(chunk_writer)
+        similarity_writer = None
+        if args.similarity_index:
+            similarity_writer = stack.enter_context(SimilarityIndexWriter(processor, similarity_index_dir))
+            writers.append(similarity_writer)
+        if args.parquet:
+            writers.append(stack.enter_context(ParquetMessagesWriter(parquet_output)))
+        if jsonl_output:
+            writers.append(stack.enter_context(JsonLinesWriter(jsonl_output, args.jsonl)))
+        
+        for file_path, dialogues, error in file_results:
+            dialogues_count = 0
+            messages_count = 0
+            duplicates_dropped = 0 if deduplicator is not None else None
+            
+            if error is None:
+                try:
+                    if args.stream and cache is None:
+                        # Файл сначала прочитывается целиком во временный файл: если чтение упадет
+                        # посреди файла, его часть не попадет ни в выходные файлы, ни в итоги
+                        dialogues = spool_dialogues(dialogues, output_dir)
+                    for dialogue in dialogues:
+                        if deduplicator is not None and deduplicator.is_duplicate(dialogue):
+                            duplicates_dropped += 1
+                            continue
+                        for writer in writers:
+                            writer.write(dialogue)
+                        dialogues_count += 1
+                        messages_count += dialogue['message_count']
+                except Exception as e:
+                    error = str(e)
+            
+            processing_info['files_processed'].append(make_file_info(file_path, dialogues_count, messages_count, error, duplicates_dropped))
+            
+            if error is not None:
+                print(f"❌ Ошибка обработки {file_path}: {error}")
+                continue
+            
+            print(f"✅ Извлечено {dialogues_count} диалогов ({messages_count} сообщений) из {os.path.basename(file_path)}")
+    
+    if json_writer.total_dialogues == 0:
+        for output_file in output_files:
+            if os.path.islink(output_file):
+                # Индекс похожих вопросов - ссылка на директорию опубликованной версии
+                shutil.rmtree(os.path.realpath(output_file))
+                os.remove(output_file)
+            elif os.path.isdir(output_file):
+                shutil.rmtree(output_file)
+            else:
+                os.remove(output_file)
+        print("❌ Не удалось извлечь диалоги ни из одного файла")
+        sys.exit(1)
+    
+    processing_info['total_dialogues'] = json_writer.total_dialogues
+    processing_info['total_messages'] = json_writer.total_messages
+    if deduplicator is not None:
+        processing_info['deduplication'] = deduplicator.stats()
+        processing_info['deduplication']['duplicates_file'] = duplicates_output
+        with open(duplicates_output, 'w', encoding='utf-8') as f:
+            json.dump(deduplicator.duplicates, f, ensure_ascii=False)
+    if qa_writer is not None:
+        processing_info['qa_pairs'] = {
+            'candidates': len(qa_writer.candidates),
+            'total_pairs': len(qa_writer.qa_pairs),
+            'min_score': args.qa_min_score
+        }
+    if chunk_writer is not None:
+        processing_info['kb_chunks'] = {
+            'directory': kb_chunks_dir,
+            'manifest': chunk_writer.manifest_path,
+            'max_bytes': chunk_writer.max_bytes,
+            'total_chunks': len(chunk_writer.chunks)
+        }
+    if similarity_writer is not None:
+        processing_info['similarity_index'] = {
+            'directory': similarity_index_dir,
+            'questions': len(similarity_writer.builder)
+        }
+    if cache is not None:
+        # Запуск завершился: кэш выгрузок, которых больше нет в директории (или которые изменились),
+        # не нужен. С --file другие файлы директории не проверялись - удаляются только файлы вне манифеста
+        cache_files_removed = cache.prune(None if args.file else cache.run_hashes)
+        processing_info['incremental'] = {
+            'cache_dir': cache.cache_dir,
+            'files_reused': cache.files_reused,
+            'files_parsed': cache.files_parsed,
+            'cache_files_removed': cache_files_removed
+        }
+    
+    print(f"\n📊 ИТОГО извлечено диалогов: {json_writer.total_dialogues}")
+    print(f"📊 ИТОГО сообщений: {json_writer.total_messages}")
+    print(f"✅ JSON файл сохранен в {json_output}")
+    print(f"✅ TXT файл сохранен в {txt_output}")
+    print(f"✅ Индекс тем сохранен в {topic_index_output}")
+    if args.parquet:
+        print(f"✅ Parquet файл сохранен в {parquet_output}")
+    if jsonl_output:
+        print(f"✅ JSON Lines файл сохранен в {jsonl_output}")
+    if deduplicator is not None:
+        dedup_stats = processing_info['deduplication']
+        print(f"🧹 Удалено дубликатов: {dedup_stats['dialogues_dropped']} "
+              f"(точных {dedup_stats['exact_duplicates']}, похожих {dedup_stats['near_duplicates']}, {dedup_stats['dropped_percent']}%)")
+    if similarity_writer is not None:
+        print(f"✅ Индекс похожих вопросов ({len(similarity_writer.builder)} вопросов) сохранен в {similarity_index_dir}")
+    if qa_writer is not None:
+        processor.print_statistics(qa_writer.qa_pairs)
+        print(f"✅ Q&A пары сохранены в {qa_txt_output} и {qa_json_output}")
     
     # Сохраняем информацию о процессе обработки
     with open(info_output, 'w', encoding='utf-8') as f:
@@ -406,7 +1429,10 @@ def main():
     
     print(f"ℹ️ Информация о процессе сохранена в {info_output}")
     print(f"\n🎉 Готово! Все файлы сохранены в папке: {output_dir}")
-    print(f"📋 Основной файл для Vector Store: {txt_output}")
+    if chunk_writer is not None:
+        print(f"📋 Части базы знаний для Vector Store ({len(chunk_writer.chunks)} шт.): {kb_chunks_dir}")
+    else:
+        print(f"📋 Основной файл для Vector Store: {txt_output}")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""
+Идемпотентная обработка обновлений Telegram: повторно доставленные обновления
+и двойные нажатия кнопок отбрасываются до обработчиков (и до запросов к OpenAI)
+"""
+
+import logging
+import time
+from collections import Counter, OrderedDict
+
+from telegram.ext import ApplicationHandlerStop
+
+from config import DEDUP_TTL, DEDUP_TAP_WINDOW, DEDUP_MAX_ENTRIES
+
+class TTLCache:
+    """
+    Множество ключей, каждый из которых живет ttl секунд; не больше max_size ключей
+    (при переполнении вытесняются самые старые). Время жизни у всех ключей одно,
+    поэтому порядок добавления совпадает с порядком истечения.
+    """
+
+    def __init__(self, ttl, max_size):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._expires = OrderedDict()
+
+    def __len__(self):
+        return len(self._expires)
+
+    def _purge(self, now):
+        while self._expires:
+            key, expires = next(iter(self._expires.items()))
+            if expires > now:
+                break
+            del self._expires[key]
+
+    def contains(self, key, now=None):
+        """Есть ли ключ, который еще не истек."""
+        self._purge(time.monotonic() if now is None else now)
+        return key in self._expires
+
+    def discard(self, key):
+        self._expires.pop(key, None)
+
+    def add(self, key, now=None):
+        """Добавляет ключ; False, если ключ уже есть и еще не истек."""
+        now = time.monotonic() if now is None else now
+        self._purge(now)
+        if key in self._expires:
+            return False
+        self._expires[key] = now + self.ttl
+        while len(self._expires) > self.max_size:
+            self._expires.popitem(last=False)
+        return True
+
+class UpdateDeduplicator:
+    """
+    Отбрасывает обновления, которые уже обрабатывались:
+
+    - update: тот же update_id (Telegram повторил доставку);
+    - message: то же сообщение (chat_id, message_id) в другом обновлении;
+    - callback: тот же callback query id;
+    - tap: нажатие той же кнопки под тем же сообщением тем же пользователем, пока
+      обрабатывается первое нажатие, и tap_window секунд после конца его обработки
+      (двойное нажатие дает новый callback query id).
+
+    Окно нажатия отсчитывается от конца обработки, а не от ее начала: обновления
+    обрабатываются по очереди, и второе нажатие ждет, пока первое выполнит run
+    ассистента - обычно дольше tap_window.
+
+    Подключается как TypeHandler(Update) перед основными обработчиками (on_update)
+    и после них (on_done); у каждого приложения свой экземпляр, потому что update_id
+    уникальны только в пределах бота.
+    """
+
+    def __init__(self, ttl=DEDUP_TTL, tap_window=DEDUP_TAP_WINDOW, max_size=DEDUP_MAX_ENTRIES):
+        self._seen = TTLCache(ttl, max_size)
+        self._taps = TTLCache(tap_window, max_size)
+        # Нажатия в обработке; ttl - на случай, если on_done для нажатия не вызовется
+        self._taps_in_flight = TTLCache(ttl, max_size)
+        self.suppressed = Counter()
+
+    def duplicate_kind(self, update):
+        """Тип дубликата ('update', 'message', 'callback', 'tap') или None для нового обновления."""
+        now = time.monotonic()
+        # Все ключи регистрируются сразу: повтор по любому из них ловится и позже
+        new_update = self._seen.add(('update', update.update_id), now)
+
+        if update.message is not None:
+            new_message = self._seen.add(('message', update.message.chat_id, update.message.message_id), now)
+            if not new_update:
+                return 'update'
+            return None if new_message else 'message'
+
+        query = update.callback_query
+        if query is not None:
+            new_callback = self._seen.add(('callback', query.id), now)
+            if not new_update:
+                return 'update'
+            if not new_callback:
+                return 'callback'
+            tap = self._tap_key(query)
+            if self._taps_in_flight.contains(tap, now) or self._taps.contains(tap, now):
+                return 'tap'
+            self._taps_in_flight.add(tap, now)
+            return None
+
+        return None if new_update else 'update'
+
+    @staticmethod
+    def _tap_key(query):
+        message_id = query.message.message_id if query.message is not None else query.inline_message_id
+        return query.from_user.id, message_id, query.data
+
+    def done(self, update):
+        """Обработка обновления закончена: окно повторного нажатия той же кнопки начинается сейчас."""
+        if update.callback_query is None:
+            return
+        tap = self._tap_key(update.callback_query)
+        self._taps_in_flight.discard(tap)
+        self._taps.discard(tap)
+        self._taps.add(tap)
+
+    async def on_done(self, update, context):
+        """Обработчик после основных (в том числе после ошибки в них)."""
+        self.done(update)
+
+    async def on_update(self, update, context):
+        """Обработчик перед основными: дубликат дальше не обрабатывается."""
+        kind = self.duplicate_kind(update)
+        if kind is None:
+            return
+
+        self.suppressed[kind] += 1
+        user = update.effective_user
+        logging.info(f"Duplicate {kind} suppressed: update {update.update_id} from user {user.id if user else None}")
+
+        # Иначе у пользователя будет крутиться индикатор загрузки на кнопке
+        if update.callback_query is not None:
+            try:
+                await update.callback_query.answer()
+            except Exception as e:
+                logging.debug(f"Could not answer duplicate callback query: {e}")
+
+        raise ApplicationHandlerStop
+
+    def stats(self):
+        return {'suppressed': sum(self.suppressed.values()), **self.suppressed}
@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+"""
+Сторож event loop: непрерывно измеряет задержку loop'а и при блокировке дольше порога
+снимает стек потока loop'а - видно, какой синхронный вызов (time.sleep, запрос OpenAI
+или requests, запись JSON) держит все чаты.
+"""
+
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import Counter, deque
+
+from config import LOOP_WATCHDOG_INTERVAL, LOOP_STALL_THRESHOLD, LOOP_STALL_LOG_INTERVAL
+from circuit_breaker import percentile
+
+_PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+class StallError(AssertionError):
+    """Event loop блокировался дольше допустимого (для тестов и воспроизведения трафика)."""
+
+def _site(stack):
+    """Место блокировки: самый внутренний кадр кода бота, а если его нет - самый внутренний кадр."""
+    for frame in reversed(stack):
+        if os.path.dirname(os.path.abspath(frame.filename)) == _PROJECT_DIR:
+            return f"{os.path.basename(frame.filename)}:{frame.lineno} {frame.name}"
+    if stack:
+        frame = stack[-1]
+        return f"{os.path.basename(frame.filename)}:{frame.lineno} {frame.name}"
+    return "[unknown]"
+
+class LoopWatchdog:
+    """
+    Задача в loop'е просыпается каждые interval секунд и измеряет, на сколько опоздала
+    (задержка loop'а). Поток-монитор видит, что очередного пробуждения нет дольше
+    threshold, и снимает стек потока loop'а, пока тот еще заблокирован.
+
+    Блокировки дольше threshold попадают в метрики (snapshot) и в лог - не чаще раза
+    в log_interval секунд, с числом пропущенных с прошлой записи. В тестах:
+
+        async with LoopWatchdog(threshold=0.05) as watchdog:
+            await handler(update, context)
+        watchdog.check()  # StallError со стеками, если loop блокировался дольше порога
+    """
+
+    def __init__(self, threshold=LOOP_STALL_THRESHOLD, interval=LOOP_WATCHDOG_INTERVAL,
+                 log_interval=LOOP_STALL_LOG_INTERVAL, window=1000):
+        self.threshold = threshold
+        self.interval = interval
+        self.log_interval = log_interval
+
+        self._lags = deque(maxlen=window)
+        self.recent = deque(maxlen=50)
+        self.sites = Counter()
+        self.stalls = 0
+        self.stall_seconds = 0.0
+        self.max_lag = 0.0
+
+        self._beat = None
+        self._captured = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._task = None
+        self._thread = None
+        self._last_log = None
+        self._suppressed = 0
+
+    @property
+    def running(self):
+        return self._task is not None and not self._task.done()
+
+    async def __aenter__(self):
+        self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.stop()
+        return False
+
+    def start(self):
+        """Запускает сторож в текущем event loop (повторный вызов и порог 0 ничего не делают)."""
+        if self.running or not self.threshold:
+            return
+        self._beat = time.monotonic()
+        self._stop.clear()
+        self._task = asyncio.get_running_loop().create_task(self._heartbeat())
+        self._thread = threading.Thread(
+            target=self._monitor,
+            args=(threading.get_ident(),),
+            name='loop-watchdog',
+            daemon=True
+        )
+        self._thread.start()
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._stop.set()
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._thread.join()
+        self._task = None
+        self._thread = None
+
+    async def _heartbeat(self):
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            self._beat = now
+            lag = max(0.0, now - expected)
+            self._lags.append(lag)
+            self.max_lag = max(self.max_lag, lag)
+            if lag >= self.threshold:
+                with self._lock:
+                    stack, self._captured = self._captured, None
+                self._record(lag, stack)
+
+    def _monitor(self, loop_thread_id):
+        captured_beat = None
+        # Проверяем чаще порога, чтобы застать loop еще заблокированным, но без холостого цикла
+        period = max(min(self.interval, self.threshold) / 2, 0.005)
+        while not self._stop.wait(period):
+            beat = self._beat
+            if beat == captured_beat or time.monotonic() - beat < self.interval + self.threshold:
+                continue
+            frame = sys._current_frames().get(loop_thread_id)
+            if frame is None:
+                continue
+            stack = traceback.extract_stack(frame)
+            with self._lock:
+                self._captured = stack
+            captured_beat = beat
+
+    def _record(self, lag, stack):
+        site = _site(stack) if stack else "[not captured]"
+        self.stalls += 1
+        self.stall_seconds += lag
+        self.sites[site] += 1
+        self.recent.append({'at': time.time(), 'duration': lag, 'site': site, 'stack': stack})
+
+        now = time.monotonic()
+        if self._last_log is not None and now - self._last_log < self.log_interval:
+            self._suppressed += 1
+            return
+        suppressed = f" (+{self._suppressed} stalls since last report)" if self._suppressed else ""
+        self._last_log = now
+        self._suppressed = 0
+        details = "".join(traceback.format_list(stack)) if stack else ""
+        logging.warning(f"Event loop blocked for {lag * 1000:.0f} ms at {site}{suppressed}\n{details}".rstrip())
+
+    def snapshot(self):
+        """Метрики: число и суммарная длительность блокировок, задержка loop'а, частые места блокировок."""
+        lags = list(self._lags)
+        return {
+            'stalls': self.stalls,
+            'stall_seconds': round(self.stall_seconds, 3),
+            'max_lag': round(self.max_lag, 4),
+            'lag_p50': percentile(lags, 0.5),
+            'lag_p99': percentile(lags, 0.99),
+            'top_sites': self.sites.most_common(5)
+        }
+
+    def check(self, budget=None):
+        """StallError со стеками, если среди последних блокировок есть дольше budget (по умолчанию threshold)."""
+        budget = self.threshold if budget is None else budget
+        offending = [stall for stall in self.recent if stall['duration'] > budget]
+        if not offending:
+            return
+        parts = [f"Event loop blocked longer than {budget * 1000:g} ms {len(offending)} time(s):"]
+        for stall in offending:
+            parts.append(f"\n{stall['duration'] * 1000:.0f} ms at {stall['site']}")
+            if stall['stack']:
+                parts.append("".join(traceback.format_list(stall['stack'])).rstrip())
+        raise StallError("\n".join(parts))
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""
+Несколько ботов (tenants) в одном процессе и одном event loop.
+
+У каждого бота свой токен, ассистент, тексты, телефоны и директория данных,
+общие - пул соединений к Telegram, планировщик отправок, OpenAI клиент и профилировщик.
+
+    python multi_tenant.py [tenants.json]
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import signal
+
+from telegram.request import HTTPXRequest
+
+from config import OPENAI_API_KEY, TENANTS_CONFIG, TELEGRAM_POOL_SIZE, TRAFFIC_CAPTURE_DIR
+from tenants import load_tenants
+import bot
+
+def build_applications(tenants):
+    """Приложение на каждого бота; запросы к Bot API (кроме getUpdates) идут через общий пул."""
+    shared_request = HTTPXRequest(connection_pool_size=TELEGRAM_POOL_SIZE)
+    return [
+        bot.build_application(
+            tenant.token,
+            request=shared_request,
+            capture_dir=os.path.join(TRAFFIC_CAPTURE_DIR, tenant.name) if TRAFFIC_CAPTURE_DIR else None,
+            tenant=tenant
+        )
+        for tenant in tenants
+    ]
+
+async def run(tenants):
+    """Запускает polling всех ботов и работает до SIGINT/SIGTERM."""
+    applications = build_applications(tenants)
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    started = []
+    try:
+        for tenant, application in zip(tenants, applications):
+            await application.initialize()
+            started.append(application)
+            await application.post_init(application)
+            await application.updater.start_polling()
+            await application.start()
+            logging.info(f"Tenant {tenant.name} started as @{application.bot.username}")
+
+        await stop.wait()
+    finally:
+        logging.info("Stopping tenants")
+        for application in started:
+            if application.updater.running:
+                await application.updater.stop()
+            if application.running:
+                await application.stop()
+        # Планировщик отправок общий: останавливается только после остановки всех ботов
+        for application in started:
+            await application.post_shutdown(application)
+        for application in started:
+            await application.shutdown()
+
+def main():
+    parser = argparse.ArgumentParser(description='Несколько ботов в одном процессе')
+    parser.add_argument('config', nargs='?', default=TENANTS_CONFIG, help='JSON файл с настройками ботов')
+    args = parser.parse_args()
+
+    if not OPENAI_API_KEY:
+        logging.error("Missing required environment variables: OPENAI_API_KEY")
+        raise SystemExit("Error: Missing environment variables: OPENAI_API_KEY")
+
+    tenants = load_tenants(args.config)
+    if not tenants:
+        raise SystemExit(f"Error: no tenants in {args.config}")
+
+    asyncio.run(run(tenants))
+
+if __name__ == "__main__":
+    main()
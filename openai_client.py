@@ -1,29 +1,52 @@
 # -*- coding: utf-8 -*-
 import openai
 import logging
-from openai import OpenAI
-from config import OPENAI_API_KEY, ASSISTANT_ID
-from utils import save_threads
+from datetime import datetime
+from config import ASSISTANT_ID, THREAD_TOKEN_BUDGET, SUMMARY_MODEL, CHAT_MODEL, SIMILAR_DIALOGUES_TOP_K, SIMILAR_DIALOGUES_MIN_SCORE
+from openai_factory import openai_for
+from utils import save_threads, save_thread_archive
+from traffic_capture import traced, summarize_run, summarize_completion
+from tenants import current_tenant
+from similarity_index import load_index
 
-# Инициализация OpenAI клиента
-client = OpenAI(api_key=OPENAI_API_KEY)
+# Функция передачи менеджеру для chat бэкенда: те же параметры, что у функции ассистента
+TRANSFER_TO_MANAGER_TOOL = {
+    "type": "function",
+    "function": {
+        "name": "transfer_to_manager",
+        "description": "Передать разговор менеджеру: клиент просит менеджера, готов оформить заказ "
+                       "или вопрос требует индивидуального расчета",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "summary": {"type": "string", "description": "Краткое резюме запроса клиента"},
+                "technical_specs": {"type": "string", "description": "Техническое задание: продукт, тираж, размеры, материалы, сроки"},
+                "recommendations": {"type": "string", "description": "Что менеджеру уточнить у клиента"}
+            },
+            "required": ["summary"]
+        }
+    }
+}
 
+@traced('openai.create_thread')
 def create_thread_for_user(user_id, user_threads):
     """Создает новый thread для пользователя."""
-    thread = client.beta.threads.create()
+    thread = openai_for('threads.create').beta.threads.create()
     user_threads[user_id] = thread.id
     logging.info(f"Created new thread {thread.id} for user {user_id}")
     save_threads(user_threads)
     return thread.id
 
+@traced('openai.get_run_status', summarize_run)
 def get_run_status(thread_id, run_id):
     """Получает статус выполнения run."""
-    return client.beta.threads.runs.retrieve(thread_id=thread_id, run_id=run_id)
+    return openai_for('runs.retrieve').beta.threads.runs.retrieve(thread_id=thread_id, run_id=run_id)
 
+@traced('openai.submit_tool_outputs')
 def submit_tool_outputs(thread_id, run_id, tool_outputs):
     """Отправляет результаты выполнения функций."""
     try:
-        return client.beta.threads.runs.submit_tool_outputs(
+        return openai_for('runs.submit_tool_outputs').beta.threads.runs.submit_tool_outputs(
             thread_id=thread_id,
             run_id=run_id,
             tool_outputs=tool_outputs
@@ -32,28 +55,179 @@ def submit_tool_outputs(thread_id, run_id, tool_outputs):
         logging.error(f"Error submitting tool outputs: {e}")
         return None
 
+@traced('openai.cancel_run')
 def cancel_run(thread_id, run_id):
     """Отменяет активный run."""
     try:
-        result = client.beta.threads.runs.cancel(thread_id=thread_id, run_id=run_id)
+        result = openai_for('runs.cancel').beta.threads.runs.cancel(thread_id=thread_id, run_id=run_id)
         logging.info(f"Run {run_id} cancelled successfully")
         return result
     except Exception as e:
         logging.error(f"Error cancelling run {run_id}: {e}")
         return None
 
+@traced('openai.get_assistant_response')
 def get_assistant_response(thread_id):
     """Получает последний ответ ассистента."""
-    messages = client.beta.threads.messages.list(thread_id=thread_id)
+    messages = openai_for('messages.list').beta.threads.messages.list(thread_id=thread_id)
     for message in messages.data:
         if message.role == "assistant":
             return message.content[0].text.value
     return None
 
+def thread_transcript(thread_id, page_size=100):
+    """Все сообщения thread'а по порядку (постранично): ["Клиент: ...", "Бот: ..."]."""
+    messages = openai_for('messages.list').beta.threads.messages.list(thread_id=thread_id, limit=page_size, order="asc")
+    transcript = []
+    for message in messages:
+        role = "Клиент" if message.role == "user" else "Бот"
+        transcript.append(f"{role}: {message.content[0].text.value}")
+    return transcript
+
+def summarize_thread(transcript):
+    """Составляет краткое резюме разговора (thread_transcript) для переноса в новый thread."""
+    completion = openai_for('chat.completions').chat.completions.create(
+        model=SUMMARY_MODEL,
+        messages=[
+            {
+                "role": "system",
+                "content": (
+                    "Сожми переписку клиента с ботом полиграфической компании Web2Print в краткое резюме "
+                    "на языке переписки: что клиент хотел заказать, параметры (тираж, размеры, материалы, сроки), "
+                    "озвученные цены, договоренности и открытые вопросы. Не более 1200 символов."
+                )
+            },
+            {"role": "user", "content": "\n".join(transcript)}
+        ]
+    )
+    return completion.choices[0].message.content.strip()
+
+# Символов на токен в переписке на русском, узбекском и английском (оценка без токенизатора)
+CHARS_PER_TOKEN = 3
+
+def estimate_tokens(text):
+    """Оценка числа токенов текста."""
+    return len(text) // CHARS_PER_TOKEN + 1
+
+# Наименьшая замеренная часть prompt_tokens run'ов thread'а сверх его сообщений (инструкции,
+# функции, фрагменты file_search): prompt_tokens минус она - верхняя оценка размера разговора
+_prompt_overheads = {}
+
+@traced('openai.maybe_rotate_thread')
+def maybe_rotate_thread(user_id, thread_id, user_threads, run):
+    """
+    Сворачивает thread, если его сообщения превысили бюджет контекста.
+    
+    Размер разговора считается по самим сообщениям thread'а, а не по prompt_tokens run'а,
+    в которые входят инструкции и фрагменты file_search. Сообщения читаются, только когда
+    prompt_tokens за вычетом замеренной ранее постоянной части дотягивают до бюджета.
+    
+    Создает новый thread с резюме старого первым сообщением, атомарно обновляет
+    user_threads и запоминает резюме для передачи менеджеру. Возвращает новый thread_id или None.
+    """
+    usage = getattr(run, 'usage', None)
+    prompt_tokens = getattr(usage, 'prompt_tokens', 0) or 0
+    # Сообщения thread'а - лишь часть промпта: меньше бюджета промпт - меньше и разговор
+    if prompt_tokens - _prompt_overheads.get(thread_id, 0) < THREAD_TOKEN_BUDGET:
+        return None
+    
+    try:
+        transcript = thread_transcript(thread_id)
+        conversation_tokens = estimate_tokens("\n".join(transcript))
+        overhead = max(0, prompt_tokens - conversation_tokens)
+        _prompt_overheads[thread_id] = min(_prompt_overheads.get(thread_id, overhead), overhead)
+        if conversation_tokens < THREAD_TOKEN_BUDGET:
+            return None
+        
+        summary = summarize_thread(transcript)
+        new_thread = openai_for('threads.create').beta.threads.create(messages=[{
+            "role": "assistant",
+            "content": f"Краткое содержание предыдущего разговора с клиентом:\n{summary}"
+        }])
+    except Exception as e:
+        logging.error(f"Error rotating thread {thread_id} for user {user_id}: {e}")
+        return None
+    _prompt_overheads.pop(thread_id, None)
+    
+    # Архив свернутых тредов текущего бота: новый thread_id -> резюме предыдущего разговора
+    thread_archive = current_tenant().thread_archive
+    thread_archive[new_thread.id] = {
+        "user_id": user_id,
+        "previous_thread_id": thread_id,
+        "summary": summary,
+        "prompt_tokens": prompt_tokens,
+        "thread_tokens": conversation_tokens,
+        "rotated_at": datetime.now().isoformat()
+    }
+    save_thread_archive(thread_archive)
+    
+    # Новый thread подменяет старый только если пользователь не сбросил/не сменил его за это время
+    if user_threads.get(user_id) == thread_id:
+        user_threads[user_id] = new_thread.id
+        save_threads(user_threads)
+    
+    logging.info(f"Thread {thread_id} of user {user_id} rotated to {new_thread.id} "
+                 f"({conversation_tokens} thread tokens, {prompt_tokens} prompt tokens)")
+    return new_thread.id
+
+def get_previous_conversation_summary(thread_id):
+    """Возвращает резюме разговора, из которого был создан thread, если он был свернут."""
+    entry = current_tenant().thread_archive.get(thread_id)
+    return entry["summary"] if entry else None
+
+def format_history_message(role, content):
+    """Строка истории диалога для менеджера."""
+    # Ограничиваем длину сообщения для читаемости
+    if len(content) > 200:
+        content = content[:200] + "..."
+    return f"{'👤 Клиент' if role == 'user' else '🤖 Бот'}: {content}"
+
+@traced('openai.chat_completion', summarize_completion)
+def stream_chat_completion(messages, model=CHAT_MODEL):
+    """
+    Один потоковый запрос chat completions с функцией transfer_to_manager.
+    Возвращает {'text', 'tool_calls': [{'name', 'arguments'}], 'prompt_tokens', 'completion_tokens'}.
+    """
+    stream = openai_for('chat.completions').chat.completions.create(
+        model=model,
+        messages=messages,
+        tools=[TRANSFER_TO_MANAGER_TOOL],
+        stream=True,
+        stream_options={"include_usage": True}
+    )
+    
+    content = []
+    tool_calls = {}
+    prompt_tokens = None
+    completion_tokens = None
+    for chunk in stream:
+        if chunk.usage is not None:
+            prompt_tokens = chunk.usage.prompt_tokens
+            completion_tokens = chunk.usage.completion_tokens
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta
+        if delta.content:
+            content.append(delta.content)
+        # Аргументы функции приходят частями, части одного вызова связаны индексом
+        for call in delta.tool_calls or []:
+            entry = tool_calls.setdefault(call.index, {'name': '', 'arguments': ''})
+            if call.function is not None:
+                entry['name'] += call.function.name or ''
+                entry['arguments'] += call.function.arguments or ''
+    
+    return {
+        'text': "".join(content).strip() or None,
+        'tool_calls': [tool_calls[index] for index in sorted(tool_calls)],
+        'prompt_tokens': prompt_tokens,
+        'completion_tokens': completion_tokens
+    }
+
+@traced('openai.get_conversation_history')
 def get_conversation_history(thread_id, limit=20):
     """Получает историю диалога из thread для передачи менеджеру."""
     try:
-        messages = client.beta.threads.messages.list(
+        messages = openai_for('messages.list').beta.threads.messages.list(
             thread_id=thread_id,
             limit=limit,
             order="asc"
@@ -61,14 +235,7 @@ def get_conversation_history(thread_id, limit=20):
         
         conversation = []
         for message in reversed(messages.data):  # От старых к новым
-            role = "👤 Клиент" if message.role == "user" else "🤖 Бот"
-            content = message.content[0].text.value
-            
-            # Ограничиваем длину сообщения для читаемости
-            if len(content) > 200:
-                content = content[:200] + "..."
-            
-            conversation.append(f"{role}: {content}")
+            conversation.append(format_history_message(message.role, message.content[0].text.value))
         
         return "\n".join(conversation)
         
@@ -76,11 +243,22 @@ def get_conversation_history(thread_id, limit=20):
         logging.error(f"Error getting conversation history: {e}")
         return "Ошибка получения истории диалога"
 
-def format_conversation_for_manager(thread_id, user_data, summary, technical_specs=None, recommendations=None):
-    """Форматирует полную информацию для передачи менеджеру."""
+def find_similar_dialogues(text, k=SIMILAR_DIALOGUES_TOP_K):
+    """Похожие прошлые диалоги из индекса текущего бота: [(сходство, запись)], лучший ответ из диалога."""
+    index = load_index(current_tenant().similarity_index_dir)
+    if index is None or not text:
+        return []
+    return index.search(text, k, SIMILAR_DIALOGUES_MIN_SCORE, unique_key='dialogue_id')
+
+def format_conversation_for_manager(user_data, summary, technical_specs=None, recommendations=None,
+                                    conversation_history=None, previous_summary=None, attachments=None):
+    """
+    Форматирует полную информацию для передачи менеджеру.
     
-    # Получаем историю диалога
-    conversation_history = get_conversation_history(thread_id)
+    conversation_history и previous_summary дает бэкенд ассистента (без истории -
+    когда OpenAI недоступен или разговора еще не было), attachments - загруженные
+    файлы клиента (attachments.py).
+    """
     
     # Форматируем сообщение для менеджера
     message_parts = []
@@ -96,10 +274,17 @@ def format_conversation_for_manager(thread_id, user_data, summary, technical_spe
         message_parts.append(f"📞 Телефон: {user_data['phone']}")
     message_parts.append("")
     
+    # Резюме предыдущего разговора, если thread был свернут по бюджету контекста
+    if previous_summary:
+        message_parts.append("═══ РАНЕЕ В РАЗГОВОРЕ (РЕЗЮМЕ) ═══")
+        message_parts.append(previous_summary)
+        message_parts.append("")
+    
     # История диалога
-    message_parts.append("═══ ИСТОРИЯ ДИАЛОГА ═══")
-    message_parts.append(conversation_history)
-    message_parts.append("")
+    if conversation_history is not None:
+        message_parts.append("═══ ИСТОРИЯ ДИАЛОГА ═══")
+        message_parts.append(conversation_history)
+        message_parts.append("")
     
     # Краткое резюме
     message_parts.append("═══ КРАТКОЕ РЕЗЮМЕ ═══")
@@ -119,6 +304,27 @@ def format_conversation_for_manager(thread_id, user_data, summary, technical_spe
         message_parts.append(recommendations)
         message_parts.append("")
     
+    # Файлы клиента: макеты и фото на Диске Битрикс24 (или, без Диска, на сервере бота)
+    if attachments:
+        message_parts.append("═══ ФАЙЛЫ КЛИЕНТА ═══")
+        for attachment in attachments:
+            message_parts.append(f"📎 {attachment['name']} ({attachment['type']}, {attachment['size'] / 1024:.0f} КБ)")
+            if attachment.get('url'):
+                message_parts.append(f"   {attachment['url']}")
+            else:
+                message_parts.append(f"   на сервере бота: {attachment['path']}")
+        message_parts.append("")
+    
+    # Как операторы отвечали на похожие вопросы раньше
+    similar_dialogues = find_similar_dialogues(" ".join(filter(None, [summary, technical_specs])))
+    if similar_dialogues:
+        message_parts.append("═══ ПОХОЖИЕ ДИАЛОГИ ═══")
+        for number, (score, record) in enumerate(similar_dialogues, 1):
+            message_parts.append(f"{number}. Диалог №{record['dialogue_id']} (сходство {score:.0%}), оператор {record['operator']}")
+            message_parts.append(f"   👤 {record['question'][:200]}")
+            message_parts.append(f"   💬 {record['answer'][:300]}")
+        message_parts.append("")
+    
     # Footer
     message_parts.append("═══════════════════════════")
     message_parts.append(f"🕐 Время передачи: {__import__('datetime').datetime.now().strftime('%d.%m.%Y %H:%M')}")
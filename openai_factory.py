@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+Единый на процесс OpenAI клиент: настроенный пул соединений, keep-alive, HTTP/2
+и таймауты/повторы для каждой операции
+"""
+
+import importlib.util
+import logging
+import threading
+
+import httpx
+from openai import OpenAI, DefaultHttpxClient
+
+from config import (OPENAI_API_KEY, OPENAI_MAX_CONNECTIONS, OPENAI_MAX_KEEPALIVE, OPENAI_KEEPALIVE_EXPIRY,
+                    OPENAI_HTTP2, OPENAI_CONNECT_TIMEOUT, OPENAI_POLL_TIMEOUT, OPENAI_CREATE_TIMEOUT,
+                    OPENAI_READ_TIMEOUT, OPENAI_COMPLETION_TIMEOUT, OPENAI_READ_RETRIES)
+
+def _timeout(seconds):
+    return httpx.Timeout(seconds, connect=OPENAI_CONNECT_TIMEOUT)
+
+# Таймауты и повторы SDK по операциям. Повторяем внутри SDK только то, что безопасно и
+# не дублирует обработку ошибок в bot.py: опрос run'а повторяет сам цикл опроса, а
+# создание thread'а, сообщения или run'а не идемпотентно (повтор после потерянного ответа
+# создает дубликат) - его ошибку бот сразу показывает пользователю.
+OPERATION_OPTIONS = {
+    'runs.retrieve': {'timeout': _timeout(OPENAI_POLL_TIMEOUT), 'max_retries': 0},
+    'runs.create': {'timeout': _timeout(OPENAI_CREATE_TIMEOUT), 'max_retries': 0},
+    'messages.create': {'timeout': _timeout(OPENAI_CREATE_TIMEOUT), 'max_retries': 0},
+    'threads.create': {'timeout': _timeout(OPENAI_CREATE_TIMEOUT), 'max_retries': 0},
+    'runs.cancel': {'timeout': _timeout(OPENAI_POLL_TIMEOUT), 'max_retries': OPENAI_READ_RETRIES},
+    'runs.submit_tool_outputs': {'timeout': _timeout(OPENAI_CREATE_TIMEOUT), 'max_retries': 0},
+    'runs.list': {'timeout': _timeout(OPENAI_READ_TIMEOUT), 'max_retries': OPENAI_READ_RETRIES},
+    'messages.list': {'timeout': _timeout(OPENAI_READ_TIMEOUT), 'max_retries': OPENAI_READ_RETRIES},
+    'assistants.retrieve': {'timeout': _timeout(OPENAI_READ_TIMEOUT), 'max_retries': OPENAI_READ_RETRIES},
+    'chat.completions': {'timeout': _timeout(OPENAI_COMPLETION_TIMEOUT), 'max_retries': 1},
+}
+
+_lock = threading.RLock()
+_client = None
+_operation_clients = {}
+
+def create_openai_client(api_key=OPENAI_API_KEY, base_url=None):
+    """Создает OpenAI клиент с явно настроенным пулом соединений и keep-alive."""
+    http2 = OPENAI_HTTP2
+    if http2 and importlib.util.find_spec('h2') is None:
+        logging.warning("OPENAI_HTTP2 is set but package 'h2' is not installed, falling back to HTTP/1.1")
+        http2 = False
+
+    http_client = DefaultHttpxClient(
+        limits=httpx.Limits(
+            max_connections=OPENAI_MAX_CONNECTIONS,
+            max_keepalive_connections=OPENAI_MAX_KEEPALIVE,
+            keepalive_expiry=OPENAI_KEEPALIVE_EXPIRY
+        ),
+        http2=http2,
+        timeout=_timeout(OPENAI_READ_TIMEOUT)
+    )
+    logging.info(f"OpenAI client: pool {OPENAI_MAX_CONNECTIONS} connections "
+                 f"({OPENAI_MAX_KEEPALIVE} keep-alive), HTTP/{'2' if http2 else '1.1'}")
+    return OpenAI(api_key=api_key, base_url=base_url, http_client=http_client,
+                  timeout=_timeout(OPENAI_READ_TIMEOUT), max_retries=OPENAI_READ_RETRIES)
+
+def get_openai_client():
+    """Общий для процесса клиент (создается при первом обращении)."""
+    global _client
+    if _client is None:
+        with _lock:
+            if _client is None:
+                _client = create_openai_client()
+    return _client
+
+def openai_for(operation):
+    """
+    Клиент с таймаутом и политикой повторов операции из OPERATION_OPTIONS.
+    Все варианты используют один пул соединений общего клиента.
+    """
+    client = _operation_clients.get(operation)
+    if client is None:
+        with _lock:
+            client = _operation_clients.get(operation)
+            if client is None:
+                client = _operation_clients[operation] = get_openai_client().with_options(**OPERATION_OPTIONS[operation])
+    return client
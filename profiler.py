@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""
+Сэмплирующий профилировщик работающего бота с учетом asyncio задач:
+collapsed stacks для flamegraph и сводка top-N функций
+"""
+
+import asyncio
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+
+from config import PROFILE_INTERVAL
+
+# Модули бота: в сводку попадают только их функции, полный стек остается в collapsed файле
+_PROJECT_MODULES = {
+    os.path.splitext(name)[0]
+    for name in os.listdir(os.path.dirname(os.path.abspath(__file__)))
+    if name.endswith('.py')
+}
+
+def _frame_name(frame):
+    code = frame.f_code
+    module = os.path.splitext(os.path.basename(code.co_filename))[0]
+    return f"{module}:{getattr(code, 'co_qualname', code.co_name)}"
+
+def _thread_stack(frame):
+    """Стек потока от внешнего кадра к внутреннему."""
+    stack = []
+    while frame is not None:
+        stack.append(_frame_name(frame))
+        frame = frame.f_back
+    stack.reverse()
+    return stack
+
+def _coroutine_stack(coro):
+    """Логический стек приостановленной задачи: цепочка await от корутины задачи вглубь."""
+    stack = []
+    while coro is not None:
+        frame = getattr(coro, 'cr_frame', None) or getattr(coro, 'gi_frame', None)
+        if frame is None:
+            break
+        stack.append(_frame_name(frame))
+        coro = getattr(coro, 'cr_await', None) or getattr(coro, 'gi_yieldfrom', None)
+    return stack
+
+class SamplingProfiler:
+    """
+    Профилировщик на время окна: отдельный поток раз в interval секунд снимает
+    стек потока event loop и стеки всех приостановленных asyncio задач.
+
+    Стек потока показывает, чем занят event loop (включая блокирующие вызовы
+    внутри обработчиков), стеки задач - где обработчики ждут (await).
+    Вне окна профилирования поток не запущен и затрат нет.
+    """
+
+    def __init__(self, interval=PROFILE_INTERVAL):
+        self.interval = interval
+        self._thread = None
+        self._stop = threading.Event()
+        self._stacks = Counter()
+        self._samples = 0
+        self._busy_samples = 0
+        self._started_at = None
+        self._owner = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def _sample(self, loop, loop_thread_id):
+        self._samples += 1
+
+        frame = sys._current_frames().get(loop_thread_id)
+        stack = _thread_stack(frame) if frame is not None else []
+        # Внутри selectors loop ждет событий - это простой, а не работа
+        if stack and not stack[-1].startswith('selectors:'):
+            self._busy_samples += 1
+            self._stacks[('loop',) + tuple(stack)] += 1
+        else:
+            self._stacks[('loop', '[idle]')] += 1
+
+        try:
+            tasks = list(asyncio.all_tasks(loop))
+        except RuntimeError:
+            # Набор задач изменился во время копирования - пропускаем этот сэмпл задач
+            return
+
+        for task in tasks:
+            coro = task.get_coro()
+            # Выполняющаяся сейчас задача уже учтена в стеке потока, собственная - не интересна
+            if task is self._owner or coro is None or getattr(coro, 'cr_running', False):
+                continue
+            task_stack = _coroutine_stack(coro)
+            if task_stack:
+                self._stacks[('await',) + tuple(task_stack)] += 1
+
+    def _run(self, loop, loop_thread_id, seconds):
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline and not self._stop.is_set():
+            self._sample(loop, loop_thread_id)
+            self._stop.wait(self.interval)
+
+    async def profile(self, seconds, directory, top=20):
+        """
+        Профилирует окно в seconds секунд и пишет результаты в directory.
+
+        Возвращает (путь к collapsed stacks, путь к сводке, текст сводки).
+        Вызывается из event loop бота; второй параллельный запуск - RuntimeError.
+        """
+        if self.running:
+            raise RuntimeError("Profiling is already running")
+
+        self._stacks = Counter()
+        self._samples = 0
+        self._busy_samples = 0
+        self._started_at = datetime.now()
+        self._stop.clear()
+        self._owner = asyncio.current_task()
+        self._thread = threading.Thread(
+            target=self._run,
+            args=(asyncio.get_running_loop(), threading.get_ident(), seconds),
+            name='sampling-profiler',
+            daemon=True
+        )
+        self._thread.start()
+
+        try:
+            while self._thread.is_alive():
+                await asyncio.sleep(min(seconds, 0.5))
+        finally:
+            self._stop.set()
+
+        return self.write(directory, top)
+
+    def _top(self, kind, top):
+        """Функции бота с наибольшим числом сэмплов (включительно: функция и все, что она вызывает)."""
+        inclusive = Counter()
+        for stack, count in self._stacks.items():
+            if stack[0] != kind:
+                continue
+            for name in set(stack[1:]):
+                module, _, function = name.partition(':')
+                if module in _PROJECT_MODULES and function != '<module>':
+                    inclusive[name] += count
+        return inclusive.most_common(top)
+
+    def summary(self, top=20):
+        duration = self._samples * self.interval
+        busy_share = self._busy_samples / self._samples if self._samples else 0.0
+        lines = [
+            f"🔬 Профиль от {self._started_at:%d.%m.%Y %H:%M:%S}: {self._samples} сэмплов, "
+            f"~{duration:.1f} с, event loop занят {busy_share:.0%}",
+            "",
+            "⏱️ Чем занят event loop (сэмплы, доля времени):"
+        ]
+        for name, count in self._top('loop', top):
+            lines.append(f"  {count:>6}  {count / self._samples:>5.1%}  {name}")
+
+        lines.append("")
+        lines.append("⏳ Где ждут asyncio задачи (сэмплы задач):")
+        for name, count in self._top('await', top):
+            lines.append(f"  {count:>6}  {name}")
+        return "\n".join(lines)
+
+    def write(self, directory, top=20):
+        os.makedirs(directory, exist_ok=True)
+        base = os.path.join(directory, f"profile_{self._started_at:%Y%m%d_%H%M%S}")
+
+        collapsed_path = f"{base}.collapsed"
+        with open(collapsed_path, 'w', encoding='utf-8') as f:
+            for stack, count in sorted(self._stacks.items()):
+                f.write(f"{';'.join(stack)} {count}\n")
+
+        summary = self.summary(top)
+        summary_path = f"{base}.txt"
+        with open(summary_path, 'w', encoding='utf-8') as f:
+            f.write(summary + "\n")
+
+        return collapsed_path, summary_path, summary
@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+"""
+Планировщик исходящих отправок в Telegram: общий и per-chat лимиты,
+приоритет ответов над typing и прозрачная обработка RetryAfter
+"""
+
+import asyncio
+import itertools
+import logging
+import time
+from collections import deque
+from datetime import timedelta
+
+from telegram.error import RetryAfter
+
+from config import SEND_GLOBAL_RATE, SEND_CHAT_INTERVAL, TYPING_INTERVAL
+
+# Меньше - важнее: сообщения всегда уходят раньше индикаторов набора
+PRIORITY_MESSAGE = 0
+PRIORITY_TYPING = 1
+
+class TokenBucket:
+    """Классический token bucket: rate токенов в секунду, не больше capacity в запасе."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def delay(self, now):
+        """Сколько секунд ждать до появления токена (0 - токен есть)."""
+        self._refill(now)
+        return 0.0 if self._tokens >= 1 else (1 - self._tokens) / self.rate
+
+    def take(self, now):
+        self._refill(now)
+        self._tokens -= 1
+
+class _Job:
+    __slots__ = ('factory', 'future', 'priority', 'seq', 'attempts')
+
+    def __init__(self, factory, future, priority, seq):
+        self.factory = factory
+        self.future = future
+        self.priority = priority
+        self.seq = seq
+        self.attempts = 0
+
+class _ChatState:
+    __slots__ = ('messages', 'typing', 'busy', 'next_at', 'last_typing')
+
+    def __init__(self):
+        self.messages = deque()
+        self.typing = None
+        self.busy = False
+        self.next_at = 0.0
+        self.last_typing = float('-inf')
+
+class SendScheduler:
+    """
+    Единая очередь исходящих отправок бота.
+
+    Сообщения одного чата уходят строго по порядку и не чаще chat_interval,
+    все отправки вместе - не чаще global_rate в секунду. Индикатор набора
+    отправляется, только если в чате нет ожидающих сообщений и предыдущий
+    индикатор старше typing_interval; лишние индикаторы отбрасываются.
+    При RetryAfter отправки приостанавливаются на указанное Telegram время,
+    а сообщение повторяется - вызывающий код получает обычный результат.
+
+    До start() (или после stop()) отправки выполняются напрямую.
+    """
+
+    def __init__(self, global_rate=SEND_GLOBAL_RATE, chat_interval=SEND_CHAT_INTERVAL,
+                 typing_interval=TYPING_INTERVAL, max_retries=3):
+        self.chat_interval = chat_interval
+        self.typing_interval = typing_interval
+        self.max_retries = max_retries
+
+        self._bucket = TokenBucket(global_rate)
+        self._chats = {}
+        self._seq = itertools.count()
+        self._paused_until = 0.0
+        self._wakeup = None
+        self._worker = None
+        self._deliveries = set()
+
+        self.stats = {
+            'sent': 0,
+            'typing_sent': 0,
+            'typing_coalesced': 0,
+            'retry_after': 0,
+            'failed': 0
+        }
+
+    def start(self):
+        """Запускает фоновую задачу отправки в текущем event loop."""
+        if self._worker is None:
+            self._wakeup = asyncio.Event()
+            self._worker = asyncio.create_task(self._run())
+            logging.info("Send scheduler started")
+
+    async def stop(self):
+        """Останавливает отправку; неотправленные сообщения завершаются отменой."""
+        if self._worker is None:
+            return
+        self._worker.cancel()
+        await asyncio.gather(self._worker, *self._deliveries, return_exceptions=True)
+        self._worker = None
+
+        for state in self._chats.values():
+            for job in state.messages:
+                if not job.future.done():
+                    job.future.cancel()
+        self._chats.clear()
+        logging.info(f"Send scheduler stopped: {self.stats}")
+
+    def _chat(self, chat_id):
+        state = self._chats.get(chat_id)
+        if state is None:
+            state = self._chats[chat_id] = _ChatState()
+        return state
+
+    async def send(self, chat_id, factory):
+        """
+        Ставит отправку в очередь чата и ждет ее результата.
+
+        factory - функция без аргументов, возвращающая корутину отправки
+        (она вызывается заново при повторе после RetryAfter).
+        """
+        if self._worker is None:
+            return await factory()
+
+        future = asyncio.get_running_loop().create_future()
+        state = self._chat(chat_id)
+        state.messages.append(_Job(factory, future, PRIORITY_MESSAGE, next(self._seq)))
+
+        # Сообщение само снимает индикатор набора - ожидающий typing больше не нужен
+        if state.typing is not None:
+            state.typing = None
+            self.stats['typing_coalesced'] += 1
+
+        self._wakeup.set()
+        return await future
+
+    def send_typing(self, chat):
+        """Ставит индикатор набора без ожидания; повторные и лишние индикаторы отбрасываются."""
+        if self._worker is None:
+            asyncio.create_task(self._send_typing_directly(chat))
+            return
+
+        state = self._chat(chat.id)
+        now = time.monotonic()
+        if state.typing is not None or state.messages or now - state.last_typing < self.typing_interval:
+            self.stats['typing_coalesced'] += 1
+            return
+
+        state.typing = _Job(lambda: chat.send_action(action="typing"), None, PRIORITY_TYPING, next(self._seq))
+        self._wakeup.set()
+
+    async def reply_text(self, message, text, **kwargs):
+        return await self.send(message.chat_id, lambda: message.reply_text(text, **kwargs))
+
+    async def edit_message_text(self, query, text, **kwargs):
+        return await self.send(query.message.chat_id, lambda: query.edit_message_text(text, **kwargs))
+
+    async def _send_typing_directly(self, chat):
+        try:
+            await chat.send_action(action="typing")
+        except Exception as e:
+            logging.warning(f"Could not send typing to chat {chat.id}: {e}")
+
+    def _next_job(self, now):
+        """Выбирает готовую отправку с наивысшим приоритетом; иначе - время до ближайшей."""
+        best = None
+        wait = None
+        idle = []
+
+        for chat_id, state in self._chats.items():
+            if state.busy:
+                continue
+            if state.messages:
+                job = state.messages[0]
+                ready_at = state.next_at
+            elif state.typing is not None:
+                job = state.typing
+                ready_at = now
+            else:
+                if now >= max(state.next_at, state.last_typing + self.typing_interval):
+                    idle.append(chat_id)
+                continue
+
+            if ready_at > now:
+                wait = ready_at - now if wait is None else min(wait, ready_at - now)
+            elif best is None or (job.priority, job.seq) < (best[2].priority, best[2].seq):
+                best = (chat_id, state, job)
+
+        # Состояние простаивающих чатов больше не влияет на лимиты
+        for chat_id in idle:
+            del self._chats[chat_id]
+
+        return best, wait
+
+    async def _run(self):
+        while True:
+            now = time.monotonic()
+            pause = max(self._paused_until - now, self._bucket.delay(now))
+            if pause > 0:
+                await asyncio.sleep(pause)
+                continue
+
+            best, wait = self._next_job(now)
+            if best is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            chat_id, state, job = best
+            self._bucket.take(now)
+            if job.priority == PRIORITY_TYPING:
+                state.typing = None
+                state.last_typing = now
+            else:
+                state.messages.popleft()
+                state.busy = True
+                state.next_at = now + self.chat_interval
+
+            task = asyncio.create_task(self._deliver(chat_id, state, job))
+            self._deliveries.add(task)
+            task.add_done_callback(self._deliveries.discard)
+
+    async def _deliver(self, chat_id, state, job):
+        try:
+            result = await job.factory()
+        except RetryAfter as e:
+            retry_after = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else float(e.retry_after)
+            self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+            self.stats['retry_after'] += 1
+            job.attempts += 1
+            logging.warning(f"Telegram flood control for chat {chat_id}: retry after {retry_after}s (attempt {job.attempts})")
+
+            if job.future is None:
+                # Устаревший индикатор набора не повторяем
+                pass
+            elif job.attempts <= self.max_retries:
+                state.messages.appendleft(job)
+            else:
+                self.stats['failed'] += 1
+                if not job.future.done():
+                    job.future.set_exception(e)
+        except Exception as e:
+            self.stats['failed'] += 1
+            if job.future is None:
+                logging.warning(f"Could not send typing to chat {chat_id}: {e}")
+            elif not job.future.done():
+                job.future.set_exception(e)
+        else:
+            if job.future is None:
+                self.stats['typing_sent'] += 1
+            else:
+                self.stats['sent'] += 1
+                if not job.future.done():
+                    job.future.set_result(result)
+        finally:
+            if job.future is not None:
+                state.busy = False
+            self._wakeup.set()
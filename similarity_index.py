@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+"""
+Индекс похожих вопросов клиентов из обработанных диалогов: hashed TF-IDF векторы
+в виде обратных списков в массивах NumPy и таблица смещений записей.
+
+dialogue_processor.py --similarity-index строит индекс, бот открывает его через
+memory map (без разбора файлов) и при передаче менеджеру ищет похожие прошлые диалоги.
+"""
+
+import json
+import logging
+import os
+import re
+import shutil
+import tempfile
+import threading
+import zlib
+
+import numpy as np
+
+FORMAT_VERSION = 1
+DEFAULT_DIM = 1 << 18
+# Запрос ограничивается самыми весомыми признаками: частые слова (длинные обратные
+# списки) почти не влияют на порядок результатов, но дают основную часть работы
+MAX_QUERY_FEATURES = 24
+
+_TOKEN_RE = re.compile(r'\w+')
+
+def features(text, dim):
+    """Хэшированные признаки текста: основы слов и пары соседних основ -> {bucket: count}."""
+    stems = [word[:6] for word in _TOKEN_RE.findall(text.lower()) if len(word) >= 2]
+    counts = {}
+    for token in stems + [f"{first} {second}" for first, second in zip(stems, stems[1:])]:
+        bucket = zlib.crc32(token.encode('utf-8')) & (dim - 1)
+        counts[bucket] = counts.get(bucket, 0) + 1
+    return counts
+
+class SimilarityIndexBuilder:
+    """
+    Собирает индекс по мере добавления вопросов во временную директорию рядом с directory,
+    publish() делает его индексом directory, discard() удаляет недостроенный:
+
+    - offsets.npy (dim + 1, int64) - границы обратного списка каждого признака;
+    - doc_ids.npy (int32), weights.npy (float32) - обратные списки: записи и веса
+      TF-IDF (векторы записей нормированы, скалярное произведение - косинус);
+    - idf.npy (dim, float32) - IDF признаков для векторизации запроса;
+    - records.bin и record_offsets.npy - записи (JSON) и их смещения;
+    - meta.json - версия формата и размеры.
+
+    directory - символическая ссылка на директорию опубликованной версии. Файлы открытого
+    ботом индекса (memory map) никогда не перезаписываются: новая версия строится в новой
+    директории, ссылка заменяется атомарно, а файлы старой версии только удаляются -
+    отображенные в память страницы остаются доступны боту до его перезапуска.
+    """
+
+    def __init__(self, directory, dim=DEFAULT_DIM):
+        if dim & (dim - 1):
+            raise ValueError("dim must be a power of two")
+        self.target = os.path.abspath(directory)
+        os.makedirs(os.path.dirname(self.target), exist_ok=True)
+        self.directory = tempfile.mkdtemp(prefix=f".{os.path.basename(self.target)}.",
+                                          dir=os.path.dirname(self.target))
+        # mkdtemp создает директорию только для владельца, а бот может работать от другого пользователя
+        os.chmod(self.directory, 0o755)
+        self.dim = dim
+        self.entries = 0
+        self._buckets = []
+        self._counts = []
+        self._record_offsets = [0]
+        self._records = open(os.path.join(self.directory, 'records.bin'), 'wb')
+
+    def __len__(self):
+        return self.entries
+
+    def add(self, question, record):
+        """Добавляет вопрос и запись, которая вернется при поиске; False, если в вопросе нет слов."""
+        counts = features(question, self.dim)
+        if not counts:
+            return False
+        self._buckets.append(np.fromiter(counts.keys(), dtype=np.int32, count=len(counts)))
+        self._counts.append(np.fromiter(counts.values(), dtype=np.float32, count=len(counts)))
+
+        # default=str: ID диалогов из выгрузок бывают типами NumPy/pandas
+        data = json.dumps(record, ensure_ascii=False, default=str).encode('utf-8')
+        self._records.write(data)
+        self._record_offsets.append(self._record_offsets[-1] + len(data))
+        self.entries += 1
+        return True
+
+    def close(self):
+        """Считает веса и записывает массивы индекса."""
+        self._records.close()
+        entries = self.entries
+
+        lengths = np.array([len(buckets) for buckets in self._buckets], dtype=np.int64)
+        buckets = np.concatenate(self._buckets) if entries else np.zeros(0, dtype=np.int32)
+        counts = np.concatenate(self._counts) if entries else np.zeros(0, dtype=np.float32)
+        doc_ids = np.repeat(np.arange(entries, dtype=np.int32), lengths)
+
+        document_frequency = np.bincount(buckets, minlength=self.dim)
+        idf = (np.log((entries + 1) / (document_frequency + 1)) + 1).astype(np.float32)
+        weights = (1 + np.log(counts)) * idf[buckets]
+        norms = np.sqrt(np.bincount(doc_ids, weights=weights ** 2, minlength=entries))
+        weights = (weights / norms[doc_ids]).astype(np.float32)
+
+        # Обратные списки: записи, отсортированные по признаку
+        order = np.argsort(buckets, kind='stable')
+        offsets = np.zeros(self.dim + 1, dtype=np.int64)
+        np.cumsum(document_frequency, out=offsets[1:])
+
+        np.save(os.path.join(self.directory, 'offsets.npy'), offsets)
+        np.save(os.path.join(self.directory, 'doc_ids.npy'), doc_ids[order])
+        np.save(os.path.join(self.directory, 'weights.npy'), weights[order])
+        np.save(os.path.join(self.directory, 'idf.npy'), idf)
+        np.save(os.path.join(self.directory, 'record_offsets.npy'), np.array(self._record_offsets, dtype=np.int64))
+        with open(os.path.join(self.directory, 'meta.json'), 'w', encoding='utf-8') as f:
+            json.dump({'version': FORMAT_VERSION, 'dim': self.dim, 'entries': entries, 'postings': int(len(order))}, f)
+
+        self._buckets = []
+        self._counts = []
+
+    def publish(self):
+        """Делает построенный индекс (после close()) индексом target."""
+        link = self.directory + '.link'
+        os.symlink(os.path.basename(self.directory), link)
+        previous = None
+        if os.path.islink(self.target):
+            previous = os.path.join(os.path.dirname(self.target), os.readlink(self.target))
+        elif os.path.isdir(self.target):
+            # Индекс старого формата (обычная директория): ссылку на ее место не поставить атомарно
+            previous = tempfile.mkdtemp(prefix=f".{os.path.basename(self.target)}.old.",
+                                        dir=os.path.dirname(self.target))
+            os.replace(self.target, os.path.join(previous, 'index'))
+        os.replace(link, self.target)
+        if previous and os.path.abspath(previous) != self.directory:
+            shutil.rmtree(previous, ignore_errors=True)
+
+    def discard(self):
+        """Удаляет недостроенный индекс; опубликованный индекс target не меняется."""
+        if not self._records.closed:
+            self._records.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+class SimilarityIndex:
+    """
+    Индекс, открытый через memory map: массивы не читаются целиком, страницы
+    подгружаются ОС при поиске. Поиск проходит только обратные списки признаков запроса.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, 'meta.json'), 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        if meta['version'] != FORMAT_VERSION:
+            raise ValueError(f"Unsupported similarity index version {meta['version']} in {directory}")
+
+        self.dim = meta['dim']
+        self.entries = meta['entries']
+        self.offsets = self._map('offsets.npy')
+        self.doc_ids = self._map('doc_ids.npy')
+        self.weights = self._map('weights.npy')
+        self.idf = self._map('idf.npy')
+        self.record_offsets = self._map('record_offsets.npy')
+        records_path = os.path.join(directory, 'records.bin')
+        # Пустой файл нельзя отобразить в память
+        self._records = np.memmap(records_path, dtype=np.uint8, mode='r') if os.path.getsize(records_path) else b''
+
+    def _map(self, filename):
+        # Обычный ndarray поверх того же отображения: срезы np.memmap заметно медленнее
+        return np.load(os.path.join(self.directory, filename), mmap_mode='r').view(np.ndarray)
+
+    def record(self, entry):
+        start, end = self.record_offsets[entry], self.record_offsets[entry + 1]
+        return json.loads(bytes(self._records[start:end]).decode('utf-8'))
+
+    def search(self, text, k=3, min_score=0.0, unique_key=None):
+        """
+        До k записей, похожих на text: [(косинус, запись)] по убыванию сходства.
+        unique_key - поле записи, по которому из одинаковых (например, одного диалога) берется лучшая.
+        """
+        counts = features(text, self.dim)
+        if not counts or not self.entries:
+            return []
+
+        buckets = np.fromiter(counts.keys(), dtype=np.int64, count=len(counts))
+        query = (1 + np.log(np.fromiter(counts.values(), dtype=np.float32, count=len(counts)))) * self.idf[buckets]
+        if len(query) > MAX_QUERY_FEATURES:
+            strongest = np.argpartition(-query, MAX_QUERY_FEATURES - 1)[:MAX_QUERY_FEATURES]
+            buckets, query = buckets[strongest], query[strongest]
+        query /= np.sqrt(np.dot(query, query))
+
+        # Все обратные списки признаков запроса одним массивом позиций, без цикла по признакам
+        starts = self.offsets[buckets]
+        lengths = self.offsets[buckets + 1] - starts
+        total = int(lengths.sum())
+        if not total:
+            return []
+        ends = np.cumsum(lengths)
+        positions = np.arange(total) + np.repeat(starts - (ends - lengths), lengths)
+        scores = np.bincount(
+            self.doc_ids[positions],
+            weights=self.weights[positions] * np.repeat(query, lengths),
+            minlength=self.entries
+        )
+
+        # Кандидатов с запасом: часть может отсеяться как повторы unique_key
+        candidates = min(self.entries, k * 4 if unique_key else k)
+        top = np.argpartition(-scores, candidates - 1)[:candidates]
+        top = top[np.argsort(-scores[top])]
+
+        results = []
+        seen = set()
+        for entry in top:
+            score = float(scores[entry])
+            if score <= min_score:
+                break
+            record = self.record(int(entry))
+            if unique_key is not None:
+                if record.get(unique_key) in seen:
+                    continue
+                seen.add(record.get(unique_key))
+            results.append((score, record))
+            if len(results) == k:
+                break
+        return results
+
+_lock = threading.Lock()
+_indexes = {}
+
+def load_index(directory):
+    """
+    Индекс из directory, открытый один раз на процесс; None, если индекса нет или он поврежден.
+    Открывается опубликованная версия (цель ссылки directory): пересборка индекса ее не меняет.
+    """
+    if not directory:
+        return None
+    with _lock:
+        if directory not in _indexes:
+            try:
+                index = SimilarityIndex(os.path.realpath(directory))
+                logging.info(f"Similarity index {directory} ({index.directory}): {index.entries} questions")
+            except (OSError, ValueError, KeyError) as e:
+                logging.error(f"Could not load similarity index {directory}: {e}")
+                index = None
+            _indexes[directory] = index
+        return _indexes[directory]
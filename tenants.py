@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+"""
+Боты (tenants) одного процесса: токен, ассистент, тексты, телефоны и директория данных
+каждого бота. Текущий бот хранится в contextvar и выставляется до обработчиков обновления.
+"""
+
+import contextvars
+import json
+import logging
+import os
+
+from config import (TELEGRAM_TOKEN, ASSISTANT_ID, COMPANY_PHONES, THREADS_DB_PATH, LANGUAGES_DB_PATH,
+                    THREAD_ARCHIVE_DB_PATH, CONVERSATIONS_DB_PATH, ASSISTANT_BACKEND, ASSISTANT_BACKENDS,
+                    CHAT_FAQ_DIR, SIMILARITY_INDEX_DIR, USAGE_DB_PATH, CRM_IDENTITIES_DB_PATH, ASSISTANT_ROUTES)
+from assistant_routing import AssistantRouter, invalid_route_keys, missing_route_files
+
+class Tenant:
+    """
+    Настройки и состояние одного бота.
+
+    Состояние (треды, языки пользователей, архив тредов, локальные разговоры, расход, лиды CRM) загружается
+    из data_dir при первом обращении, поэтому у каждого бота оно свое. utils импортируется
+    внутри свойств: он сам определяет пути через current_tenant().
+    texts - переопределения текстов по языкам: {"ru": {"company_info": "..."}}.
+    backend - бэкенд ответов ("assistants" или "chat"); для chat бэкенда system_prompt
+    заменяет системный промпт, а faq_dir - директорию FAQ.
+    similarity_index_dir - индекс похожих прошлых диалогов для передачи менеджеру.
+    assistant_routes - ассистенты по языку и быстрому действию (assistant_routing.py).
+    """
+
+    def __init__(self, name, token, assistant_id, data_dir=os.path.dirname(THREADS_DB_PATH),
+                 texts=None, phones=None, backend=ASSISTANT_BACKEND, system_prompt=None, faq_dir=CHAT_FAQ_DIR,
+                 similarity_index_dir=SIMILARITY_INDEX_DIR, assistant_routes=None):
+        self.name = name
+        self.token = token
+        self.assistant_id = assistant_id
+        self.data_dir = data_dir
+        self.text_overrides = texts or {}
+        self.phones = phones or COMPANY_PHONES
+        self.backend = backend
+        self.system_prompt = system_prompt
+        self.faq_dir = faq_dir
+        self.similarity_index_dir = similarity_index_dir
+        self.assistant_routes = assistant_routes or {}
+
+        self._user_threads = None
+        self._user_languages = None
+        self._thread_archive = None
+        self._conversations = None
+        self._usage = None
+        self._crm_identities = None
+        self._router = None
+        self._texts = {}
+
+    def __repr__(self):
+        return f"Tenant({self.name!r})"
+
+    def path(self, filename):
+        return os.path.join(self.data_dir, filename)
+
+    @property
+    def user_threads(self):
+        if self._user_threads is None:
+            from utils import load_threads
+            self._user_threads = load_threads(self.path(os.path.basename(THREADS_DB_PATH)))
+        return self._user_threads
+
+    @property
+    def user_languages(self):
+        if self._user_languages is None:
+            from utils import load_user_languages
+            self._user_languages = load_user_languages(self.path(os.path.basename(LANGUAGES_DB_PATH)))
+        return self._user_languages
+
+    @property
+    def thread_archive(self):
+        if self._thread_archive is None:
+            from utils import load_thread_archive
+            self._thread_archive = load_thread_archive(self.path(os.path.basename(THREAD_ARCHIVE_DB_PATH)))
+        return self._thread_archive
+
+    @property
+    def conversations(self):
+        if self._conversations is None:
+            from utils import load_conversations
+            self._conversations = load_conversations(self.path(os.path.basename(CONVERSATIONS_DB_PATH)))
+        return self._conversations
+
+    @property
+    def usage(self):
+        if self._usage is None:
+            from usage_ledger import UsageLedger
+            self._usage = UsageLedger(self.path(os.path.basename(USAGE_DB_PATH)))
+        return self._usage
+
+    @property
+    def crm_identities(self):
+        if self._crm_identities is None:
+            from crm_identity import IdentityIndex
+            self._crm_identities = IdentityIndex(self.path(os.path.basename(CRM_IDENTITIES_DB_PATH)))
+        return self._crm_identities
+
+    @property
+    def router(self):
+        if self._router is None:
+            # У chat бэкенда ассистент по умолчанию - общий системный промпт
+            default = self.assistant_id if self.backend == "assistants" else None
+            self._router = AssistantRouter(default, self.assistant_routes)
+        return self._router
+
+    def texts(self, defaults, lang):
+        """Тексты языка lang: defaults[lang] с переопределениями этого бота."""
+        merged = self._texts.get(lang)
+        if merged is None:
+            merged = self._texts[lang] = {**defaults[lang], **self.text_overrides.get(lang, {})}
+        return merged
+
+# Бот из переменных окружения (TELEGRAM_TOKEN, ASSISTANT_ID, data/) - режим одного бота
+default_tenant = Tenant('default', TELEGRAM_TOKEN, ASSISTANT_ID, assistant_routes=ASSISTANT_ROUTES)
+
+_current_tenant = contextvars.ContextVar('tenant', default=None)
+
+def current_tenant():
+    """Бот, обновление которого сейчас обрабатывается (вне обработки - бот по умолчанию)."""
+    return _current_tenant.get() or default_tenant
+
+def use_tenant(tenant):
+    """Делает tenant текущим ботом для этой задачи и задач/потоков, запущенных из нее."""
+    return _current_tenant.set(tenant)
+
+def load_tenants(path):
+    """
+    Загружает список ботов из JSON файла:
+
+    [{"name": "web2print", "token_env": "TELEGRAM_TOKEN_W2P", "assistant_id": "asst_...",
+      "data_dir": "data/web2print", "phones": ["+998..."], "texts": {"ru": {...}},
+      "backend": "chat", "system_prompt": "...", "faq_dir": "FAQ/web2print",
+      "similarity_index_dir": "data/web2print/similarity_index",
+      "assistant_routes": {"uz": "asst_...", "ru/services": "asst_..."}}]
+
+    Токен задается напрямую ("token") или именем переменной окружения ("token_env").
+    assistant_id обязателен только для бэкенда "assistants".
+    Маршруты ASSISTANT_ROUTES из окружения относятся к боту по умолчанию и ботам не передаются.
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        configs = json.load(f)
+
+    tenants = []
+    errors = []
+    for index, cfg in enumerate(configs):
+        name = cfg.get("name") or f"tenant{index + 1}"
+        token = cfg.get("token") or os.environ.get(cfg.get("token_env", ""))
+        assistant_id = cfg.get("assistant_id") or ASSISTANT_ID
+        backend = cfg.get("backend", ASSISTANT_BACKEND)
+        if not token:
+            errors.append(f"{name}: no token")
+        if backend not in ASSISTANT_BACKENDS:
+            errors.append(f"{name}: unknown backend {backend}")
+        elif backend == "assistants" and not assistant_id:
+            errors.append(f"{name}: no assistant_id")
+        invalid_routes = invalid_route_keys(cfg.get("assistant_routes") or {})
+        if invalid_routes:
+            errors.append(f"{name}: unknown assistant routes {', '.join(invalid_routes)}")
+        if backend == "chat":
+            missing_files = missing_route_files(cfg.get("assistant_routes") or {})
+            if missing_files:
+                errors.append(f"{name}: assistant route prompt files not found: {', '.join(missing_files)}")
+        tenants.append(Tenant(
+            name,
+            token,
+            assistant_id,
+            data_dir=cfg.get("data_dir", os.path.join(os.path.dirname(THREADS_DB_PATH), name)),
+            texts=cfg.get("texts"),
+            phones=cfg.get("phones"),
+            backend=backend,
+            system_prompt=cfg.get("system_prompt"),
+            faq_dir=cfg.get("faq_dir", CHAT_FAQ_DIR),
+            similarity_index_dir=cfg.get("similarity_index_dir", SIMILARITY_INDEX_DIR),
+            assistant_routes=cfg.get("assistant_routes")
+        ))
+
+    names = [tenant.name for tenant in tenants]
+    duplicates = {name for name in names if names.count(name) > 1}
+    if duplicates:
+        errors.append(f"duplicate tenant names: {', '.join(sorted(duplicates))}")
+    data_dirs = [os.path.abspath(tenant.data_dir) for tenant in tenants]
+    if len(set(data_dirs)) != len(data_dirs):
+        errors.append("tenants must not share data_dir")
+
+    if errors:
+        logging.error(f"Invalid tenants config {path}: {'; '.join(errors)}")
+        raise SystemExit(f"Error: invalid tenants config {path}: {'; '.join(errors)}")
+
+    logging.info(f"Loaded {len(tenants)} tenants from {path}: {', '.join(names)}")
+    return tenants
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""
+Тегирование диалогов по бизнес-темам для базы знаний
+"""
+
+import re
+from typing import Callable, Dict, List, Iterable
+
+import pandas as pd
+
+# Темы и ключевые слова (подстроки в нижнем регистре)
+TOPIC_KEYWORDS = {
+    'Ценообразование': ['цена', 'стоимость', 'сколько', 'стоит', 'рубл', 'сум'],
+    'Сроки изготовления': ['срок', 'время', 'когда', 'готов', 'день', 'час'],
+    'Технические характеристики': ['размер', 'формат', 'сантиметр', 'мм', 'см'],
+    'Дизайн и макеты': ['дизайн', 'макет', 'файл', 'картинк', 'изображен'],
+    'Доставка': ['доставк', 'самовывоз', 'привез', 'курьер'],
+    'Оплата': ['оплат', 'плат', 'счет', 'деньг'],
+    'Материалы': ['материал', 'бумаг', 'ткан', 'качеств'],
+    'Процесс заказа': ['заказ', 'оформ', 'как получ'],
+}
+
+# Тема для диалогов, в которых не нашлось ни одного ключевого слова
+DEFAULT_TOPIC = 'Общие вопросы'
+
+class TopicTagger:
+    """
+    Находит темы диалога за один проход по тексту.
+
+    Все ключевые слова собраны в одно регулярное выражение с lookahead, которое
+    проверяет каждую позицию текста. В одной позиции совпадает самое длинное слово,
+    поэтому каждому слову заранее приписаны темы всех слов, являющихся его префиксом
+    ("деньг" дает и "Оплата", и "Сроки изготовления" через "день"). Результат
+    совпадает с проверкой `word in text` для каждого слова.
+    """
+
+    def __init__(self, topic_keywords: Dict[str, List[str]] = None):
+        self.topic_keywords = topic_keywords or TOPIC_KEYWORDS
+
+        keyword_topics = {}
+        for topic, keywords in self.topic_keywords.items():
+            for keyword in keywords:
+                keyword_topics.setdefault(keyword.lower(), set()).add(topic)
+
+        # Самое длинное слово в позиции покрывает все свои префиксы
+        self._keyword_topics = {}
+        for keyword in keyword_topics:
+            topics = set()
+            for other, other_topics in keyword_topics.items():
+                if keyword.startswith(other):
+                    topics |= other_topics
+            self._keyword_topics[keyword] = frozenset(topics)
+
+        alternation = '|'.join(re.escape(k) for k in sorted(keyword_topics, key=len, reverse=True))
+        self._pattern = re.compile(f"(?=({alternation}))")
+
+    def tag_text(self, text: str) -> List[str]:
+        """Возвращает отсортированный список тем для текста"""
+        text = text.lower()
+        found = set()
+        all_topics = len(self.topic_keywords)
+
+        for match in self._pattern.finditer(text):
+            found |= self._keyword_topics[match.group(1)]
+            if len(found) == all_topics:
+                break
+
+        return sorted(found)
+
+    def tag_dialogue(self, messages: Iterable[Dict]) -> List[str]:
+        """Возвращает темы диалога по тексту всех его сообщений"""
+        return self.tag_text(" ".join(msg['text'] for msg in messages))
+
+    def tag_dataframe(self, df: pd.DataFrame, text_column: str = 'Диалог (Demo)',
+                      clean: Callable[[str], str] = None) -> pd.DataFrame:
+        """
+        Тегирование всей таблицы тем же выражением, что и tag_dialogue: по булевой
+        колонке на тему и колонка 'topics' со списком тем каждой строки.
+
+        clean - нормализация текста перед поиском; с DialogueProcessor.clean_message
+        (ссылки заменяются на [ССЫЛКА]) темы совпадают с темами разобранных диалогов.
+        """
+        texts = df[text_column].fillna('').astype(str)
+        if clean is not None:
+            texts = texts.map(clean)
+        topics = texts.map(self.tag_text)
+
+        result = pd.DataFrame(index=df.index)
+        for topic in self.topic_keywords:
+            result[topic] = topics.map(lambda found, topic=topic: topic in found)
+        result['topics'] = topics.astype(object)
+
+        return result
@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+"""
+Запись входящих обновлений Telegram (анонимизированно) и таймингов вызовов OpenAI/Bitrix24,
+которые каждое обновление вызвало. Записи воспроизводит traffic_replay.py.
+
+Тексты сообщений по умолчанию не записываются: вместо них - длина и хэш (одинаковые
+сообщения видны как одинаковые), команды - без аргументов, кнопки бота - как есть.
+Исходный текст пишется только с TRAFFIC_CAPTURE_RAW_TEXT, и тогда anonymize_text убирает
+из него лишь e-mail, упоминания и длинные номера - имена, адреса и прочие личные данные остаются.
+"""
+
+import contextvars
+import functools
+import gzip
+import hashlib
+import inspect
+import json
+import logging
+import os
+import re
+import time
+from datetime import datetime
+
+from config import TRAFFIC_CAPTURE_RAW_TEXT
+from utils import get_user_language
+
+# Обновление, которое сейчас обрабатывается; вызовы бэкендов привязываются к нему
+current_update = contextvars.ContextVar('traffic_update', default=None)
+
+_EMAIL_RE = re.compile(r'[\w.+-]+@[\w-]+\.[\w.-]+')
+_MENTION_RE = re.compile(r'(?<![\w.])@\w+')
+_LONG_NUMBER_RE = re.compile(r'\+?\d[\d\s()-]{5,}\d')
+
+def anonymize_text(text):
+    """Убирает из текста e-mail, упоминания и длинные номера (телефоны, номера счетов)."""
+    text = _EMAIL_RE.sub('user@example.com', text)
+    text = _MENTION_RE.sub('@user', text)
+    return _LONG_NUMBER_RE.sub(lambda m: re.sub(r'\d', '0', m.group(0)), text)
+
+def redact_text(text, keep_texts=()):
+    """Текст сообщения без содержания: команда без аргументов, текст из keep_texts как есть, иначе длина и хэш."""
+    if text.startswith('/'):
+        return text.split()[0]
+    if text in keep_texts:
+        return text
+    digest = hashlib.sha256(text.encode('utf-8')).hexdigest()[:12]
+    return f"[text len={len(text)} sha256={digest}]"
+
+def summarize_run(run):
+    """Краткая сводка run'а для записи: статус, вызванные функции и размер промпта."""
+    summary = {'status': run.status}
+    if run.status == 'requires_action':
+        summary['tools'] = [call.function.name for call in run.required_action.submit_tool_outputs.tool_calls]
+    usage = getattr(run, 'usage', None)
+    if usage is not None:
+        summary['prompt_tokens'] = usage.prompt_tokens
+    return summary
+
+def summarize_completion(result):
+    """Сводка потокового chat completion: вызванные функции и размер промпта."""
+    summary = {'tools': [call['name'] for call in result['tool_calls']]}
+    if result['prompt_tokens'] is not None:
+        summary['prompt_tokens'] = result['prompt_tokens']
+    return summary
+
+def summarize_attachment(attachment):
+    """Сводка загруженного файла клиента: тип и размер (без имени)."""
+    return {'type': attachment['type'], 'size': attachment['size']}
+
+def summarize_request_result(result):
+    """Сводка результата safe_process_message: только тип ошибки, если она была."""
+    return {'error': result['error']} if isinstance(result, dict) and 'error' in result else None
+
+class _UpdateTrace:
+    __slots__ = ('recorder', 'seq', 'started')
+
+    def __init__(self, recorder, seq, started):
+        self.recorder = recorder
+        self.seq = seq
+        self.started = started
+
+def traced(op, summarize=None):
+    """
+    Декоратор вызова бэкенда: если обновление записывается, сохраняет начало и длительность
+    вызова относительно начала обработки обновления. Без записи накладных расходов почти нет.
+    """
+    def record(trace, started, result, error):
+        entry = {
+            'type': 'call',
+            'seq': trace.seq,
+            'op': op,
+            'start': round(started - trace.started, 4),
+            'dur': round(time.monotonic() - started, 4)
+        }
+        if error is not None:
+            entry['error'] = type(error).__name__
+        elif summarize is not None:
+            summary = summarize(result)
+            if summary is not None:
+                entry['result'] = summary
+        trace.recorder.write(entry)
+
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                trace = current_update.get()
+                if not isinstance(trace, _UpdateTrace):
+                    return await func(*args, **kwargs)
+                started = time.monotonic()
+                try:
+                    result = await func(*args, **kwargs)
+                except Exception as e:
+                    record(trace, started, None, e)
+                    raise
+                record(trace, started, result, None)
+                return result
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            trace = current_update.get()
+            if not isinstance(trace, _UpdateTrace):
+                return func(*args, **kwargs)
+            started = time.monotonic()
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                record(trace, started, None, e)
+                raise
+            record(trace, started, result, None)
+            return result
+        return wrapper
+
+    return decorator
+
+class TrafficRecorder:
+    """
+    Пишет обновления и вызовы бэкендов в gzip JSONL файл в directory.
+
+    Пользователи, чаты, update_id и id callback query заменяются порядковыми псевдонимами
+    (1, 2, ...), общими для всей записи. Тексты сообщений заменяются длиной и хэшем (redact_text), кроме команд
+    и keep_texts - текстов кнопок бота, по которым воспроизведение выбирает обработчик.
+    С raw_text тексты пишутся как есть, без e-mail, упоминаний и номеров телефонов.
+    Подключается как TypeHandler(Update) в группе -1, до основных обработчиков.
+    """
+
+    FLUSH_EVERY = 50
+
+    def __init__(self, directory, keep_texts=(), raw_text=TRAFFIC_CAPTURE_RAW_TEXT):
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, f"traffic_{datetime.now().strftime('%Y%m%d_%H%M%S')}.jsonl.gz")
+        self._file = gzip.open(self.path, 'wt', encoding='utf-8')
+        self._started = time.monotonic()
+        self._epoch = time.time()
+        self._pseudonyms = {}
+        self._seq = 0
+        self._pending = 0
+        self.keep_texts = frozenset(keep_texts)
+        self.raw_text = raw_text
+
+        self.write({'type': 'header', 'version': 1, 'started_at': datetime.now().isoformat()})
+        logging.info(f"Traffic capture enabled: {self.path}")
+
+    def pseudonym(self, real_id):
+        return self._pseudonyms.setdefault(real_id, len(self._pseudonyms) + 1)
+
+    def write(self, entry):
+        if self._file is None:
+            return
+        self._file.write(json.dumps(entry, ensure_ascii=False, separators=(',', ':')) + '\n')
+        self._pending += 1
+        if self._pending >= self.FLUSH_EVERY:
+            self._file.flush()
+            self._pending = 0
+
+    def describe(self, update):
+        """Анонимизированное описание обновления или None, если его не нужно записывать."""
+        user = update.effective_user
+        chat = update.effective_chat
+        if user is None or chat is None:
+            return None
+
+        entry = {
+            'type': 'update',
+            # Повторная доставка обновления получает тот же псевдоним - ее видит дедупликация при воспроизведении
+            'update_id': self.pseudonym(('update', update.update_id)),
+            'user': self.pseudonym(user.id),
+            'chat': self.pseudonym(chat.id),
+            'lang': get_user_language(user.id)
+        }
+
+        if update.callback_query is not None:
+            query = update.callback_query
+            entry['kind'] = 'callback'
+            entry['data'] = query.data
+            # Двойное нажатие - новый id, но то же сообщение с кнопкой
+            entry['callback_id'] = self.pseudonym(('callback', query.id))
+            if query.message is not None:
+                entry['message_id'] = query.message.message_id
+        elif update.message is not None:
+            message = update.message
+            entry['message_id'] = message.message_id
+            # Время отправки клиентом (с точностью до секунды) - до ожидания в очереди бота
+            entry['arrived'] = round(message.date.timestamp() - self._epoch, 3)
+            if message.contact is not None:
+                entry['kind'] = 'contact'
+                entry['own_contact'] = message.contact.user_id == user.id
+            elif message.text is not None:
+                entry['kind'] = 'text'
+                entry['text'] = anonymize_text(message.text) if self.raw_text else redact_text(message.text, self.keep_texts)
+            else:
+                entry['kind'] = 'other'
+        else:
+            return None
+
+        return entry
+
+    async def on_update(self, update, context):
+        """Обработчик группы -1: записывает обновление и открывает трассировку его вызовов."""
+        now = time.monotonic()
+        entry = self.describe(update)
+        if entry is None:
+            current_update.set(None)
+            return
+
+        self._seq += 1
+        entry['seq'] = self._seq
+        entry['t'] = round(now - self._started, 3)
+        self.write(entry)
+        current_update.set(_UpdateTrace(self, self._seq, now))
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            logging.info(f"Traffic capture saved: {self.path} ({self._seq} updates)")
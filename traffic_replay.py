@@ -0,0 +1,394 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Воспроизведение записи трафика (traffic_capture.py) через настоящие обработчики bot.py
+на локальных заглушках Telegram, OpenAI и Bitrix24 - в реальном времени или ускоренно
+"""
+
+import argparse
+import asyncio
+import contextvars
+import gzip
+import itertools
+import json
+import logging
+import math
+import os
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict, deque
+from types import SimpleNamespace
+
+from telegram import Update
+from telegram.ext import TypeHandler
+from telegram.request import BaseRequest
+
+REPLAY_TOKEN = '9000000000:REPLAY'
+BOT_USER = {'id': 9000000000, 'is_bot': True, 'first_name': 'Replay', 'username': 'replay_bot'}
+
+# seq записанного обновления, которое сейчас обрабатывается: по нему заглушки берут тайминги
+replay_update = contextvars.ContextVar('replay_update', default=None)
+
+def load_recording(path):
+    """Читает запись: список обновлений и вызовы бэкендов {seq: {op: deque(вызовов)}}"""
+    updates = []
+    calls = defaultdict(lambda: defaultdict(deque))
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt', encoding='utf-8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            if entry['type'] == 'update':
+                updates.append(entry)
+            elif entry['type'] == 'call':
+                calls[entry['seq']][entry['op']].append(entry)
+    return updates, calls
+
+def arrival_offset(entry):
+    """Момент прихода обновления: время отправки клиентом, если оно раньше начала обработки"""
+    if 'arrived' in entry:
+        return max(0.0, min(entry['t'], entry['arrived']))
+    return entry['t']
+
+def percentile(values, share):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(share * len(ordered)) - 1)]
+
+class FakeTelegramRequest(BaseRequest):
+    """Заглушка Bot API: отвечает успехом на все методы и запоминает время сообщений по чатам"""
+
+    def __init__(self):
+        self._message_ids = itertools.count(1_000_000)
+        self.sent = defaultdict(list)
+        self.methods = Counter()
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        api_method = url.rsplit('/', 1)[-1]
+        params = request_data.parameters if request_data is not None else {}
+        self.methods[api_method] += 1
+
+        if api_method == 'getMe':
+            result = BOT_USER
+        elif api_method in ('sendMessage', 'editMessageText'):
+            chat_id = int(params.get('chat_id', 0))
+            self.sent[chat_id].append(time.monotonic())
+            result = {
+                'message_id': next(self._message_ids),
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'},
+                'from': BOT_USER,
+                'text': params.get('text', '')
+            }
+        else:
+            result = True
+
+        return 200, json.dumps({'ok': True, 'result': result}).encode('utf-8')
+
+class FakeBackends:
+    """
+    Заглушки функций OpenAI и Bitrix24, тайминги которых пишет traffic_capture.
+
+    Каждый вызов берет следующую запись этой операции для текущего обновления, блокирует
+    поток на записанное время (деленное на speed) - как и настоящие синхронные вызовы -
+    и возвращает записанный результат: статусы run'ов, вызовы функций, ошибки.
+    """
+
+    def __init__(self, calls, speed):
+        self.calls = calls
+        self.speed = speed
+        self.invocations = Counter()
+
+    def _take(self, op):
+        self.invocations[op] += 1
+        queue = self.calls.get(replay_update.get(), {}).get(op)
+        entry = queue.popleft() if queue else None
+        if entry is not None:
+            time.sleep(entry['dur'] / self.speed)
+            if 'error' in entry:
+                raise RuntimeError(f"Replayed {op} failure: {entry['error']}")
+        return entry
+
+    def create_thread_for_user(self, user_id, user_threads):
+        self._take('openai.create_thread')
+        user_threads[user_id] = f"thread_{user_id}"
+        return user_threads[user_id]
+
+    def get_run_status(self, thread_id, run_id):
+        entry = self._take('openai.get_run_status')
+        result = (entry or {}).get('result', {'status': 'completed'})
+        tool_calls = [
+            SimpleNamespace(function=SimpleNamespace(name=name, arguments=json.dumps({'summary': 'Replay transfer'})))
+            for name in result.get('tools', [])
+        ]
+        return SimpleNamespace(
+            id=run_id,
+            status=result['status'],
+            required_action=SimpleNamespace(submit_tool_outputs=SimpleNamespace(tool_calls=tool_calls)),
+            usage=SimpleNamespace(prompt_tokens=result.get('prompt_tokens', 0))
+        )
+
+    def cancel_run(self, thread_id, run_id):
+        self._take('openai.cancel_run')
+        return SimpleNamespace(id=run_id, status='cancelled')
+
+    def get_assistant_response(self, thread_id):
+        self._take('openai.get_assistant_response')
+        return "Ответ ассистента (replay)"
+
+    def maybe_rotate_thread(self, user_id, thread_id, user_threads, run):
+        self._take('openai.maybe_rotate_thread')
+        return None
+
+    def get_conversation_history(self, thread_id, limit=20):
+        self._take('openai.get_conversation_history')
+        return "👤 Клиент: (replay)"
+
+    async def safe_process_message(self, user_message, thread_id, user_lang, assistant_id=None):
+        entry = self._take('openai.safe_process_message')
+        error = (entry or {}).get('result', {}).get('error')
+        if error:
+            return {'error': error, 'message': ''}
+        return SimpleNamespace(id=f"run_{replay_update.get()}")
+
+    def stream_chat_completion(self, messages, model=None):
+        entry = self._take('openai.chat_completion')
+        tools = (entry or {}).get('result', {}).get('tools', [])
+        return {
+            'text': None if tools else "Ответ ассистента (replay)",
+            'tool_calls': [{'name': name, 'arguments': json.dumps({'summary': 'Replay transfer'})} for name in tools],
+            'prompt_tokens': (entry or {}).get('result', {}).get('prompt_tokens')
+        }
+
+    async def send_to_bitrix(self, user_data, formatted_message, thread_id, attachments=None):
+        self._take('bitrix.send')
+        return None
+
+    async def update_bitrix_lead(self, lead_id, user_data, comment):
+        self._take('bitrix.update')
+        return True
+
+    def install(self, backends_module, crm_module):
+        """Подменяет вызовы OpenAI и Bitrix24 в модулях бота; обработчики и бэкенды остаются настоящими"""
+        for name in ('create_thread_for_user', 'get_run_status', 'cancel_run', 'get_assistant_response',
+                     'maybe_rotate_thread', 'get_conversation_history', 'safe_process_message',
+                     'stream_chat_completion'):
+            setattr(backends_module, name, getattr(self, name))
+        crm_module.send_to_bitrix = self.send_to_bitrix
+        crm_module.update_bitrix_lead = self.update_bitrix_lead
+
+def build_update(entry, bot):
+    """Собирает объект Update из анонимизированной записи"""
+    user = {'id': entry['user'], 'is_bot': False, 'first_name': f"User{entry['user']}"}
+    chat = {'id': entry['chat'], 'type': 'private', 'first_name': user['first_name']}
+    now = int(time.time())
+    # Записи до появления update_id и callback_id - уникальные значения по seq
+    data = {'update_id': entry.get('update_id', entry['seq'])}
+
+    if entry['kind'] == 'callback':
+        data['callback_query'] = {
+            'id': str(entry.get('callback_id', entry['seq'])),
+            'from': user,
+            'chat_instance': str(entry['chat']),
+            'data': entry['data'],
+            'message': {'message_id': entry.get('message_id', entry['seq']), 'date': now, 'chat': chat,
+                        'from': BOT_USER, 'text': '...'}
+        }
+    else:
+        message = {'message_id': entry.get('message_id', entry['seq']), 'date': now, 'chat': chat, 'from': user}
+        if entry['kind'] == 'text':
+            message['text'] = entry['text']
+            if entry['text'].startswith('/'):
+                message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(entry['text'].split()[0])}]
+        elif entry['kind'] == 'contact':
+            contact_user = entry['user'] if entry.get('own_contact') else entry['user'] + 10 ** 9
+            message['contact'] = {'phone_number': '+998000000000', 'first_name': user['first_name'], 'user_id': contact_user}
+        else:
+            return None
+        data['message'] = message
+
+    return Update.de_json(data, bot)
+
+async def replay(updates, calls, speed, verbose=False, stall_budget=None):
+    """Подает обновления в настоящее приложение бота по записанному расписанию и собирает задержки"""
+    # Бот импортируется только здесь: после перехода во временную директорию и настройки окружения
+    import bot as bot_module
+    import assistant_backends as backends_module
+    import crm_identity as crm_module
+    from loop_watchdog import StallError
+    from utils import save_user_language
+
+    if not verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+
+    fakes = FakeBackends(calls, speed)
+    fakes.install(backends_module, crm_module)
+    # Интервалы опроса и per-chat лимиты отправки сжимаются вместе с временем записи
+    backends_module.RUN_POLL_INTERVAL /= speed
+    bot_module.outbound.chat_interval /= speed
+    bot_module.outbound.typing_interval /= speed
+    bot_module.default_tenant.usage.rate_window /= speed
+    # Блокировка loop'а - реальное время, со скоростью воспроизведения не масштабируется
+    if stall_budget is not None:
+        bot_module.watchdog.threshold = stall_budget
+    request = FakeTelegramRequest()
+    application = bot_module.build_application(REPLAY_TOKEN, request=request, capture_dir=None, polling=False)
+
+    # update_id записи - псевдоним настоящего и у повторной доставки совпадает: вызовы бэкендов
+    # привязываются к seq записи через сам объект обновления
+    update_seqs = {}
+
+    async def bind_update(update, context):
+        replay_update.set(update_seqs.pop(id(update), None))
+    application.add_handler(TypeHandler(Update, bind_update), group=bot_module.TENANT_GROUP - 1)
+
+    # Языки пользователей на момент записи
+    for entry in updates:
+        if entry.get('lang') and bot_module.get_user_language(entry['user']) is None:
+            save_user_language(entry['user'], entry['lang'])
+
+    await application.initialize()
+    await bot_module.post_init(application)
+    await application.start()
+
+    schedule = sorted(updates, key=arrival_offset)
+    put_times = {}
+    started = time.monotonic()
+    skipped = 0
+
+    for entry in schedule:
+        delay = started + arrival_offset(entry) / speed - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        update = build_update(entry, application.bot)
+        if update is None:
+            skipped += 1
+            continue
+        put_times[entry['seq']] = (entry['chat'], time.monotonic())
+        update_seqs[id(update)] = entry['seq']
+        await application.update_queue.put(update)
+
+    await application.update_queue.join()
+    wall = time.monotonic() - started
+
+    await application.stop()
+    await bot_module.post_shutdown(application)
+    await application.shutdown()
+
+    # Задержка ответа: от подачи обновления до первого сообщения в его чат
+    latencies = []
+    for chat_id, put_at in put_times.values():
+        replies = [sent for sent in request.sent[chat_id] if sent >= put_at]
+        if replies:
+            latencies.append((min(replies) - put_at) * speed)
+
+    # Бюджет блокировки loop'а: превышение - ошибка воспроизведения со стеками мест блокировки
+    stall_error = None
+    if stall_budget is not None:
+        try:
+            bot_module.watchdog.check(stall_budget)
+        except StallError as e:
+            stall_error = str(e)
+
+    recorded_calls = Counter(op for ops in calls.values() for op, queue in ops.items() for _ in queue)
+    return {
+        'updates': len(put_times),
+        'skipped': skipped,
+        'speed': speed,
+        'wall_seconds': round(wall, 3),
+        'replied': len(latencies),
+        'latency_p50': percentile(latencies, 0.5),
+        'latency_p95': percentile(latencies, 0.95),
+        'latency_max': max(latencies) if latencies else None,
+        'telegram_methods': dict(request.methods),
+        'backend_calls': dict(fakes.invocations),
+        'unused_recorded_calls': dict(recorded_calls),
+        'send_scheduler': dict(bot_module.outbound.stats),
+        'duplicates': application.bot_data['deduplicator'].stats(),
+        'assistant_breaker': bot_module.assistant_breaker.snapshot(),
+        'loop_stalls': bot_module.watchdog.snapshot(),
+        'assistant_routes': bot_module.default_tenant.router.report(),
+        'stall_error': stall_error
+    }
+
+def print_result(result):
+    def fmt(value):
+        return '-' if value is None else f"{value:.2f} с"
+
+    print(f"\n📊 Воспроизведено обновлений: {result['updates']} (пропущено {result['skipped']}) "
+          f"за {result['wall_seconds']} с при скорости {result['speed']}x")
+    print(f"   ⏱️ Задержка первого ответа (в масштабе записи): p50 {fmt(result['latency_p50'])}, "
+          f"p95 {fmt(result['latency_p95'])}, max {fmt(result['latency_max'])} ({result['replied']} ответов)")
+    print(f"   📤 Telegram: {result['telegram_methods']}")
+    print(f"   🔌 Бэкенды: {result['backend_calls']}")
+    if result['unused_recorded_calls']:
+        print(f"   ⚠️ Записанные, но не повторенные вызовы: {result['unused_recorded_calls']}")
+    print(f"   🚦 Планировщик отправок: {result['send_scheduler']}")
+    print(f"   ♻️ Отброшенные дубликаты: {result['duplicates']}")
+    print(f"   🔒 Circuit breaker: {result['assistant_breaker']['state']}, срабатываний {result['assistant_breaker']['trips']}")
+    stalls = result['loop_stalls']
+    print(f"   🐢 Блокировки event loop: {stalls['stalls']} ({stalls['stall_seconds']} с), "
+          f"max задержка {stalls['max_lag'] * 1000:.0f} мс")
+    for site, count in stalls['top_sites']:
+        print(f"      {count} × {site}")
+    for row in result['assistant_routes']:
+        if row['turns']:
+            print(f"   🧭 {row['assistant'] or 'общий промпт'} [{', '.join(row['routes'])}]: {row['turns']} ходов, "
+                  f"prompt_tokens min {row['prompt_min']}, p50 {row['prompt_p50']}, p95 {row['prompt_p95']}")
+
+def main():
+    parser = argparse.ArgumentParser(description='Воспроизведение записанного трафика через обработчики бота')
+    parser.add_argument('recording', help='Файл записи traffic_*.jsonl.gz')
+    parser.add_argument('--speed', type=float, default=1.0, help='Ускорение: 1 - реальное время, 10 - в 10 раз быстрее')
+    parser.add_argument('--output', help='Сохранить результат в JSON')
+    parser.add_argument('--verbose', action='store_true', help='Показывать логи бота')
+    parser.add_argument('--stall-budget', type=float,
+                        help='Завершиться с ошибкой, если event loop блокировался дольше N мс (со стеками)')
+
+    args = parser.parse_args()
+
+    if args.speed <= 0:
+        print("❌ --speed должен быть больше 0")
+        sys.exit(1)
+
+    recording = os.path.abspath(args.recording)
+    output = os.path.abspath(args.output) if args.output else None
+    updates, calls = load_recording(recording)
+    if not updates:
+        print(f"❌ В записи {args.recording} нет обновлений")
+        sys.exit(1)
+
+    # Состояние бота (data/threads.json, языки) пишется во временную директорию, а не в рабочую
+    os.environ.setdefault('OPENAI_API_KEY', 'replay')
+    with tempfile.TemporaryDirectory() as workdir:
+        os.chdir(workdir)
+        stall_budget = args.stall_budget / 1000 if args.stall_budget is not None else None
+        result = asyncio.run(replay(updates, calls, args.speed, args.verbose, stall_budget))
+
+    print_result(result)
+
+    if output:
+        with open(output, 'w', encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"💾 Результат сохранен в {output}")
+
+    if result['stall_error']:
+        print(f"\n❌ {result['stall_error']}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""
+Учет расхода OpenAI по пользователям: токены, длительность и число опросов run'ов
+за каждый день, дневные квоты и ограничение частоты запросов к ассистенту.
+"""
+
+import json
+import logging
+import os
+import time
+from collections import deque
+from datetime import date, timedelta
+
+from config import (USAGE_DAILY_TOKENS, USAGE_DAILY_TURNS, USAGE_RATE_LIMIT, USAGE_RATE_WINDOW,
+                    USAGE_RETENTION_DAYS, USAGE_SAVE_INTERVAL, ADMIN_IDS)
+from utils import write_json_atomic
+
+# Счетчики одного пользователя за день
+COUNTERS = ('turns', 'prompt_tokens', 'completion_tokens', 'seconds', 'polls', 'limited')
+
+# Причины отказа в запросе к ассистенту
+RATE_LIMITED = 'rate'
+QUOTA_EXCEEDED = 'quota'
+
+class UsageLedger:
+    """
+    Журнал расхода одного бота: {"YYYY-MM-DD": {user_id: {turns, prompt_tokens, completion_tokens,
+    seconds, polls, limited}}} в path, не больше retention_days последних дней.
+
+    Запись на диск - не чаще раза в save_interval секунд (и при остановке бота, flush()),
+    чтобы файл с историей всех пользователей не переписывался на каждый ход.
+    Частота запросов считается в памяти: не больше rate_limit ходов за rate_window секунд.
+    Раз в rate_window секунд из памяти убираются пользователи без ходов в окне, истекшие
+    предупреждения и отказы прошлых дней - она не растет с числом всех пользователей бота.
+    Квоты и лимиты 0 выключены; администраторов (ADMIN_IDS) они не касаются.
+    """
+
+    def __init__(self, path, daily_tokens=USAGE_DAILY_TOKENS, daily_turns=USAGE_DAILY_TURNS,
+                 rate_limit=USAGE_RATE_LIMIT, rate_window=USAGE_RATE_WINDOW,
+                 retention_days=USAGE_RETENTION_DAYS, save_interval=USAGE_SAVE_INTERVAL):
+        self.path = path
+        self.daily_tokens = daily_tokens
+        self.daily_turns = daily_turns
+        self.rate_limit = rate_limit
+        self.rate_window = rate_window
+        self.retention_days = retention_days
+        self.save_interval = save_interval
+
+        self._days = self._load()
+        self._recent = {}
+        # Последний отказ пользователю (причина, день) и когда он был предупрежден о лимите
+        self._refusals = {}
+        self._notified = {}
+        self._dirty = False
+        self._saved_at = time.monotonic()
+        self._pruned_at = None
+
+    def _load(self):
+        if os.path.exists(self.path) and os.path.getsize(self.path) > 0:
+            try:
+                with open(self.path, "r") as f:
+                    return {day: {int(k): v for k, v in users.items()} for day, users in json.load(f).items()}
+            except (json.JSONDecodeError, IOError) as e:
+                logging.error(f"Error loading usage ledger: {e}")
+        return {}
+
+    def flush(self):
+        """Сохраняет журнал, если в нем есть несохраненные записи."""
+        if not self._dirty:
+            return
+        oldest = (date.today() - timedelta(days=self.retention_days - 1)).isoformat()
+        for day in [day for day in self._days if day < oldest]:
+            del self._days[day]
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            write_json_atomic(self.path, {day: {str(k): v for k, v in users.items()} for day, users in self._days.items()})
+            self._dirty = False
+            self._saved_at = time.monotonic()
+        except IOError as e:
+            logging.error(f"Error saving usage ledger: {e}")
+
+    def _today(self, user_id):
+        users = self._days.setdefault(date.today().isoformat(), {})
+        counters = users.get(user_id)
+        if counters is None:
+            counters = users[user_id] = dict.fromkeys(COUNTERS, 0)
+        return counters
+
+    def check(self, user_id, now=None):
+        """
+        Можно ли сейчас отправить ход пользователя ассистенту: None или причина отказа
+        (RATE_LIMITED - слишком часто, QUOTA_EXCEEDED - исчерпана дневная квота).
+        Разрешенный ход сразу учитывается в ограничении частоты.
+        """
+        if user_id in ADMIN_IDS:
+            return None
+        now = time.monotonic() if now is None else now
+        if self._pruned_at is None or now - self._pruned_at >= self.rate_window:
+            self._prune(now)
+
+        reason = None
+        counters = self._days.get(date.today().isoformat(), {}).get(user_id)
+        if counters is not None and (
+                (self.daily_tokens and counters['prompt_tokens'] + counters['completion_tokens'] >= self.daily_tokens)
+                or (self.daily_turns and counters['turns'] >= self.daily_turns)):
+            reason = QUOTA_EXCEEDED
+        elif self.rate_limit:
+            recent = self._recent.setdefault(user_id, deque())
+            while recent and now - recent[0] > self.rate_window:
+                recent.popleft()
+            if len(recent) >= self.rate_limit:
+                reason = RATE_LIMITED
+            else:
+                recent.append(now)
+
+        if reason is None:
+            self._refusals.pop(user_id, None)
+        else:
+            self._refusals[user_id] = (reason, date.today().isoformat())
+            self._today(user_id)['limited'] += 1
+            self._dirty = True
+        return reason
+
+    def refusal(self, user_id):
+        """Причина отказа в последнем запросе пользователя или None, если он был разрешен."""
+        refusal = self._refusals.get(user_id)
+        return refusal[0] if refusal is not None else None
+
+    def should_notify(self, user_id, now=None):
+        """Предупреждать ли пользователя об отказе: не чаще раза за rate_window секунд."""
+        now = time.monotonic() if now is None else now
+        notified = self._notified.get(user_id)
+        if notified is not None and now - notified < self.rate_window:
+            return False
+        self._notified[user_id] = now
+        return True
+
+    def _prune(self, now):
+        """Убирает пользователей без ходов в окне частоты, истекшие предупреждения и отказы прошлых дней."""
+        for user_id, recent in list(self._recent.items()):
+            while recent and now - recent[0] > self.rate_window:
+                recent.popleft()
+            if not recent:
+                del self._recent[user_id]
+        for user_id, notified in list(self._notified.items()):
+            if now - notified >= self.rate_window:
+                del self._notified[user_id]
+        today = date.today().isoformat()
+        for user_id, (reason, day) in list(self._refusals.items()):
+            if day != today:
+                del self._refusals[user_id]
+        self._pruned_at = now
+
+    def record(self, user_id, seconds, usage=None):
+        """Учитывает ход пользователя: длительность и расход бэкенда (usage из TurnResult)."""
+        counters = self._today(user_id)
+        counters['turns'] += 1
+        counters['seconds'] = round(counters['seconds'] + seconds, 3)
+        for key in ('prompt_tokens', 'completion_tokens', 'polls'):
+            counters[key] += (usage or {}).get(key) or 0
+        self._dirty = True
+        if time.monotonic() - self._saved_at >= self.save_interval:
+            self.flush()
+
+    def top(self, days=1, limit=10):
+        """
+        Самые затратные пользователи за последние days дней (включая сегодня):
+        [(user_id, суммы счетчиков)] по убыванию токенов.
+        """
+        since = (date.today() - timedelta(days=days - 1)).isoformat()
+        totals = {}
+        for day, users in self._days.items():
+            if day < since:
+                continue
+            for user_id, counters in users.items():
+                total = totals.setdefault(user_id, dict.fromkeys(COUNTERS, 0))
+                for key in COUNTERS:
+                    total[key] += counters.get(key, 0)
+        ranked = sorted(totals.items(),
+                        key=lambda item: (item[1]['prompt_tokens'] + item[1]['completion_tokens'], item[1]['turns']),
+                        reverse=True)
+        return ranked[:limit]
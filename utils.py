@@ -3,7 +3,9 @@ import json
 import logging
 import time
 import os
-from config import THREADS_DB_PATH
+import tempfile
+from config import THREADS_DB_PATH, THREAD_ARCHIVE_DB_PATH, CONVERSATIONS_DB_PATH
+from tenants import current_tenant
 
 # Путь к файлу с языками пользователей
 LANGUAGES_DB_PATH = "data/languages.json"
@@ -14,11 +16,16 @@ def log_user_action(user_id, username, action, message_text=""):
     log_entry = f"{timestamp} | User {user_id} (@{username}) | {action} | {message_text[:50]}"
     logging.info(log_entry)
 
-def load_threads():
-    """Загружает сохраненные треды из файла."""
-    if os.path.exists(THREADS_DB_PATH) and os.path.getsize(THREADS_DB_PATH) > 0:
+def tenant_path(default_path):
+    """Путь к файлу данных default_path в директории данных текущего бота."""
+    return current_tenant().path(os.path.basename(default_path))
+
+def load_threads(path=None):
+    """Загружает сохраненные треды из файла (по умолчанию - файл текущего бота)."""
+    path = path or tenant_path(THREADS_DB_PATH)
+    if os.path.exists(path) and os.path.getsize(path) > 0:
         try:
-            with open(THREADS_DB_PATH, "r") as f:
+            with open(path, "r") as f:
                 threads = json.load(f)
                 # Конвертируем строковые ключи обратно в целые числа
                 return {int(k): v for k, v in threads.items()}
@@ -27,28 +34,85 @@ def load_threads():
             return {}
     else:
         # Создаем директорию, если она не существует
-        os.makedirs(os.path.dirname(THREADS_DB_PATH), exist_ok=True)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
         # Создаем пустой файл с пустым словарем
-        with open(THREADS_DB_PATH, "w") as f:
+        with open(path, "w") as f:
             json.dump({}, f)
         return {}
 
-def save_threads(threads_dict):
+def write_json_atomic(path, data):
+    """
+    Записывает JSON через временный файл, чтобы прерванная запись не портила данные.
+    Временный файл уникален: одновременные сохранения из разных потоков не мешают друг другу.
+    """
+    with tempfile.NamedTemporaryFile("w", dir=os.path.dirname(path) or ".",
+                                     prefix=f".{os.path.basename(path)}.", suffix=".tmp", delete=False) as f:
+        tmp_path = f.name
+        try:
+            json.dump(data, f)
+        except BaseException:
+            f.close()
+            os.remove(tmp_path)
+            raise
+    os.replace(tmp_path, path)
+
+def save_threads(threads_dict, path=None):
     """Сохраняет треды в файл."""
+    path = path or tenant_path(THREADS_DB_PATH)
     try:
         # Преобразуем ключи из int в str для корректного JSON
         threads_str_keys = {str(k): v for k, v in threads_dict.items()}
-        with open(THREADS_DB_PATH, "w") as f:
-            json.dump(threads_str_keys, f)
-        logging.info(f"Threads data saved to {THREADS_DB_PATH}")
+        write_json_atomic(path, threads_str_keys)
+        logging.info(f"Threads data saved to {path}")
     except IOError as e:
         logging.error(f"Error saving threads data: {e}")
 
-def load_user_languages():
+def load_thread_archive(path=None):
+    """Загружает архив свернутых тредов: новый thread_id -> резюме предыдущего разговора."""
+    path = path or tenant_path(THREAD_ARCHIVE_DB_PATH)
+    if os.path.exists(path) and os.path.getsize(path) > 0:
+        try:
+            with open(path, "r") as f:
+                return json.load(f)
+        except (json.JSONDecodeError, IOError) as e:
+            logging.error(f"Error loading thread archive: {e}")
+    return {}
+
+def save_thread_archive(archive, path=None):
+    """Сохраняет архив свернутых тредов."""
+    path = path or tenant_path(THREAD_ARCHIVE_DB_PATH)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        write_json_atomic(path, archive)
+    except IOError as e:
+        logging.error(f"Error saving thread archive: {e}")
+
+def load_conversations(path=None):
+    """Загружает локальные истории разговоров chat бэкенда: user_id -> список сообщений."""
+    path = path or tenant_path(CONVERSATIONS_DB_PATH)
+    if os.path.exists(path) and os.path.getsize(path) > 0:
+        try:
+            with open(path, "r") as f:
+                return {int(k): v for k, v in json.load(f).items()}
+        except (json.JSONDecodeError, IOError) as e:
+            logging.error(f"Error loading conversations: {e}")
+    return {}
+
+def save_conversations(conversations, path=None):
+    """Сохраняет локальные истории разговоров."""
+    path = path or tenant_path(CONVERSATIONS_DB_PATH)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        write_json_atomic(path, {str(k): v for k, v in conversations.items()})
+    except IOError as e:
+        logging.error(f"Error saving conversations: {e}")
+
+def load_user_languages(path=None):
     """Загружает языки пользователей из файла."""
-    if os.path.exists(LANGUAGES_DB_PATH) and os.path.getsize(LANGUAGES_DB_PATH) > 0:
+    path = path or tenant_path(LANGUAGES_DB_PATH)
+    if os.path.exists(path) and os.path.getsize(path) > 0:
         try:
-            with open(LANGUAGES_DB_PATH, "r") as f:
+            with open(path, "r") as f:
                 languages = json.load(f)
                 # Конвертируем строковые ключи обратно в целые числа
                 return {int(k): v for k, v in languages.items()}
@@ -57,34 +121,31 @@ def load_user_languages():
             return {}
     else:
         # Создаем директорию, если она не существует
-        os.makedirs(os.path.dirname(LANGUAGES_DB_PATH), exist_ok=True)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
         # Создаем пустой файл с пустым словарем
-        with open(LANGUAGES_DB_PATH, "w") as f:
+        with open(path, "w") as f:
             json.dump({}, f)
         return {}
 
-def save_user_languages(languages_dict):
+def save_user_languages(languages_dict, path=None):
     """Сохраняет языки пользователей в файл."""
+    path = path or tenant_path(LANGUAGES_DB_PATH)
     try:
         # Преобразуем ключи из int в str для корректного JSON
         languages_str_keys = {str(k): v for k, v in languages_dict.items()}
-        with open(LANGUAGES_DB_PATH, "w") as f:
+        with open(path, "w") as f:
             json.dump(languages_str_keys, f)
-        logging.info(f"Languages data saved to {LANGUAGES_DB_PATH}")
+        logging.info(f"Languages data saved to {path}")
     except IOError as e:
         logging.error(f"Error saving languages data: {e}")
 
-# Глобальная переменная для хранения языков пользователей
-_user_languages = load_user_languages()
-
 def save_user_language(user_id, language_code):
-    """Сохраняет выбранный язык пользователя."""
-    global _user_languages
-    _user_languages[user_id] = language_code
-    save_user_languages(_user_languages)
+    """Сохраняет выбранный язык пользователя (языки у каждого бота свои)."""
+    user_languages = current_tenant().user_languages
+    user_languages[user_id] = language_code
+    save_user_languages(user_languages)
     logging.info(f"Language set for user {user_id}: {language_code}")
 
 def get_user_language(user_id):
     """Получает язык пользователя. Возвращает None, если язык не установлен."""
-    global _user_languages
-    return _user_languages.get(user_id)
\ No newline at end of file
+    return current_tenant().user_languages.get(user_id)
\ No newline at end of file
@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Инкрементальная синхронизация файлов базы знаний (FAQ/ и результатов dialogue_processor)
+с Vector Store ассистента
+"""
+
+import argparse
+import glob
+import hashlib
+import json
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Dict, List, Tuple
+
+from openai import OpenAI
+
+from config import OPENAI_API_KEY, VECTOR_STORE_ID, VECTOR_STORE_SYNC_DB_PATH
+
+class OpenAIVectorStoreBackend:
+    """
+    Операции с файлами и Vector Store через OpenAI API.
+
+    base_url позволяет направить все вызовы на локальную заглушку
+    эндпоинтов /files и /vector_stores для проверки синхронизации.
+    """
+
+    def __init__(self, vector_store_id: str, api_key: str = None, base_url: str = None):
+        self.vector_store_id = vector_store_id
+        self.client = OpenAI(api_key=api_key, base_url=base_url)
+        # В старых версиях SDK Vector Store API находится в beta
+        self.vector_stores = getattr(self.client, 'vector_stores', None) or self.client.beta.vector_stores
+
+    def upload_file(self, path: str) -> str:
+        with open(path, 'rb') as f:
+            uploaded = self.client.files.create(file=f, purpose='assistants')
+        return uploaded.id
+
+    def attach_files(self, file_ids: List[str]) -> Dict:
+        batch = self.vector_stores.file_batches.create_and_poll(
+            vector_store_id=self.vector_store_id,
+            file_ids=file_ids
+        )
+        # Прикрепленными считаются только файлы, обработка которых завершилась успешно
+        attached = [
+            file.id for file in self.vector_stores.file_batches.list_files(
+                batch.id, vector_store_id=self.vector_store_id, filter='completed'
+            )
+        ]
+        return {
+            'batch_id': batch.id,
+            'status': batch.status,
+            'completed': batch.file_counts.completed,
+            'failed': batch.file_counts.failed,
+            'attached': attached
+        }
+
+    def delete_file(self, file_id: str):
+        self.vector_stores.files.delete(vector_store_id=self.vector_store_id, file_id=file_id)
+        self.client.files.delete(file_id)
+
+    def discard_upload(self, file_id: str):
+        """Удаляет загруженный, но не прикрепленный файл (он мог остаться в Vector Store со статусом failed)"""
+        try:
+            self.vector_stores.files.delete(vector_store_id=self.vector_store_id, file_id=file_id)
+        except Exception:
+            pass
+        self.client.files.delete(file_id)
+
+def file_sha256(path: str) -> str:
+    """Считает SHA-256 содержимого файла"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def collect_files(sources: List[str], pattern: str) -> Dict[str, str]:
+    """Собирает файлы для синхронизации: {нормализованный путь: путь}"""
+    files = {}
+    for source in sources:
+        if os.path.isdir(source):
+            matches = glob.glob(os.path.join(source, '**', pattern), recursive=True)
+        else:
+            matches = [source]
+        for path in sorted(matches):
+            if os.path.isfile(path):
+                files[os.path.normpath(path)] = path
+    return files
+
+def load_sync_state(db_path: str = VECTOR_STORE_SYNC_DB_PATH) -> Dict:
+    """Загружает записи о загруженных файлах по каждому Vector Store"""
+    if os.path.exists(db_path) and os.path.getsize(db_path) > 0:
+        try:
+            with open(db_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (json.JSONDecodeError, IOError) as e:
+            print(f"⚠️ Не удалось прочитать {db_path}: {e}")
+    return {}
+
+def save_sync_state(state: Dict, db_path: str = VECTOR_STORE_SYNC_DB_PATH):
+    """Атомарно сохраняет записи о загруженных файлах"""
+    os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+    tmp_path = db_path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(state, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, db_path)
+
+def plan_sync(local_files: Dict[str, str], hashes: Dict[str, str], uploaded: Dict[str, Dict],
+              sources: List[str]) -> Tuple[List[str], List[str], List[str]]:
+    """
+    Сравнивает локальные файлы с записью о загруженных.
+
+    Возвращает (новые, измененные, удаленные). Удаленными считаются только файлы
+    внутри синхронизируемых источников - записи других источников не трогаем.
+    """
+    roots = [os.path.normpath(source) for source in sources]
+
+    def in_sources(key: str) -> bool:
+        return any(key == root or key.startswith(root + os.sep) for root in roots)
+
+    new = [key for key in local_files if key not in uploaded]
+    changed = [key for key in local_files if key in uploaded and uploaded[key]['sha256'] != hashes[key]]
+    removed = [key for key in uploaded if key not in local_files and in_sources(key)]
+    return new, changed, removed
+
+def sync(backend, sources: List[str], pattern: str = '*.txt', workers: int = 4,
+         dry_run: bool = False, db_path: str = VECTOR_STORE_SYNC_DB_PATH) -> Dict:
+    """Загружает новые и измененные файлы, прикрепляет их одним batch и удаляет исчезнувшие"""
+    state = load_sync_state(db_path)
+    uploaded = state.setdefault(backend.vector_store_id, {})
+
+    local_files = collect_files(sources, pattern)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        hashes = dict(zip(local_files, executor.map(file_sha256, local_files.values())))
+
+    new, changed, removed = plan_sync(local_files, hashes, uploaded, sources)
+    unchanged = len(local_files) - len(new) - len(changed)
+    print(f"📊 Файлов: {len(local_files)}, без изменений: {unchanged}, новых: {len(new)}, измененных: {len(changed)}, удаленных: {len(removed)}")
+
+    for key in new:
+        print(f"   ➕ {key}")
+    for key in changed:
+        print(f"   ✏️ {key}")
+    for key in removed:
+        print(f"   ➖ {key}")
+
+    summary = {
+        'files': len(local_files),
+        'unchanged': unchanged,
+        'new': len(new),
+        'changed': len(changed),
+        'removed': len(removed),
+        'uploaded': 0,
+        'deleted': 0,
+        'errors': []
+    }
+    if dry_run:
+        return summary
+
+    # Загружаем файлы параллельно с ограничением числа потоков
+    to_upload = new + changed
+    upload_results = {}
+
+    def upload(key):
+        try:
+            return key, backend.upload_file(local_files[key]), None
+        except Exception as e:
+            return key, None, str(e)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for key, file_id, error in executor.map(upload, to_upload):
+            if error is not None:
+                print(f"❌ Ошибка загрузки {key}: {error}")
+                summary['errors'].append({'file': key, 'error': error})
+            else:
+                upload_results[key] = file_id
+
+    # Все загруженные файлы прикрепляем к Vector Store одним batch
+    stale_file_ids = [uploaded[key]['file_id'] for key in removed]
+    if upload_results:
+        attached = set()
+        try:
+            batch = backend.attach_files(list(upload_results.values()))
+            attached = set(batch.pop('attached'))
+            summary['batch'] = batch
+            print(f"📦 Batch {batch['batch_id']}: {batch['status']}, прикреплено {batch['completed']}, ошибок {batch['failed']}")
+        except Exception as e:
+            print(f"❌ Ошибка прикрепления файлов к Vector Store: {e}")
+            summary['errors'].append({'batch': 'attach', 'error': str(e)})
+
+        # Запись обновляется и старая версия удаляется только для прикрепленных файлов:
+        # у остальных в Vector Store остается прежняя версия, а новая загрузка удаляется
+        now = datetime.now().isoformat()
+        failed_uploads = []
+        for key, file_id in upload_results.items():
+            if file_id not in attached:
+                print(f"❌ Файл {key} не прикреплен, прежняя версия сохранена")
+                summary['errors'].append({'file': key, 'error': 'not attached'})
+                failed_uploads.append(file_id)
+                continue
+            if key in uploaded:
+                stale_file_ids.append(uploaded[key]['file_id'])
+            uploaded[key] = {
+                'sha256': hashes[key],
+                'file_id': file_id,
+                'size': os.path.getsize(local_files[key]),
+                'uploaded_at': now
+            }
+            summary['uploaded'] += 1
+
+        for file_id in failed_uploads:
+            try:
+                backend.discard_upload(file_id)
+            except Exception as e:
+                print(f"⚠️ Не удалось удалить неприкрепленную загрузку {file_id}: {e}")
+                summary['errors'].append({'file_id': file_id, 'error': str(e)})
+
+    # Старые версии измененных и исчезнувшие файлы удаляем после прикрепления новых
+    def delete(file_id):
+        try:
+            backend.delete_file(file_id)
+            return file_id, None
+        except Exception as e:
+            return file_id, str(e)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for file_id, error in executor.map(delete, stale_file_ids):
+            if error is not None:
+                print(f"⚠️ Не удалось удалить {file_id}: {error}")
+                summary['errors'].append({'file_id': file_id, 'error': error})
+            else:
+                summary['deleted'] += 1
+
+    for key in removed:
+        del uploaded[key]
+
+    save_sync_state(state, db_path)
+    return summary
+
+def main():
+    parser = argparse.ArgumentParser(description='Инкрементальная синхронизация базы знаний с Vector Store')
+    parser.add_argument('sources', nargs='*', default=['FAQ'], help='Файлы и директории для синхронизации (по умолчанию FAQ)')
+    parser.add_argument('--pattern', default='*.txt', help='Шаблон файлов внутри директорий (по умолчанию *.txt)')
+    parser.add_argument('--vector-store-id', default=VECTOR_STORE_ID, help='ID Vector Store (по умолчанию из VECTOR_STORE_ID)')
+    parser.add_argument('--workers', type=int, default=4, help='Максимум одновременных загрузок (по умолчанию 4)')
+    parser.add_argument('--base-url', default=os.environ.get('OPENAI_BASE_URL'), help='Адрес API, например локальной заглушки')
+    parser.add_argument('--state-file', default=VECTOR_STORE_SYNC_DB_PATH, help=f'Файл с записью о загруженных файлах (по умолчанию {VECTOR_STORE_SYNC_DB_PATH})')
+    parser.add_argument('--dry-run', action='store_true', help='Только показать, что будет загружено и удалено')
+
+    args = parser.parse_args()
+
+    if not args.vector_store_id:
+        print("❌ Не указан Vector Store: задайте VECTOR_STORE_ID или --vector-store-id")
+        sys.exit(1)
+
+    backend = OpenAIVectorStoreBackend(args.vector_store_id, api_key=OPENAI_API_KEY, base_url=args.base_url)
+    summary = sync(backend, args.sources, args.pattern, args.workers, args.dry_run, args.state_file)
+
+    if summary['errors']:
+        print(f"⚠️ Завершено с ошибками: {len(summary['errors'])}")
+        sys.exit(1)
+
+    print(f"🎉 Готово! Загружено: {summary['uploaded']}, удалено: {summary['deleted']}")
+
+if __name__ == "__main__":
+    main()